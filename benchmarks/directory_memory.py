@@ -0,0 +1,144 @@
+"""
+Memory benchmark for the user directory
+
+Builds a directory of synthetic users with the plain dict the bot used to
+keep, with a pair of dicts for two way lookups and with the NameIndex it
+keeps now, then reports the memory each one holds on to and how long
+lookups take in both directions. Run it from the repository root:
+
+    python -m benchmarks.directory_memory [user counts...]
+
+"""
+import gc
+import sys
+import time
+import tracemalloc
+
+from directory import NameIndex
+
+DEFAULT_COUNTS = (10_000, 100_000, 1_000_000)
+LOOKUPS = 10_000
+SCANS = 20  # Name lookups in a plain dict are a scan of every user, only time a few
+
+
+def synthetic_users(count: int):
+    """
+    Yield (id, name) pairs shaped like Slack users, as fresh strings the way
+    decoding a users.list response would create them.
+
+    """
+    for number in range(count):
+        yield f'U{number:010X}', f'user.{number:x}.example'
+
+
+class PlainDict:
+    """
+    The id to name dict the bot used to keep, with its name scan
+
+    """
+    label = 'dict id->name'
+    name_lookups = SCANS
+
+    def __init__(self, users):
+        self.users = dict(users)
+
+    def name(self, user_id):
+        return self.users[user_id]
+
+    def user_id(self, name):
+        for user_id, user_name in self.users.items():
+            if user_name == name:
+                return user_id
+
+
+class DictPair(PlainDict):
+    """
+    A dict in each direction
+
+    """
+    label = 'dict id<->name'
+    name_lookups = LOOKUPS
+
+    def __init__(self, users):
+        self.users, self.user_ids = {}, {}
+        for user_id, user_name in users:
+            self.users[user_id] = user_name
+            self.user_ids[user_name] = user_id
+
+    def user_id(self, name):
+        return self.user_ids[name]
+
+
+class Index(PlainDict):
+    """
+    The NameIndex the directory keeps
+
+    """
+    label = 'NameIndex id<->name'
+    name_lookups = LOOKUPS
+
+    def __init__(self, users):
+        self.users = NameIndex(users)
+
+    def user_id(self, name):
+        return self.users.key_for(name)
+
+
+def measure_memory(structure, count: int) -> int:
+    """
+    Build a directory and measure the memory it keeps.
+
+    """
+    gc.collect()
+    tracemalloc.start()
+    directory = structure(synthetic_users(count))
+    gc.collect()
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del directory
+
+    return held
+
+
+def measure_speed(structure, count: int) -> tuple:
+    """
+    Time building a directory and looking users up in both directions.
+
+    Returns:
+        The build time in seconds and the id and name lookup times in microseconds
+
+    """
+    started = time.perf_counter()
+    directory = structure(synthetic_users(count))
+    build = time.perf_counter() - started
+
+    # Spread the lookups over the whole directory
+    user_ids = [user_id for user_id, _ in synthetic_users(count)][::max(count // LOOKUPS, 1)]
+    names = [name for _, name in synthetic_users(count)][::max(count // structure.name_lookups, 1)]
+
+    started = time.perf_counter()
+    for user_id in user_ids:
+        directory.name(user_id)
+    by_id = (time.perf_counter() - started) / len(user_ids) * 1e6
+
+    started = time.perf_counter()
+    for name in names:
+        directory.user_id(name)
+    by_name = (time.perf_counter() - started) / len(names) * 1e6
+
+    return build, by_id, by_name
+
+
+def main(counts):
+    print(f'{"users":>10} {"structure":<20} {"MB":>8} {"bytes/user":>11} {"build s":>8} '
+          f'{"id->name us":>12} {"name->id us":>12}')
+    for count in counts:
+        for structure in (PlainDict, DictPair, Index):
+            held = measure_memory(structure, count)
+            build, by_id, by_name = measure_speed(structure, count)
+            print(f'{count:>10} {structure.label:<20} {held / 2 ** 20:>8.1f} {held / count:>11.1f} {build:>8.2f} '
+                  f'{by_id:>12.2f} {by_name:>12.2f}')
+
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or DEFAULT_COUNTS)
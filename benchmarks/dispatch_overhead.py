@@ -0,0 +1,124 @@
+"""
+Per message dispatch overhead benchmark
+
+Times how long the bot takes to turn an RTM message into a finished command,
+with commands built the way they used to be, resolving the channel and user
+names and building settings in the constructor, and the way they are now,
+with a lazily resolved request context. Run it from the repository root:
+
+    python -m benchmarks.dispatch_overhead [messages]
+
+"""
+import sys
+import time
+
+from bot import MattBot
+from commands.base import Command, CommandResult
+from registry import CommandRegistry
+
+DEFAULT_MESSAGES = 100_000
+BOT_ID = 'UBOT'
+
+
+class NullTransport:
+    """
+    Answers every Web API call without going anywhere
+
+    """
+    def api_call(self, method, token=None, **parameters):
+        return {'ok': True}
+
+    def metrics(self):
+        return {}
+
+
+class NoopCommand(Command):
+    """
+    A command that uses nothing from its context
+
+    """
+    def run(self, parameters: str) -> bool:
+        return CommandResult(success=True, message=parameters)
+
+
+class GreetCommand(Command):
+    """
+    A command that uses the user name, like hello
+
+    """
+    def run(self, parameters: str) -> bool:
+        return CommandResult(success=True, message=f'Hello, {self.user_name}!')
+
+
+class EagerCommand(Command):
+    """
+    Builds itself the way Command.__init__ used to
+
+    """
+    def __init__(self, bot, channel, user, context=None):
+        super().__init__(bot, channel, user, context)
+        self.eager_settings = {
+            'check_logs': None
+        }
+        self.eager_channel_name = self.bot.get_channel_name(channel)
+        self.eager_user_name = self.bot.get_user_name(user)
+
+
+class EagernoopCommand(EagerCommand, NoopCommand):
+    pass
+
+
+class EagergreetCommand(EagerCommand, GreetCommand):
+    pass
+
+
+def make_bot() -> MattBot:
+    registry = CommandRegistry([NoopCommand, GreetCommand, EagernoopCommand, EagergreetCommand])
+    bot = MattBot(token='benchmark', registry=registry, queue_messages=False, transport=NullTransport(),
+                  connect=False)
+    bot.slack_user_id = BOT_ID
+    bot.slack_users.update({BOT_ID: 'mattbot', 'U1': 'alice'})
+    bot.slack_channels['C1'] = 'general'
+
+    return bot
+
+
+def time_construction(bot: MattBot, command_class: type, messages: int) -> float:
+    started = time.perf_counter()
+    for _ in range(messages):
+        command_class(bot, channel='C1', user='U1')
+
+    return (time.perf_counter() - started) / messages * 1e6
+
+
+def time_dispatch(bot: MattBot, command: str, messages: int) -> float:
+    event = {'type': 'message', 'user': 'U1', 'channel': 'C1', 'text': f'<@{BOT_ID}> {command} now'}
+    batch = [event] * 100
+
+    started = time.perf_counter()
+    for _ in range(messages // len(batch)):
+        bot.parse_slack_output(batch, None)
+    elapsed = time.perf_counter() - started
+
+    return elapsed / messages * 1e6
+
+
+def main(messages: int):
+    bot = make_bot()
+
+    print(f'{"":<32} {"before us":>10} {"after us":>10}')
+    for label, before, after in (
+            ('construct, no names used', EagernoopCommand, NoopCommand),
+            ('construct, user name used', EagergreetCommand, GreetCommand)):
+        print(f'{label:<32} {time_construction(bot, before, messages):>10.2f} '
+              f'{time_construction(bot, after, messages):>10.2f}')
+
+    for label, before, after in (
+            ('dispatch, no names used', 'eagernoop', 'noop'),
+            ('dispatch, user name used', 'eagergreet', 'greet')):
+        print(f'{label:<32} {time_dispatch(bot, before, messages):>10.2f} '
+              f'{time_dispatch(bot, after, messages):>10.2f}')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_MESSAGES)
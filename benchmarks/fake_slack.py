@@ -0,0 +1,632 @@
+"""
+A local stand in for Slack
+
+Serves the RTM websocket, the Web API methods the bot uses and private file
+downloads from one asyncio server, so the whole stack can be driven without
+a workspace. Responses can be slowed down and rate limited like the real
+thing, and chatter and commands can be injected into the fire hose at a
+steady rate from thousands of users.
+
+Every reply the bot posts is matched to the oldest command waiting in its
+channel, which gives the end to end latency of a command from the moment it
+went out on the websocket to the moment its reply arrived.
+
+Point the bot at it with MATTBOT_API_URL=http://127.0.0.1:8765/api/ or run
+it with the load test driver:
+
+    python -m benchmarks.fake_slack --port 8765
+    python -m benchmarks.load_test
+
+"""
+import argparse
+import asyncio
+import base64
+import collections
+import email.parser
+import email.policy
+import hashlib
+import itertools
+import json
+import logging
+import math
+import random
+import struct
+import time
+import typing
+import urllib.parse
+
+from metrics import HistogramValue
+from outbound import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+BOT_ID = 'UBOT'
+BOT_NAME = 'mattbot'
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+REASONS = {101: 'Switching Protocols', 200: 'OK', 401: 'Unauthorized', 404: 'Not Found',
+           429: 'Too Many Requests'}
+
+COMMANDS = ('hello', 'magic8 will it ship?', 'bizzfuzz 15', 'who is <@{user}>')
+CHATTER = ('the build is green again', 'lunch?', 'deploying now', 'who broke staging', 'ship it')
+
+
+def deploy_log(size: int) -> bytes:
+    """
+    Build a deploy log of about the given size with a migration section in
+    the middle, the way the deploy log command expects them.
+
+    """
+    filler = b'INFO collecting static files ... done\n'
+    padding = filler * max(size // len(filler) // 2, 1)
+    migrations = (b'#### RUNNING MIGRATIONS\n'
+                  b'  Applying bearprofile.0042_fitbit... OK\n'
+                  b'#### DONE\n')
+
+    return padding + migrations + padding
+
+
+class WebSocket:
+    """
+    The server end of one RTM websocket
+
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+
+    def send(self, event: dict):
+        """
+        Send an event as a text frame, servers do not mask their frames.
+
+        """
+        if self.closed:
+            return
+
+        payload = json.dumps(event).encode()
+        length = len(payload)
+        if length < 126:
+            header = struct.pack('!BB', 0x81, length)
+        elif length < 65536:
+            header = struct.pack('!BBH', 0x81, 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x81, 127, length)
+
+        self.writer.write(header + payload)
+
+    def send_control(self, opcode: int, payload: bytes = b''):
+        self.writer.write(struct.pack('!BB', 0x80 | opcode, len(payload)) + payload)
+
+    async def read_frame(self) -> typing.Tuple[int, bytes]:
+        """
+        Read one frame from the client, whose frames are always masked.
+
+        """
+        first, second = await self.reader.readexactly(2)
+        opcode = first & 0x0f
+        length = second & 0x7f
+        if length == 126:
+            length, = struct.unpack('!H', await self.reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', await self.reader.readexactly(8))
+
+        mask = await self.reader.readexactly(4) if second & 0x80 else b'\0\0\0\0'
+        payload = await self.reader.readexactly(length)
+
+        return opcode, bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+    async def serve(self, on_event: typing.Callable):
+        """
+        Answer the client until it goes away.
+
+        """
+        try:
+            while True:
+                opcode, payload = await self.read_frame()
+                if opcode == 0x8:
+                    self.send_control(0x8, payload[:2])
+                    return
+                if opcode == 0x9:
+                    self.send_control(0xa, payload)
+                elif opcode == 0x1:
+                    on_event(self, json.loads(payload))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        finally:
+            self.closed = True
+            self.writer.close()
+
+
+class FakeSlack:
+    """
+    The fake workspace and the server in front of it
+
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, users: int = 1000, channels: int = 50,
+                 latency: float = 0.0, jitter: float = 0.0, post_rate: float = None, api_rate: float = None,
+                 file_size: int = 64 * 1024, token: str = None, duplicates: float = 0.0, seed: int = 0) -> None:
+        """
+        Initialize the server
+
+        Args:
+            host:       The address to listen on
+            port:       The port to listen on, any free one when 0
+            users:      The number of users in the workspace
+            channels:   The number of channels in the workspace
+            latency:    Seconds every Web API call and download takes at least
+            jitter:     Up to this many more seconds at random
+            post_rate:  chat.postMessage calls allowed per second in each
+                        channel, unlimited when None
+            api_rate:   Calls to every other method allowed per second,
+                        unlimited when None
+            file_size:  The size of the deploy log served for file events
+            token:      The only token accepted, any token when None
+            duplicates: The share of events delivered twice, the way Slack
+                        can after a retry
+            seed:       Seeds the random choices
+
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.post_rate = post_rate
+        self.api_rate = api_rate
+        self.token = token
+        self.duplicates = duplicates
+        self.random = random.Random(seed)
+        self.file = deploy_log(file_size)
+
+        self.users = [{'id': BOT_ID, 'name': BOT_NAME}] + [{'id': f'U{number:08X}', 'name': f'user{number}'}
+                                                          for number in range(users)]
+        self.channels = [{'id': f'C{number:08X}', 'name': f'channel-{number}'} for number in range(channels)]
+        self.ims = [{'id': f'D{user["id"][1:]}', 'user': user['id']} for user in self.users[1:]]
+        self.joined = set()
+
+        self.server = None
+        self.down_until = 0.0  # RTM sessions are refused until then
+        self.sockets = set()
+        self.connections = {}  # task -> writer of every open connection
+        self.buckets = {}
+        self.ts = itertools.count(1)
+        self.counts = collections.Counter()
+        self.posts = collections.Counter()  # channel -> messages posted by the bot
+        self.waiting = collections.defaultdict(collections.deque)  # channel -> send times of commands
+        self.latencies = HistogramValue()
+
+        self.methods = {
+            'rtm.connect': self.rtm_connect,
+            'rtm.start': self.rtm_start,
+            'users.list': self.users_list,
+            'channels.list': self.channels_list,
+            'im.list': self.im_list,
+            'chat.postMessage': self.chat_post_message,
+            'files.upload': self.files_upload,
+            'channels.join': self.channels_join,
+            'channels.leave': self.channels_leave,
+        }
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}'
+
+    @property
+    def api_url(self) -> str:
+        return f'{self.base_url}/api/'
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.serve_connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info('Fake Slack listening on %s', self.base_url)
+
+    async def stop(self):
+        for websocket in list(self.sockets):
+            websocket.send_control(0x8, struct.pack('!H', 1001))
+            websocket.writer.close()
+
+        self.server.close()
+        # Closed connections read as finished, which ends their handlers
+        for writer in list(self.connections.values()):
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Serve HTTP requests on one kept alive connection, or hand it to the
+        websocket when it asks for an upgrade.
+
+        """
+        connection = asyncio.current_task()
+        self.connections[connection] = writer
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+
+                verb, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                if headers.get('upgrade', '').lower() == 'websocket':
+                    await self.serve_websocket(reader, writer, headers)
+                    return
+
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, response_headers, payload = await self.route(verb, target, headers, body)
+                self.respond(writer, status, response_headers, payload)
+                await writer.drain()
+
+                if headers.get('connection', '').lower() == 'close':
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        finally:
+            self.connections.pop(connection, None)
+            if not writer.is_closing():
+                writer.close()
+
+    def respond(self, writer: asyncio.StreamWriter, status: int, headers: dict, payload: bytes):
+        lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}', f'Content-Length: {len(payload)}']
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload)
+
+    async def route(self, verb: str, target: str, headers: dict, body: bytes) -> tuple:
+        """
+        Answer one HTTP request.
+
+        Returns:
+            The status, the headers and the body of the response
+
+        """
+        url = urllib.parse.urlsplit(target)
+        await self.delay()
+
+        if verb == 'GET' and url.path.startswith('/files/'):
+            self.counts['downloads'] += 1
+            if not self.authorized(headers.get('authorization', '').replace('Bearer ', '', 1)):
+                return 401, {}, b''
+            return 200, {'Content-Type': 'text/plain'}, self.file
+
+        if not url.path.startswith('/api/'):
+            return 404, {}, b''
+
+        method = url.path[len('/api/'):]
+        parameters = self.parse_parameters(url.query, headers.get('content-type', ''), body)
+        self.counts[method] += 1
+
+        retry_after = self.rate_limit(method, parameters)
+        if retry_after:
+            self.counts['ratelimited'] += 1
+            return 429, {'Retry-After': str(retry_after)}, b''
+
+        if not self.authorized(parameters.get('token')):
+            response = {'ok': False, 'error': 'invalid_auth'}
+        elif method not in self.methods:
+            response = {'ok': False, 'error': 'unknown_method'}
+        else:
+            response = self.methods[method](parameters)
+
+        return 200, {'Content-Type': 'application/json'}, json.dumps(response).encode()
+
+    def parse_parameters(self, query: str, content_type: str, body: bytes) -> dict:
+        parameters = {key: values[-1] for key, values in urllib.parse.parse_qs(query).items()}
+
+        if content_type.startswith('multipart/form-data'):
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f'Content-Type: {content_type}\r\n\r\n'.encode('latin-1') + body)
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                if name:
+                    parameters[name] = part.get_payload(decode=True).decode('utf-8', 'replace')
+        elif body:
+            parameters.update({key: values[-1]
+                               for key, values in urllib.parse.parse_qs(body.decode('utf-8')).items()})
+
+        return parameters
+
+    def authorized(self, token: str) -> bool:
+        return bool(token) and (self.token is None or token == self.token)
+
+    async def delay(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.random() * self.jitter)
+
+    def rate_limit(self, method: str, parameters: dict) -> int:
+        """
+        Take a token for a call.
+
+        Returns:
+            The seconds to wait when the call is rate limited, otherwise 0
+
+        """
+        if method == 'chat.postMessage':
+            rate, key = self.post_rate, (method, parameters.get('channel'))
+        else:
+            rate, key = self.api_rate, method
+
+        if rate is None:
+            return 0
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, max(rate, 1))
+
+        now = time.monotonic()
+        wait = bucket.wait_time(now=now)
+        if wait > 0:
+            return max(math.ceil(wait), 1)
+
+        bucket.take(now=now)
+        return 0
+
+    def page(self, items: list, parameters: dict, key: str) -> dict:
+        """
+        Page through a list the way the Web API does, with cursors.
+
+        """
+        start = int(parameters.get('cursor') or 0)
+        limit = int(parameters.get('limit') or 100)
+        end = start + limit
+        next_cursor = str(end) if end < len(items) else ''
+
+        return {'ok': True, key: items[start:end], 'response_metadata': {'next_cursor': next_cursor}}
+
+    def disconnect(self, outage: float = 0.0):
+        """
+        Close every RTM websocket and refuse new sessions for a while, the
+        way a network blip looks to the bot.
+
+        """
+        self.down_until = time.monotonic() + outage
+        for websocket in list(self.sockets):
+            websocket.send_control(0x8, struct.pack('!H', 1001))
+            websocket.closed = True
+            websocket.writer.close()
+        self.counts['disconnects'] += 1
+
+    async def disconnect_forever(self, interval: float, outage: float = 0.0, duration: float = None):
+        """
+        Disconnect every bot at a steady interval.
+
+        """
+        started = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            if duration is not None and time.monotonic() - started >= duration:
+                return
+            self.disconnect(outage)
+
+    def rtm_connect(self, parameters: dict) -> dict:
+        if time.monotonic() < self.down_until:
+            return {'ok': False, 'error': 'service_unavailable'}
+
+        return {
+            'ok': True,
+            'url': f'ws://{self.host}:{self.port}/rtm',
+            'self': {'id': BOT_ID, 'name': BOT_NAME},
+            'team': {'id': 'T00000000', 'name': 'Fake', 'domain': 'fake'},
+        }
+
+    def rtm_start(self, parameters: dict) -> dict:
+        return dict(self.rtm_connect(parameters), users=self.users, channels=self.channels, groups=[],
+                    ims=self.ims)
+
+    def users_list(self, parameters: dict) -> dict:
+        return self.page(self.users, parameters, 'members')
+
+    def channels_list(self, parameters: dict) -> dict:
+        return self.page(self.channels, parameters, 'channels')
+
+    def im_list(self, parameters: dict) -> dict:
+        return self.page(self.ims, parameters, 'ims')
+
+    def chat_post_message(self, parameters: dict) -> dict:
+        channel = parameters.get('channel')
+        text = parameters.get('text', '')
+        self.posts[channel] += 1
+
+        # Merged replies carry one line for every command they answer
+        now = time.perf_counter()
+        waiting = self.waiting.get(channel)
+        for _ in range(text.count('\n') + 1):
+            if not waiting:
+                # A command answered twice, or a reply nobody asked for
+                self.counts['extra_replies'] += 1
+                break
+            self.latencies.observe(now - waiting.popleft())
+
+        return {'ok': True, 'channel': channel, 'ts': f'{time.time():.6f}', 'message': {'text': text}}
+
+    def files_upload(self, parameters: dict) -> dict:
+        return {'ok': True, 'file': {'id': f'F{next(self.ts):08X}', 'name': parameters.get('filename')}}
+
+    def channels_join(self, parameters: dict) -> dict:
+        name = parameters.get('name') or parameters.get('channel', '')
+        channel = next((channel for channel in self.channels if name.lstrip('#') in (channel['name'], channel['id'])),
+                       None)
+        if channel is None:
+            return {'ok': False, 'error': 'channel_not_found'}
+
+        already_in_channel = channel['id'] in self.joined
+        self.joined.add(channel['id'])
+        return {'ok': True, 'channel': channel, 'already_in_channel': already_in_channel}
+
+    def channels_leave(self, parameters: dict) -> dict:
+        channel = parameters.get('channel')
+        if channel not in self.joined:
+            return {'ok': True, 'not_in_channel': True}
+
+        self.joined.discard(channel)
+        return {'ok': True}
+
+    async def serve_websocket(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, headers: dict):
+        self.counts['websockets'] += 1
+        accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + WEBSOCKET_GUID).encode()).digest())
+        self.respond(writer, 101, {'Upgrade': 'websocket', 'Connection': 'Upgrade',
+                                   'Sec-WebSocket-Accept': accept.decode()}, b'')
+
+        websocket = WebSocket(reader, writer)
+        self.sockets.add(websocket)
+        websocket.send({'type': 'hello'})
+        try:
+            await websocket.serve(self.on_client_event)
+        finally:
+            self.sockets.discard(websocket)
+
+    def on_client_event(self, websocket: WebSocket, event: dict):
+        if event.get('type') == 'ping':
+            websocket.send({'type': 'pong', 'reply_to': event.get('id')})
+
+    def broadcast(self, event: dict):
+        for websocket in list(self.sockets):
+            websocket.send(event)
+
+    def message(self, kind: str) -> dict:
+        """
+        Build a random message event of a kind, chatter, mention, im or file.
+
+        """
+        user = self.random.choice(self.users[1:])['id']
+        channel = self.random.choice(self.channels)['id']
+        event = {'type': 'message', 'user': user, 'channel': channel, 'ts': f'{time.time():.6f}'}
+
+        if kind == 'chatter':
+            event['text'] = self.random.choice(CHATTER)
+        elif kind == 'mention':
+            command = self.random.choice(COMMANDS).format(user=self.random.choice(self.users)['id'])
+            event['text'] = f'<@{BOT_ID}> {command}'
+        elif kind == 'im':
+            event['channel'] = f'D{user[1:]}'
+            event['text'] = self.random.choice(COMMANDS).format(user=user)
+        else:
+            event['subtype'] = 'file_share'
+            event['file'] = {'id': f'F{next(self.ts):08X}', 'name': 'deploy.log', 'filetype': 'text',
+                             'url_private_download': f'{self.base_url}/files/deploy.log'}
+
+        return event
+
+    def inject(self, event: dict):
+        """
+        Send an event to every connected bot, keeping track of the ones it
+        answers, commands and files, so their replies can be timed.
+
+        """
+        if not self.sockets:
+            # Nobody is connected to miss it
+            self.counts['events_missed'] += 1
+            return
+
+        answered = ('file' in event or event.get('text', '').startswith(f'<@{BOT_ID}>')
+                    or event.get('channel', '').startswith('D'))
+        if answered:
+            self.waiting[event['channel']].append(time.perf_counter())
+            self.counts['commands_injected'] += 1
+
+        self.counts['events_injected'] += 1
+        self.broadcast(event)
+        if self.duplicates and self.random.random() < self.duplicates:
+            self.counts['events_duplicated'] += 1
+            self.broadcast(event)
+
+    async def inject_forever(self, rate: float, mix: typing.Dict[str, float], duration: float = None):
+        """
+        Inject messages at a steady rate.
+
+        Args:
+            rate:     Events per second
+            mix:      The weights of chatter, mention, im and file events
+            duration: Seconds to inject for, forever when None
+
+        """
+        kinds = list(mix)
+        weights = [mix[kind] for kind in kinds]
+        started = time.monotonic()
+        sent = 0
+
+        while duration is None or time.monotonic() - started < duration:
+            # Catch up in bursts rather than sleeping once per event
+            due = int((time.monotonic() - started) * rate) - sent
+            for kind in self.random.choices(kinds, weights, k=max(due, 0)):
+                self.inject(self.message(kind))
+            sent += max(due, 0)
+
+            for websocket in list(self.sockets):
+                try:
+                    await websocket.writer.drain()
+                except ConnectionError:
+                    # Dropped, the bot reconnects on a new socket
+                    self.sockets.discard(websocket)
+            await asyncio.sleep(min(1 / rate, 0.01))
+
+    def report(self) -> str:
+        waiting = sum(len(times) for times in self.waiting.values())
+        return (f'{self.counts["events_injected"]} events injected, {self.counts["commands_injected"]} commands, '
+                f'{self.latencies.count} replies, {waiting} unanswered, {self.counts["extra_replies"]} extra, '
+                f'{self.counts["ratelimited"]} rate limited, {self.counts["disconnects"]} disconnects '
+                f'missing {self.counts["events_missed"]} events\n'
+                f'end to end p50 {self.latencies.percentile(50) * 1000:.1f} ms, '
+                f'p99 {self.latencies.percentile(99) * 1000:.1f} ms, max {self.latencies.max * 1000:.1f} ms')
+
+
+def parse_mix(mix: str) -> dict:
+    """
+    Parse an event mix like chatter=70,mention=20 into weights.
+
+    """
+    return {kind.strip(): float(weight) for kind, _, weight in (part.partition('=') for part in mix.split(','))}
+
+
+def add_server_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many more seconds at random')
+    parser.add_argument('--post-rate', type=float, default=None, help='Posts per second allowed per channel')
+    parser.add_argument('--api-rate', type=float, default=None, help='Calls per second allowed per method')
+    parser.add_argument('--file-size', type=int, default=64 * 1024, help='Bytes in the served deploy log')
+    parser.add_argument('--duplicates', type=float, default=0.0, help='Share of events delivered twice')
+    parser.add_argument('--rate', type=float, default=100, help='Events injected per second')
+    parser.add_argument('--mix', default='chatter=70,mention=20,im=7,file=3')
+
+
+def server_from_arguments(args) -> FakeSlack:
+    return FakeSlack(host=args.host, port=args.port, users=args.users, channels=args.channels,
+                     latency=args.latency, jitter=args.jitter, post_rate=args.post_rate, api_rate=args.api_rate,
+                     file_size=args.file_size, duplicates=args.duplicates)
+
+
+async def serve(args):
+    slack = server_from_arguments(args)
+    await slack.start()
+    print(f'Fake Slack on {slack.api_url}, injecting {args.rate} events per second once the bot connects')
+    try:
+        while not slack.sockets:
+            await asyncio.sleep(0.1)
+        await slack.inject_forever(args.rate, parse_mix(args.mix))
+    finally:
+        print(slack.report())
+        await slack.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.fake_slack', description=__doc__.split('\n\n')[0])
+    add_server_arguments(parser)
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
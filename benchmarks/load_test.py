@@ -0,0 +1,130 @@
+"""
+End to end load test against the fake Slack server
+
+Starts a fake Slack server, connects a real bot to it over HTTP and the RTM
+websocket, injects events from thousands of users for a while and then
+reports the end to end latency of every command, from the moment it went out
+on the websocket to the moment the bot's reply was posted, next to the bot's
+own metrics. Run it from the repository root:
+
+    python -m benchmarks.load_test --users 5000 --rate 500 --duration 30 --workers 8
+    python -m benchmarks.load_test --shards 4 --workers 2
+    python -m benchmarks.load_test --disconnect-every 5 --outage 2
+
+"""
+import argparse
+import asyncio
+import logging
+import sys
+import threading
+import time
+
+from benchmarks.fake_slack import BOT_NAME, add_server_arguments, parse_mix, server_from_arguments
+from bot import MattBot
+from throttle import parse_limits
+from transport import Transport
+
+SETTLE_TIME = 5  # Seconds to wait for the last replies once injection stops
+
+
+class ServerThread:
+    """
+    Runs the fake server on its own event loop in a background thread
+
+    """
+    def __init__(self, slack) -> None:
+        self.slack = slack
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='fake-slack', daemon=True)
+
+    def run(self, coroutine, timeout: float = None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def start(self):
+        self.thread.start()
+        self.run(self.slack.start())
+
+    def stop(self):
+        self.run(self.slack.stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def wait_for_replies(slack, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and any(slack.waiting.values()):
+        time.sleep(0.1)
+
+
+async def inject(slack, args):
+    injecting = slack.inject_forever(args.rate, parse_mix(args.mix), args.duration)
+    if not args.disconnect_every:
+        await injecting
+        return
+
+    await asyncio.gather(injecting, slack.disconnect_forever(args.disconnect_every, args.outage, args.duration))
+
+
+def run(args):
+    slack = server_from_arguments(args)
+    server = ServerThread(slack)
+    server.start()
+    throttle = parse_limits(args.throttle) if args.throttle else None
+
+    if args.shards:
+        from sharding import ShardedBot
+        bot = ShardedBot(token='load-test', name=BOT_NAME, shards=args.shards, shard_workers=args.workers,
+                         transport=Transport(base_url=slack.api_url), throttle=throttle)
+    else:
+        bot = MattBot(token='load-test', name=BOT_NAME, workers=args.workers,
+                      transport=Transport(base_url=slack.api_url), throttle=throttle)
+
+    if args.use_async:
+        from engine import AsyncEngine
+        target = AsyncEngine(bot, loop=asyncio.new_event_loop()).run
+    else:
+        target = bot.listen
+    listener = threading.Thread(target=target, name='mattbot', daemon=True)
+
+    listener.start()
+    while not slack.sockets:
+        time.sleep(0.05)
+
+    print(f'Injecting {args.rate} events per second from {args.users} users for {args.duration} seconds',
+          file=sys.stderr)
+    started = time.monotonic()
+    server.run(inject(slack, args))
+    injected = time.monotonic() - started
+
+    wait_for_replies(slack, SETTLE_TIME)
+    bot.living = False
+    listener.join(SETTLE_TIME * 2)
+
+    bot.transport.close()
+    server.stop()
+
+    print(f'{slack.counts["events_injected"] / injected:,.0f} events per second over {injected:.1f} s')
+    print(slack.report())
+    print('\nThe bot says:')
+    print(bot.metrics.summary())
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.load_test', description=__doc__.split('\n\n')[0])
+    add_server_arguments(parser)
+    parser.set_defaults(port=0, users=5000, rate=200)
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to inject events for')
+    parser.add_argument('--workers', type=int, default=None, help='Run commands on a dispatcher')
+    parser.add_argument('--shards', type=int, default=None, help='Run commands in this many shard processes')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='Run the bot on the asyncio engine')
+    parser.add_argument('--throttle', default=None, help='Throttle limits like user=0.5/5, see the throttle module')
+    parser.add_argument('--disconnect-every', type=float, default=None, help='Drop the bot every this many seconds')
+    parser.add_argument('--outage', type=float, default=0.0, help='Seconds Slack refuses to reconnect after a drop')
+
+    # Unknown commands log a warning each, only show what went wrong
+    logging.basicConfig(level=logging.ERROR)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""
+Replay recorded RTM events through the bot
+
+Feeds a JSONL file of RTM events, one event per line, into the bot through
+a stand in SlackClient that also answers every Web API call. Each line is
+handed over as the raw frame it would arrive as, so the ingest pre-filter
+and the decoding are measured too. The replay reports the throughput, the
+p50 and p99 latency of handling each batch and the memory allocated along
+the way. Nothing talks to Slack, so the numbers only cover parsing, routing
+and the commands themselves.
+
+A synthetic recording with a mix of chatter, mentions, IMs, file events,
+typing indicators, presence changes and reactions can be generated to catch
+regressions before they ship. Run it from the repository root:
+
+    python -m benchmarks.replay generate events.jsonl --events 100000
+    python -m benchmarks.replay run events.jsonl
+
+"""
+import argparse
+import collections
+import contextlib
+import gc
+import json
+import logging
+import random
+import time
+import tracemalloc
+import typing
+
+from benchmarks.fake_slack import deploy_log
+from bot import MattBot
+from metrics import HistogramValue
+from transport import SLACK_API_URL, Download, Transport
+
+BOT_ID = 'UBOT'
+DEFAULT_EVENTS = 100_000
+DEFAULT_MIX = 'chatter=70,mention=20,im=7,file=3'
+LOG_SIZE = 64 * 1024  # Bytes in the deploy log every shared file downloads as
+KINDS = ('chatter', 'mention', 'im', 'file', 'typing', 'presence', 'reaction')
+
+MENTIONS = (
+    'hello',
+    'magic8 will the deploy work?',
+    'bizzfuzz {number}',
+    'who is <@{user}>',
+    'helo',  # Typos cost a suggestion lookup
+    'stats',
+)
+
+
+class ReplayClient:
+    """
+    Stands in for the SlackClient and the HTTP transport, handing out the
+    recorded frames, answering every Web API call and serving every shared
+    file as the same deploy log
+
+    """
+    server = None
+    base_url = SLACK_API_URL
+    # The real check, so a file the bot would refuse to download is refused here too
+    is_file_url = Transport.is_file_url
+
+    def __init__(self, frames: list, batch_size: int = 1, log: bytes = None) -> None:
+        self.batches = [frames[start:start + batch_size] for start in range(0, len(frames), batch_size)]
+        self.position = 0
+        self.calls = collections.Counter()
+        self.log = deploy_log(LOG_SIZE) if log is None else log
+
+    @property
+    def done(self) -> bool:
+        return self.position >= len(self.batches)
+
+    def rtm_read(self) -> list:
+        if self.done:
+            return []
+
+        batch = self.batches[self.position]
+        self.position += 1
+        return batch
+
+    def api_call(self, method: str, token: str = None, **parameters) -> dict:
+        self.calls[method] += 1
+        return {'ok': True}
+
+    @contextlib.contextmanager
+    def download(self, url: str, token: str = None) -> typing.Iterator[Download]:
+        if not self.is_file_url(url):
+            raise ValueError(f'Refusing to send the token to {url}, it is not a Slack file')
+
+        self.calls['download'] += 1
+        log = self.log
+        yield Download(200, lambda chunk_size: (log[start:start + chunk_size]
+                                                for start in range(0, len(log), chunk_size)))
+
+    def metrics(self) -> dict:
+        return dict(self.calls)
+
+
+def parse_mix(mix: str) -> dict:
+    """
+    Parse an event mix like chatter=70,mention=20 into weights.
+
+    """
+    weights = {}
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        weights[kind.strip()] = float(weight)
+
+    unknown = set(weights) - set(KINDS)
+    if unknown:
+        raise ValueError(f'Unknown event kinds in the mix: {", ".join(sorted(unknown))}')
+
+    return weights
+
+
+def synthetic_events(count: int, mix: str = DEFAULT_MIX, users: int = 200, channels: int = 20,
+                     seed: int = 0) -> typing.Iterator[dict]:
+    """
+    Yield RTM events shaped like a busy workspace.
+
+    The workspace is introduced first with team_join, channel_created and
+    im_created events, so the directory is filled the way the fire hose
+    would keep it current.
+
+    Args:
+        count:    The number of events after the introduction
+        mix:      The weights of each kind of event, see DEFAULT_MIX
+        users:    The number of users talking
+        channels: The number of channels they talk in
+        seed:     Seeds the random choices so a recording can be made again
+
+    """
+    rng = random.Random(seed)
+    weights = parse_mix(mix)
+    kinds = list(weights)
+
+    user_ids = [f'U{number:08X}' for number in range(users)]
+    channel_ids = [f'C{number:08X}' for number in range(channels)]
+    im_ids = {user_id: f'D{user_id[1:]}' for user_id in user_ids}
+
+    yield {'type': 'team_join', 'user': {'id': BOT_ID, 'name': 'mattbot'}}
+    for number, user_id in enumerate(user_ids):
+        yield {'type': 'team_join', 'user': {'id': user_id, 'name': f'user{number}'}}
+    for number, channel_id in enumerate(channel_ids):
+        yield {'type': 'channel_created', 'channel': {'id': channel_id, 'name': f'channel-{number}'}}
+    for user_id, im_id in im_ids.items():
+        yield {'type': 'im_created', 'user': user_id, 'channel': {'id': im_id}}
+
+    ts = 1500000000.0
+    for _ in range(count):
+        ts += rng.random()
+        kind = rng.choices(kinds, [weights[kind] for kind in kinds])[0]
+        user = rng.choice(user_ids)
+        event = {'type': 'message', 'user': user, 'channel': rng.choice(channel_ids), 'ts': f'{ts:.6f}'}
+
+        if kind == 'chatter':
+            event['text'] = ' '.join(rng.choice(('deploy', 'lunch', 'the', 'build', 'is', 'green', 'again'))
+                                     for _ in range(rng.randint(3, 12)))
+        elif kind == 'mention':
+            command = rng.choice(MENTIONS).format(number=rng.randint(1, 100), user=rng.choice(user_ids))
+            event['text'] = f'<@{BOT_ID}> {command}'
+        elif kind == 'im':
+            event['channel'] = im_ids[user]
+            event['text'] = rng.choice(('hello', 'magic8 is it friday?', 'stats'))
+        elif kind == 'typing':
+            event = {'type': 'user_typing', 'user': user, 'channel': event['channel']}
+        elif kind == 'presence':
+            event = {'type': 'presence_change', 'user': user, 'presence': rng.choice(('active', 'away'))}
+        elif kind == 'reaction':
+            event = {'type': 'reaction_added', 'user': user, 'reaction': 'thumbsup', 'event_ts': event['ts'],
+                     'item': {'type': 'message', 'channel': event['channel'], 'ts': f'{ts - 1:.6f}'}}
+        else:
+            event['subtype'] = 'file_share'
+            event['file'] = {'id': f'F{rng.getrandbits(32):08X}', 'name': 'deploy.log', 'filetype': 'text',
+                             'url_private_download': 'https://files.slack.com/files-pri/deploy.log'}
+
+        yield event
+
+
+def read_frames(path: str) -> list:
+    """
+    Read a JSONL recording as raw frames, skipping blank lines.
+
+    """
+    with open(path, 'rb') as recording:
+        return [line.strip() for line in recording if line.strip()]
+
+
+def make_bot(client: ReplayClient, bot_id: str, workers: int = None) -> MattBot:
+    bot = MattBot(token='replay', workers=workers, queue_messages=False, transport=client, connect=False)
+    bot.slack_client = client
+    bot.slack_user_id = bot_id
+    bot.prefilter.set_user_id(bot_id)
+
+    return bot
+
+
+def replay(client: ReplayClient, bot_id: str = BOT_ID, workers: int = None) -> tuple:
+    """
+    Feed the recorded events through a new bot the way its read loop would.
+
+    Returns:
+        The bot, the elapsed seconds and a histogram of batch latencies
+
+    """
+    bot = make_bot(client, bot_id, workers)
+    latencies = HistogramValue()
+
+    if bot.dispatcher is not None:
+        bot.dispatcher.start()
+
+    started = time.perf_counter()
+    while not client.done:
+        batch_started = time.perf_counter()
+        bot.parse_slack_output(bot.ingest(client.rtm_read()), None)
+        latencies.observe(time.perf_counter() - batch_started)
+
+    if bot.dispatcher is not None:
+        bot.dispatcher.stop()
+    elapsed = time.perf_counter() - started
+
+    return bot, elapsed, latencies
+
+
+def measure_allocations(frames: list, bot_id: str, batch_size: int) -> tuple:
+    """
+    Replay the events again while tracing memory.
+
+    Returns:
+        The peak and retained bytes, and the lines that allocated the most
+        memory that is still held
+
+    """
+    # Batch the recording up front so the harness is left out of the numbers
+    client = ReplayClient(frames, batch_size)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    bot, _, _ = replay(client, bot_id)
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    top = tracemalloc.take_snapshot().compare_to(before, 'lineno')[:5]
+    tracemalloc.stop()
+    del bot
+
+    return peak, retained, top
+
+
+def run(args):
+    frames = read_frames(args.recording)
+    bot, elapsed, latencies = replay(ReplayClient(frames, args.batch), args.bot_id, args.workers)
+
+    seen = len(frames)
+    print(f'{seen} events in {elapsed:.2f} s, {seen / elapsed:,.0f} events/s, '
+          f'{bot.event_counts["filtered"]} filtered before decoding, {bot.event_counts["dispatched"]} commands')
+    print(f'batch of {args.batch}: p50 {latencies.percentile(50) * 1e6:.1f} us, '
+          f'p99 {latencies.percentile(99) * 1e6:.1f} us, max {latencies.max * 1e6:.1f} us')
+
+    errors = collections.Counter()
+    for labels, counter in bot.metrics.commands.items():
+        if labels['outcome'] == 'error':
+            errors[labels['command']] += counter.value
+
+    print(f'\n{"command":<20} {"runs":>8} {"errors":>8} {"p50 us":>10} {"p99 us":>10}')
+    for labels, histogram in sorted(bot.metrics.command_latency.items(), key=lambda item: -item[1].count):
+        print(f'{labels["command"]:<20} {histogram.count:>8} {errors[labels["command"]]:>8} '
+              f'{histogram.percentile(50) * 1e6:>10.1f} {histogram.percentile(99) * 1e6:>10.1f}')
+
+    if args.no_allocations:
+        return
+
+    peak, retained, top = measure_allocations(frames, args.bot_id, args.batch)
+    print(f'\nallocations: peak {peak / 2 ** 20:.1f} MB, retained {retained / 2 ** 20:.1f} MB, '
+          f'{retained / max(seen, 1):.0f} bytes/event retained')
+    for statistic in top:
+        print(f'  {statistic}')
+
+
+def generate(args):
+    with open(args.recording, 'w', encoding='utf-8') as recording:
+        for event in synthetic_events(args.events, args.mix, args.users, args.channels, args.seed):
+            recording.write(json.dumps(event))
+            recording.write('\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.replay', description=__doc__.split('\n\n')[0])
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    run_parser = subparsers.add_parser('run', help='Replay a recording and report')
+    run_parser.add_argument('recording', help='A JSONL file of RTM events')
+    run_parser.add_argument('--bot-id', default=BOT_ID, help='The user id of the bot in the recording')
+    run_parser.add_argument('--batch', type=int, default=1, help='Events handed to the bot per read')
+    run_parser.add_argument('--workers', type=int, default=None, help='Run commands on a dispatcher')
+    run_parser.add_argument('--no-allocations', action='store_true', help='Skip the traced replay')
+    run_parser.set_defaults(handler=run)
+
+    generate_parser = subparsers.add_parser('generate', help='Write a synthetic recording')
+    generate_parser.add_argument('recording', help='The JSONL file to write')
+    generate_parser.add_argument('--events', type=int, default=DEFAULT_EVENTS)
+    generate_parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Weights of {", ".join(KINDS)}')
+    generate_parser.add_argument('--users', type=int, default=200)
+    generate_parser.add_argument('--channels', type=int, default=20)
+    generate_parser.add_argument('--seed', type=int, default=0)
+    generate_parser.set_defaults(handler=generate)
+
+    args = parser.parse_args()
+    # Unknown commands log a warning each, only show what went wrong
+    logging.basicConfig(level=logging.ERROR)
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,20 +2,79 @@
 Implementation of the mattbot
 
 """
-import inspect
 import logging
 import os
+import random
+import select
+import ssl
 import sys
 import time
 import typing
 
+from collections import Counter, namedtuple
 from slackclient import SlackClient
+from websocket import ABNF, WebSocketException
 
 import commands
+import logconfig
+from dedup import DEDUP_SIZE, RingIndex, event_key
+from directory import Directory, NameIndex
+from dispatcher import BLOCK, DEFAULT_QUEUE_SIZE, Dispatcher
+from ingest import Prefilter, loads
+from metrics import BotMetrics, MetricsServer
+from outbound import OutboundQueue
+from registry import CommandRegistry, command_name
+from settings import DEFAULT_PATH, WORKSPACE, SettingsStore
+from subscriptions import IGNORE, IGNORED_SETTING, LISTEN, LISTENED_SETTING, Subscriptions
+from throttle import BUSY, CHANNEL, Throttle, ThrottleLimits, parse_limits
+from transport import SLACK_API_URL, Transport
 
 logger = logging.getLogger(__name__)
 
-READ_WEBSOCKET_DELAY = 1  # 1 second delay between reading from fire hose
+READ_WEBSOCKET_DELAY = 1  # 1 second delay between reading from fire hose when polling
+RECONNECT_BACKOFF = 1  # Seconds before the first reconnect attempt at most, doubled after every failure
+MAX_RECONNECT_BACKOFF = 60  # The longest wait between reconnect attempts
+PING_INTERVAL = 30  # Ping a websocket that has been quiet this many seconds
+PONG_TIMEOUT = 10  # Seconds a ping has to be answered before the websocket counts as dropped
+
+# Event types other than message the bot acts on, besides the ones that change the directory
+HANDLED_EVENT_TYPES = ('goodbye',)
+
+# rtm.connect errors that trying again will not fix
+FATAL_CONNECT_ERRORS = ('invalid_auth', 'not_authed', 'account_inactive', 'token_revoked', 'token_expired')
+
+
+def backoff_delay(attempt: int, base: float = RECONNECT_BACKOFF, cap: float = MAX_RECONNECT_BACKOFF) -> float:
+    """
+    Get how long to wait before a reconnect attempt.
+
+    The wait is anywhere up to the exponential backoff, so bots that dropped
+    together do not all come back at the same moment.
+
+    Args:
+        attempt: The number of attempts that failed so far
+
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class BatchStats(namedtuple('BatchStats', ['seen', 'dispatched', 'skipped'])):
+    """
+    The number of events seen, dispatched as commands and skipped in one
+    batch read from the fire hose.
+
+    """
+
+
+class SharedFile(namedtuple('SharedFile', ['file'])):
+    """
+    A file shared with the bot, dispatched in place of the command text and
+    handed to the file handler as it came in the event. No text turns into
+    one, so nobody can make the bot download a file by typing a command.
+
+    """
+    def __str__(self):
+        return f'file {self.file.get("name", "")}'
 
 
 class MattBot:
@@ -24,58 +83,330 @@ class MattBot:
 
     """
     name = 'mattbot'
-    available_commands = None
+    registry = None
 
     slack_client = None
     slack_user_id = None
+    team_id = None
     slack_users = None
     slack_channels = None
     slack_ims = None
+    directory = None
+    recent_events = None
+    prefilter = None
+    subscriptions = None
+    throttle = None
+    settings = None
     voice_engine = None
     living = True
-
-    def __init__(self, token: str, name: str = None):
+    dropped = False
+    last_frame_at = 0.0
+    pinged_at = 0.0
+    event_counts = None
+    dispatcher = None
+    outbound = None
+    transport = None
+    metrics = None
+    metrics_server = None
+    profiler = None
+
+    def __init__(self, token: str, name: str = None, workers: int = None,
+                 queue_size: int = DEFAULT_QUEUE_SIZE, queue_policy: str = BLOCK,
+                 registry: CommandRegistry = None, queue_messages: bool = True, transport: Transport = None,
+                 connect: bool = True, metrics: BotMetrics = None, metrics_port: int = None,
+                 dedup_size: int = DEDUP_SIZE, throttle: ThrottleLimits = None, settings: SettingsStore = None):
         """
         Initialize the bot
 
+        Args:
+            token:          The Slack API token
+            name:           The user name of the bot
+            workers:        Run commands on this many worker threads instead
+                            of on the listener, see the dispatcher module
+            queue_size:     The most commands waiting for a worker
+            queue_policy:   What to do with a command when the queue is full
+            registry:       The commands the bot knows, every command in the
+                            commands package by default
+            queue_messages: Post messages from a rate limited background
+                            queue instead of from the command, see the
+                            outbound module
+            transport:      The HTTP connection pool for Web API calls and
+                            downloads, a new one by default
+            connect:        Connect to Slack right away, turn it off to drive
+                            the bot without a workspace
+            metrics:        Where the bot keeps its counters and latency
+                            histograms, a new set by default
+            metrics_port:   Serve the metrics in the Prometheus text format
+                            on this local port while listening
+            dedup_size:     The number of recent commands remembered to
+                            suppress ones Slack delivers twice
+            throttle:       Limit how fast each user and channel may run
+                            commands, see the throttle module, no limits
+                            when None
+            settings:       Where commands keep their settings, see the
+                            settings module, only in memory by default
 
         """
         if name is not None:
             self.name = name
 
+        if registry is None:
+            registry = CommandRegistry.from_manifest(commands.load_manifest(), commands.load)
+        self.registry = registry
+
+        if transport is None:
+            transport = Transport()
+        self.transport = transport
+
+        if metrics is None:
+            metrics = BotMetrics()
+        self.metrics = metrics
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer([self.metrics], port=metrics_port)
+
+        if queue_messages:
+            self.outbound = OutboundQueue(self.api_call)
+
+        if workers:
+            self.dispatcher = Dispatcher(self.handle_command, workers=workers, queue_size=queue_size,
+                                         policy=queue_policy, on_busy=self.reply_busy)
+
         self.slack_token = token
-        self.connect()
+        self.event_counts = Counter()
+        self.directory = Directory()
+        self.slack_users = self.directory.users
+        self.slack_channels = self.directory.channels
+        self.slack_ims = self.directory.ims
+        self.recent_events = RingIndex(dedup_size)
+        self.subscriptions = Subscriptions(self.slack_channels)
+        self.prefilter = Prefilter(HANDLED_EVENT_TYPES + tuple(self.directory.event_types), self.slack_ims,
+                                   self.subscriptions)
+        if throttle is not None:
+            self.throttle = Throttle(throttle)
+        self.settings = settings if settings is not None else SettingsStore()
+        self.add_gauges()
+
+        if connect and not self.connect():
+            sys.exit()
 
-    def connect(self):
+    def connect(self) -> bool:
         """
+        Connect to Slack and load the directory, trying again with backoff
+        while Slack cannot be reached.
+
+        Returns:
+            Whether the bot connected, False when the token is refused
 
         """
-        print(f'Attempting to connect with token: {self.slack_token}')
+        logger.info('Connecting to Slack')
         self.slack_client = SlackClient(self.slack_token)
 
-        if not self.slack_client.rtm_connect():
-            print("Connection failed, invalid Slack token.")
-            sys.exit()
-
-        print('MattBot connected and running!')
+        if not self.connect_with_backoff():
+            logger.error('Connection failed, invalid Slack token.')
+            return False
 
         self.slack_users = self.get_users()
-        print('\n'.join([k + ':' + v for k, v in self.slack_users.items()]))
         self.slack_user_id = self.get_user_id(self.slack_users, self.name)
-        print(f'Bot id: {self.slack_user_id}')
-
+        self.prefilter.set_user_id(self.slack_user_id)
         self.slack_channels = self.get_channels()
-        print('\nChannels')
-        print('\n'.join([k + ':' + v for k, v in self.slack_channels.items()]))
-
         self.slack_ims = self.get_ims()
-        print('\nIMs')
-        print('\n'.join([k + ':' + v for k, v in self.slack_ims.items()]))
+        self.load_subscriptions()
+
+        logger.info('Connected as %s with %s users, %s channels and %s IMs', self.slack_user_id,
+                    len(self.slack_users), len(self.slack_channels), len(self.slack_ims))
+        # The whole directory is only worth writing out when debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Directory', extra={'users': dict(self.slack_users), 'channels': dict(self.slack_channels),
+                                             'ims': dict(self.slack_ims)})
 
         voice_engine = None
         # voice_engine = pyttsx.init()
         # voices = voice_engine.getProperty('voices')
 
+        return True
+
+    def add_gauges(self):
+        """
+        Fold the numbers the queues and the transport keep into the metrics.
+
+        """
+        self.metrics.gauge('mattbot_transport', 'HTTP transport counts and pool reuse',
+                           self.transport.metrics, label_name='stat')
+
+        if self.outbound is not None:
+            self.metrics.gauge('mattbot_outbound_depth', 'Messages waiting to be posted', self.outbound.depth)
+            self.metrics.gauge('mattbot_outbound_messages', 'Outbound messages by outcome',
+                               lambda: dict(self.outbound.counts), label_name='outcome')
+
+        if self.dispatcher is not None:
+            self.metrics.gauge('mattbot_dispatcher', 'Command queue depth, counts and wait times',
+                               self.dispatcher.metrics, label_name='stat')
+
+        self.metrics.gauge('mattbot_settings', 'Settings cached, waiting to be saved and saved',
+                           self.settings.metrics, label_name='stat')
+
+        if self.throttle is not None:
+            self.metrics.gauge('mattbot_throttle_buckets', 'Users and channels with a throttle bucket',
+                               self.throttle.metrics, label_name='stat')
+
+    def stats(self) -> str:
+        """
+        Summarize the metrics and the queues for the stats command.
+
+        """
+        lines = [self.metrics.summary()]
+        lines.extend(self.queue_stats())
+
+        if self.outbound is not None:
+            counts = self.outbound.counts
+            lines.append(f'Outbound queue {self.outbound.depth()} deep, {counts["sent"]} sent, '
+                         f'{counts["coalesced"]} merged, {counts["ratelimited"]} rate limited')
+
+        transport = self.transport.metrics()
+        if 'pool_hits' in transport:
+            lines.append(f'HTTP connections reused {transport["pool_hits"]} times, '
+                         f'opened {transport["pool_misses"]} times')
+
+        return '\n'.join(lines)
+
+    def queue_stats(self) -> typing.List[str]:
+        """
+        Describe the command queue for the stats summary.
+
+        Returns:
+            A line about the dispatcher queue, or none when commands run on
+            the reader thread
+
+        """
+        if self.dispatcher is None:
+            return []
+
+        queue = self.dispatcher.metrics()
+        return [f'Command queue {queue["queue_depth"]} deep (peak {queue["queue_peak_depth"]}), '
+                f'{queue["dropped"]} dropped, {queue["rejected"]} turned away, '
+                f'average wait {queue["wait_seconds_avg"] * 1000:.1f}ms']
+
+    def rtm_connect(self) -> dict:
+        """
+        Open the RTM websocket.
+
+        The websocket URL is asked for through the transport rather than by
+        SlackClient.rtm_connect, which always calls slack.com, so a bot
+        pointed at a local stand in server connects to it too.
+
+        Returns:
+            The rtm.connect response, ok is False when the websocket is not open
+        """
+        response = self.api_call('rtm.connect')
+        if not response.get('ok', False):
+            logger.error('Could not start an RTM session: %s', response.get('error', 'an error'))
+            return response
+
+        self.team_id = response.get('team', {}).get('id')
+
+        try:
+            self.slack_client.server.connect_slack_websocket(response['url'])
+        except Exception:
+            logger.exception('Could not open the RTM websocket at %s', response['url'])
+            return {'ok': False, 'error': 'websocket_failed'}
+
+        self.dropped = False
+        self.last_frame_at = self.pinged_at = time.monotonic()
+        return response
+
+    def connect_with_backoff(self) -> bool:
+        """
+        Open the RTM websocket, waiting longer after every failed attempt.
+
+        Returns:
+            Whether it is open, False when the token is refused or the bot died
+
+        """
+        attempt = 0
+        while self.living:
+            response = self.rtm_connect()
+            if response.get('ok', False):
+                self.metrics.connects.labels('ok').inc()
+                return True
+
+            if response.get('error') in FATAL_CONNECT_ERRORS:
+                self.metrics.connects.labels('refused').inc()
+                return False
+
+            self.metrics.connects.labels('failed').inc()
+            delay = max(backoff_delay(attempt), float(response.get('retry_after') or 0))
+            logger.warning('Could not connect to Slack, trying again in %.1f seconds', delay)
+            self.sleep_while_living(delay)
+            attempt += 1
+
+        return False
+
+    def reconnect(self) -> bool:
+        """
+        Reconnect after the RTM websocket dropped.
+
+        The directory is kept rather than loaded again, and the outbound
+        queue holds its messages until the bot is back.
+
+        Returns:
+            Whether the bot reconnected, it dies when the token is refused
+
+        """
+        dropped_at = time.monotonic()
+        logger.warning('Lost the RTM connection, reconnecting')
+        if self.outbound is not None:
+            self.outbound.pause()
+        self.close_websocket()
+
+        connected = self.connect_with_backoff()
+        if connected:
+            downtime = time.monotonic() - dropped_at
+            self.metrics.reconnects.inc()
+            self.metrics.downtime.observe(downtime)
+            logger.info('Reconnected after %.1f seconds', downtime)
+        elif self.living:
+            logger.error('Slack refused the token while reconnecting')
+            self.die()
+
+        if self.outbound is not None:
+            self.outbound.resume()
+
+        return connected
+
+    def sleep_while_living(self, seconds: float):
+        """
+        Sleep, waking early when the bot dies.
+
+        """
+        deadline = time.monotonic() + seconds
+        while self.living:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, READ_WEBSOCKET_DELAY))
+
+    def rtm_websocket(self):
+        """
+        Get the RTM websocket, None when there is none to read.
+
+        """
+        server = getattr(self.slack_client, 'server', None)
+        return getattr(server, 'websocket', None)
+
+    def close_websocket(self):
+        """
+        Close the RTM websocket, ignoring a websocket that is already dead.
+
+        """
+        websocket = self.rtm_websocket()
+        if websocket is None:
+            return
+
+        try:
+            websocket.shutdown()
+        except (WebSocketException, OSError):
+            pass
+
     @property
     def at_name(self):
         """
@@ -90,77 +421,412 @@ class MattBot:
 
         """
         self.living = False
-        print('I have died.')
+        logger.info('I have died.')
+
+    def listen(self, event_driven: bool = True):
+        """
+        Read events from the fire hose until the bot dies.
+
+        Args:
+            event_driven: Block on the websocket and wake as soon as a frame
+                          arrives instead of sleeping between every read.
 
-    def listen(self):
         """
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.outbound is not None:
+            self.outbound.start()
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+        self.settings.start()
+
+        try:
+            self.read_fire_hose(event_driven)
+        finally:
+            if self.dispatcher is not None:
+                self.dispatcher.stop()
+            # Anything the last commands said still gets posted, and every setting saved
+            if self.outbound is not None:
+                self.outbound.stop()
+            self.settings.stop()
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+
+    def read_fire_hose(self, event_driven: bool):
+        """
+        Read and parse batches of events until the bot dies.
 
-        :return:
         """
         while self.living:
-            self.parse_slack_output(self.slack_client.rtm_read(), self.voice_engine)
-            time.sleep(READ_WEBSOCKET_DELAY)
+            with self.metrics.rtm_read.time():
+                slack_rtm_output = self.rtm_read()
+            self.parse_slack_output(slack_rtm_output, self.voice_engine)
+
+            if self.dropped:
+                self.reconnect()
+                continue
+
+            if not event_driven:
+                time.sleep(READ_WEBSOCKET_DELAY)
+                continue
+
+            # Keep draining while frames are coming in, only block once the socket is empty
+            if not slack_rtm_output and not self.wait_for_events(timeout=READ_WEBSOCKET_DELAY):
+                self.keep_alive()
+
+    def rtm_read(self) -> list:
+        """
+        Read every event waiting on the RTM websocket.
+
+        Frames are read straight off the websocket. SlackClient.rtm_read
+        only expects a dry TLS socket, so on a plain ws:// socket it raises
+        BlockingIOError and loses the frames it already read.
+
+        A websocket that closes or fails marks the bot as dropped, the events
+        read before that are still returned. Only the frames that pass the
+        pre-filter are decoded, see the ingest module.
+
+        Returns:
+            The decoded events, empty when nothing is waiting
+        """
+        websocket = self.rtm_websocket()
+        if websocket is None:
+            # Stand ins for the client, like the replay harness, hand out events themselves
+            return self.slack_client.rtm_read()
+
+        frames = []
+        while True:
+            try:
+                opcode, frame = websocket.recv_data(control_frame=True)
+            except (ssl.SSLWantReadError, BlockingIOError):
+                break
+            except (WebSocketException, OSError) as error:
+                logger.warning('The RTM websocket failed: %s', error)
+                self.dropped = True
+                break
+
+            self.last_frame_at = time.monotonic()
+            if opcode == ABNF.OPCODE_TEXT and frame:
+                frames.append(frame)
+            elif opcode == ABNF.OPCODE_CLOSE:
+                self.dropped = True
+                break
+
+        return self.ingest(frames)
+
+    def ingest(self, frames: typing.Iterable[bytes]) -> list:
+        """
+        Decode the raw frames that might hold an event the bot acts on, the
+        rest are counted and dropped without being decoded.
+
+        Returns:
+            The decoded events
+        """
+        events = []
+        filtered = Counter()
+        check = self.prefilter.check
+        for frame in frames:
+            reason = check(frame)
+            if reason is None:
+                events.append(loads(frame))
+            else:
+                filtered[reason] += 1
+
+        for reason, count in filtered.items():
+            self.metrics.filtered.labels(reason).inc(count)
+        self.event_counts['filtered'] += sum(filtered.values())
+
+        return events
+
+    def keep_alive(self):
+        """
+        Ping a quiet websocket, a connection can die without ever closing.
+        When even the ping goes unanswered the websocket counts as dropped.
+
+        """
+        websocket = self.rtm_websocket()
+        if websocket is None or self.dropped:
+            return
+
+        now = time.monotonic()
+        quiet = now - self.last_frame_at
+        if quiet >= PING_INTERVAL + PONG_TIMEOUT:
+            logger.warning('Nothing from the RTM websocket for %.0f seconds', quiet)
+            self.dropped = True
+        elif quiet >= PING_INTERVAL and now - self.pinged_at >= PING_INTERVAL:
+            self.pinged_at = now
+            try:
+                websocket.ping()
+            except (WebSocketException, OSError) as error:
+                logger.warning('Could not ping the RTM websocket: %s', error)
+                self.dropped = True
+
+    def get_websocket(self):
+        """
+        Get the raw socket underneath the RTM websocket, if there is one.
+
+        """
+        return getattr(self.rtm_websocket(), 'sock', None)
+
+    def wait_for_events(self, timeout: float) -> bool:
+        """
+        Block until the RTM websocket has something to read.
+
+        The timeout keeps the loop checking whether the bot is still living on
+        a quiet socket.
+
+        Args:
+            timeout: The longest time to wait in seconds
+
+        Returns:
+            Whether the websocket is ready to be read
 
-    def parse_slack_output(self, slack_rtm_output, voice_engine):
+        """
+        sock = self.get_websocket()
+        if sock is None:
+            time.sleep(timeout)
+            return False
+
+        # TLS can hold decrypted bytes that select will never report
+        pending = getattr(sock, 'pending', None)
+        if pending is not None and pending():
+            return True
+
+        readable, _, _ = select.select([sock], [], [], timeout)
+        return bool(readable)
+
+    def parse_slack_output(self, slack_rtm_output, voice_engine) -> BatchStats:
         """
         The Slack Real Time Messaging API is an events fire hose.
 
-        This parsing function returns None unless a message is directed at the
-        Bot, based on its ID.
+        Every event in the batch is classified in a single pass, then every
+        message directed at the Bot, based on its ID, is handled as a command.
+
+        Returns:
+            The counts of events seen, dispatched and skipped in the batch
 
         """
         if not slack_rtm_output:
-            return None, None
+            return BatchStats(seen=0, dispatched=0, skipped=0)
 
         # print(f'Parsing slack message: {slack_rtm_output}')
 
-        for output in slack_rtm_output:
+        with self.metrics.batch.time():
+            pending_commands = []
+            for output in slack_rtm_output:
+                bot_command = self.classify_event(output)
+                if bot_command is not None and not self.is_duplicate(output) and self.admit(*bot_command):
+                    pending_commands.append(bot_command)
 
-            message_type = output.get('type', None)
-            if message_type != 'message':
-                # print('\t-- skipping type {}'.format(message_type))
-                continue
+            for channel, user, bot_command in pending_commands:
+                if self.dispatcher is not None:
+                    self.dispatcher.submit(channel, user, bot_command)
+                    continue
 
-            user = output.get('user')
+                try:
+                    self.handle_command(channel, user, bot_command)
+                except Exception:
+                    # One broken command must not cost us the rest of the batch
+                    logger.exception('Error while handling command "%s" in channel %s', bot_command, channel)
 
-            if user == self.slack_user_id:
-                continue
+        return self.record_batch(seen=len(slack_rtm_output), dispatched=len(pending_commands))
 
-            print(f'Message from: {user}')
-            channel = output.get('channel')
-            channel_name = None
+    def record_batch(self, seen: int, dispatched: int) -> BatchStats:
+        """
+        Add the counts for one batch to the running totals.
 
-            try:
-                channel_name = self.slack_channels[channel]
-            except KeyError:
-                if channel in self.slack_ims:
-                    channel_name = 'private messages'
+        Args:
+            seen:       The number of events in the batch
+            dispatched: The number of commands dispatched from the batch
+
+        """
+        stats = BatchStats(seen=seen, dispatched=dispatched, skipped=seen - dispatched)
+        self.event_counts.update(stats._asdict())
+        for outcome, count in stats._asdict().items():
+            self.metrics.events.labels(outcome).inc(count)
+
+        return stats
+
+    def classify_event(self, output: dict) -> typing.Optional[tuple]:
+        """
+        Decide whether an event from the fire hose is a command for the bot.
 
-            if 'file' in output:
-                return self.handle_command(channel, user, 'handle file')
-                # return handle_file(channel_name, user, output['file'])
+        Args:
+            output: A single RTM event
 
-            text = output.get('text', '')
+        Returns:
+            A (channel, user, command) tuple or None if the event is skipped
 
-            if self.at_name in text:
-                bot_command = text.split(self.at_name)[1].strip().lower()
-                return self.handle_command(channel, user, bot_command)
+        """
+        message_type = output.get('type', None)
+        if message_type == 'goodbye':
+            # Slack is about to close the websocket, reconnect right away
+            self.dropped = True
+            return None
 
-            if channel in self.slack_ims:
-                return self.handle_command(channel, user, text)
+        if message_type in self.directory.event_types:
+            # Keep the directory current instead of refetching it
+            self.directory.apply_event(output)
+            # A renamed channel may match other rules
+            self.subscriptions.forget()
+            return None
+
+        if message_type != 'message':
+            # print('\t-- skipping type {}'.format(message_type))
+            return None
 
-            # voice_engine.setProperty('voice', voices[0].id)  # changes the voice to Ivy
-            # voice_engine.setProperty('voice', voices[1].id)  # changes the voice to Stuart
+        user = output.get('user')
 
-            try:
-                message = f'{self.slack_users[user]} says: "{text}" in {channel_name}'
-                # voice_engine.say(message)
-                # voice_engine.runAndWait()
-                print(message)
-            except KeyError as error:
-                print(f'Error "{error}" while processing "{text}"')
-            except UnicodeEncodeError as error:
-                print(f'Could not parse message: {error}')
+        if user == self.slack_user_id:
+            return None
+
+        channel = output.get('channel')
+
+        file = output.get('file')
+        if file is not None:
+            if self.ignores(channel, '') or not isinstance(file, dict):
+                return None
+            return channel, user, SharedFile(file)
+
+        text = output.get('text', '')
+
+        if self.at_name in text:
+            bot_command = text.split(self.at_name)[1].strip().lower()
+            return None if self.ignores(channel, bot_command) else (channel, user, bot_command)
+
+        if channel in self.slack_ims:
+            return None if self.ignores(channel, text) else (channel, user, text)
+
+        # voice_engine.setProperty('voice', voices[0].id)  # changes the voice to Ivy
+        # voice_engine.setProperty('voice', voices[1].id)  # changes the voice to Stuart
+
+        # Chatter is most of the fire hose, only look names up when it is logged
+        if logger.isEnabledFor(logging.DEBUG):
+            channel_name = self.slack_channels.get(channel) or channel
+            logger.debug('%s says: "%s" in %s', self.slack_users.get(user, user), text, channel_name,
+                         extra={'channel': channel, 'user': user})
+            # voice_engine.say(message)
+            # voice_engine.runAndWait()
+
+        return None
+
+    def ignores(self, channel: str, bot_command: str) -> bool:
+        """
+        Check whether a command comes from a channel the bot ignores. The
+        pre-filter drops most of them, but not the events read by
+        SlackClient, and telling the bot to listen always gets through.
+
+        """
+        return (channel is not None and self.subscriptions.is_ignored(channel)
+                and bot_command.partition(' ')[0].lower() != LISTEN)
+
+    def load_subscriptions(self):
+        """
+        Read back the channels this workspace told the bot to ignore.
+
+        """
+        rules = [self.settings.get(name, self.team_id) or '' for name in (IGNORED_SETTING, LISTENED_SETTING)]
+        self.subscriptions.load(*(filter(None, rule.split(',')) for rule in rules))
+
+    def subscribe(self, action: str, pattern: str) -> str:
+        """
+        Listen to or ignore the channels matching a rule from now on.
+
+        Args:
+            action:  Listen or ignore, see the subscriptions module
+            pattern: A channel id or name, with wildcards to cover many
+
+        Returns:
+            The rule as kept
+
+        """
+        # Saved before anyone else changes them, so the last change is the one kept
+        with self.subscriptions.lock:
+            if action == IGNORE:
+                rule = self.subscriptions.ignore(pattern)
+            else:
+                rule = self.subscriptions.listen(pattern)
+
+            for name, rules in zip((IGNORED_SETTING, LISTENED_SETTING), self.subscriptions.rules()):
+                self.settings.set(name, ','.join(rules) or None, self.team_id, scope=WORKSPACE)
+
+        logger.info('%s channels matching %s', action.capitalize(), rule, extra={'rule': rule})
+        return rule
+
+    def is_duplicate(self, output: dict) -> bool:
+        """
+        Check whether a command event was already handled, Slack can deliver
+        the same message twice after a reconnect or a retry.
+
+        Args:
+            output: A single RTM event that is a command
+
+        """
+        key = event_key(output)
+        if key is None or self.recent_events.add(key):
+            return False
+
+        logger.info('Suppressed a duplicate of event %s', key)
+        self.metrics.duplicates.inc()
+        return True
+
+    def backlog(self) -> int:
+        """
+        Get the number of commands waiting to run.
+
+        """
+        return self.dispatcher.depth if self.dispatcher is not None else 0
+
+    def admit(self, channel: str, user: str, bot_command: str, backlog: int = None) -> bool:
+        """
+        Check a command against the throttle before it is dispatched.
+
+        A throttled user or channel is told so once per throttle window.
+
+        Args:
+            channel:     The channel the command came from
+            user:        The user who sent it
+            bot_command: The command text
+            backlog:     The commands waiting to run, the dispatcher queue by default
+
+        Returns:
+            Whether the command may run
+
+        """
+        if self.throttle is None:
+            return True
+
+        # Unknown commands cost a suggestion lookup, as much as a cheap command
+        if isinstance(bot_command, SharedFile):
+            handler_class = self.file_handler_class()
+        else:
+            handler_class = self.registry.get(bot_command.partition(' ')[0])
+        cost = getattr(handler_class, 'cost', 1)
+        reason, wait = self.throttle.check(channel, user, cost, self.backlog() if backlog is None else backlog)
+        if reason is None:
+            return True
+
+        self.metrics.throttled.labels(reason).inc()
+        logger.info('Throttled "%s" from user %s in channel %s: %s', bot_command, user, channel, reason)
+
+        key = channel if reason in (CHANNEL, BUSY) else user
+        if self.throttle.should_notify(reason, key):
+            self.post_message(channel, self.throttled_response(reason, user, wait))
+
+        return False
+
+    def throttled_response(self, reason: str, user: str, wait: float) -> str:
+        """
+        Build the reply for a throttled command.
+
+        """
+        if reason == BUSY:
+            return 'I am too busy for more commands right now, try again soon.'
+
+        if reason == CHANNEL:
+            return f'This channel is sending me too many commands, give me {max(wait, 1):.0f} seconds.'
+
+        return f'Slow down {self.get_user_name(user)}, try again in {max(wait, 1):.0f} seconds.'
 
     def get_command_class(self, command: str, channel: str, user: str):
         """
@@ -174,26 +840,19 @@ class MattBot:
         Returns: The class of the command to run
 
         """
-        try:
-            command_class = f'{command.capitalize()}Command'
-            handler_class = getattr(commands, command_class)
-            return handler_class(self, channel=channel, user=user)
-        except AttributeError:
-            logger.debug('Could not load the %s handler class.', command_class)
+        handler_class = self.registry.get(command)
+        if handler_class is None:
+            logger.debug('Could not find a handler class for %s.', command)
             return None
 
+        return handler_class(self, channel=channel, user=user)
+
     def get_available_commands(self) -> list:
         """
         Get a list of commands
 
         """
-        if self.available_commands:
-            return self.available_commands
-
-        self.available_commands = [command_name for command_name, command_class in inspect.getmembers(commands)
-                                                if inspect.isclass(command_class)]
-
-        return self.available_commands
+        return self.registry.names
 
     def handle_command(self, channel, user, bot_command):
         """
@@ -202,89 +861,194 @@ class MattBot:
         returns back what it needs for clarification.
 
         """
+        command_type, handler, parameters = self.resolve_command(channel, user, bot_command)
+        if handler is not None:
+            started = time.perf_counter()
+            profiler = self.profiler
+            try:
+                if profiler is not None:
+                    result = profiler.run(handler, parameters)
+                else:
+                    result = handler.run(parameters)
+            except Exception:
+                self.record_command(handler, 'error', time.perf_counter() - started)
+                raise
+
+            self.record_command(handler, 'ok' if result is None or result else 'failed',
+                                time.perf_counter() - started)
+            return result
+
+        self.record_command(None, 'unknown')
+        response = self.unknown_command_response(command_type)
+        self.post_message(channel, response)
+
+    def record_command(self, handler, outcome: str, seconds: float = None):
+        """
+        Count a command and how long it ran.
+
+        Commands are counted by their name rather than the alias used, and
+        every unknown command counts as unknown so typos cannot flood the
+        metrics with labels.
+
+        Args:
+            handler: The command that ran, None for an unknown command
+            outcome: ok, failed when it returned a failed result, error when
+                     it raised or unknown
+            seconds: How long it ran
+        """
+        self.count_command(None if handler is None else command_name(type(handler)), outcome, seconds)
+
+    def count_command(self, name: typing.Optional[str], outcome: str, seconds: float = None):
+        """
+        Count a command by its name, None for an unknown command.
+
+        """
+        if name is None:
+            self.metrics.commands.labels('unknown', outcome).inc()
+            return
+
+        self.metrics.commands.labels(name, outcome).inc()
+        self.metrics.command_latency.labels(name).observe(seconds)
+
+    def reply_busy(self, channel, user, bot_command):
+        """
+        Tell a user their command was turned away because the bot is busy.
+
+        """
+        response = f'Sorry {self.get_user_name(user)}, I am too busy for "{bot_command}" right now, try again soon.'
+        self.post_message(channel, response)
+
+    def resolve_command(self, channel, user, bot_command) -> tuple:
+        """
+        Split a command into its type and parameters and build its handler.
+
+        Returns:
+            A (command type, handler, parameters) tuple, the handler is None
+            for an unknown command
+
+        """
+        if isinstance(bot_command, SharedFile):
+            logger.debug('Handling %s from channel %s', bot_command, channel)
+            return 'file', self.file_handler_class()(self, channel=channel, user=user), bot_command.file
+
         command_type, _, parameters = bot_command.partition(' ')
 
         logger.debug('Handling command %s from channel %s', command_type, channel)
         handler = self.get_command_class(command_type, channel, user)
-        if handler is not None:
-            return handler.run(parameters)
+
+        return command_type, handler, parameters
+
+    def file_handler_class(self) -> type:
+        """
+        Get the class that handles shared files, it is kept out of the
+        registry so it cannot be run as a command.
+
+        """
+        return commands.import_module('exos').FileHandler
+
+    def unknown_command_response(self, command_type: str) -> str:
+        """
+        Build the reply for a command we do not know about.
+
+        Args:
+            command_type: The name of the unknown command
+
+        """
+        suggestions = self.registry.suggest(command_type)
+        logger.warning('unknown command %s, suggesting %s', command_type, suggestions)
+        if suggestions:
+            return f'Not sure what you mean. Did you mean {" or ".join(suggestions)}?'
 
         available_commands = ', '.join(self.get_available_commands())
-        logger.warning('unknown command %s, must be one of:%s', command_type, available_commands)
-        response = f'Not sure what you mean. Available commands are: {available_commands}'
-        self.slack_client.api_call('chat.postMessage', channel=channel, text=response, as_user=True)
+        return f'Not sure what you mean. Available commands are: {available_commands}'
 
-    def get_users(self) -> dict:
+    def api_call(self, method: str, **parameters) -> dict:
         """
-        Get all users in the slack application
+        Call the Slack Web API
+
+        Args:
+            method:     The API method to call
+            parameters: The arguments of the call
 
         """
-        slack_users = {}
+        started = time.perf_counter()
+        response = self.transport.api_call(method, token=self.slack_token, **parameters)
+        seconds = time.perf_counter() - started
 
-        api_call = self.slack_client.api_call('users.list')
-        if api_call.get('ok', False):
-            # retrieve all users so we can find our bot
-            users = api_call.get('members')
-            for user in users:
-                user_id = user.get('id')
-                user_name = user.get('name', None)
-                slack_users[user_id] = user_name
+        if response.get('ok', False):
+            outcome = 'ok'
+        elif response.get('error') == 'ratelimited':
+            outcome = 'ratelimited'
+        else:
+            outcome = 'error'
+        self.count_api_call(method, outcome, seconds)
 
-        return slack_users
+        return response
 
-    def get_channels(self) -> dict:
+    def count_api_call(self, method: str, outcome: str, seconds: float):
         """
-        Get all slack channels
+        Count a Web API call and how long it took.
+
+        Args:
+            method:  The Web API method called
+            outcome: How the call went, ok, ratelimited or error
+            seconds: The time the call took
+
+        """
+        self.metrics.api_latency.labels(method).observe(seconds)
+        self.metrics.api_calls.labels(method, outcome).inc()
+
+    def post_message(self, channel: str, text: str, **parameters) -> dict:
+        """
+        Post a message to a channel as the bot, through the outbound queue
+        when there is one.
+
+        Args:
+            channel:    The channel to post to
+            text:       The message
+            parameters: Other chat.postMessage parameters
 
         """
-        slack_channels = {}
+        parameters.setdefault('as_user', True)
+        if self.outbound is not None:
+            return self.outbound.post(channel, text, **parameters)
 
-        api_call = self.slack_client.api_call('channels.list')
-        if api_call.get('ok', False):
-            # retrieve all channels so we can find our bot
-            channels = api_call.get('channels')
-            for channel in channels:
-                channel_id = channel.get('id')
-                channel_name = channel.get('name', None)
-                slack_channels[channel_id] = channel_name
+        return self.api_call('chat.postMessage', channel=channel, text=text, **parameters)
 
-        return slack_channels
+    def get_users(self) -> dict:
+        """
+        Get all users in the slack application
+
+        """
+        return self.directory.load_users(self.api_call)
 
-    def get_ims(self):
+    def get_channels(self) -> dict:
         """
+        Get all slack channels
 
-        :return:
         """
-        slack_ims = {}
+        return self.directory.load_channels(self.api_call)
 
-        api_call = self.slack_client.api_call('im.list')
-        if api_call.get('ok', False):
-            # retrieve all channels so we can find our bot
-            ims = api_call.get('ims')
-            for im in ims:
-                im_id = im.get('id')
-                im_user = im.get('user', None)
-                slack_ims[im_id] = im_user
+    def get_ims(self) -> dict:
+        """
+        Get all IMs with the bot
 
-        return slack_ims
+        """
+        return self.directory.load_ims(self.api_call)
 
-    def get_user_id(self, users: dict, name: str) -> typing.Union[int, None]:
+    def get_user_id(self, users: NameIndex, name: str) -> typing.Union[str, None]:
         """
         Get the user id for th given username
 
         Args:
-            users: dict
-            name: string
+            users: The user directory
+            name:  The user name to look up
 
         Returns:
-            integer
+            The user id or None if there is no such user
 
         """
-        for user_id, user_name in users.items():
-            if user_name == name:
-                return user_id
-
-        return None
+        return users.key_for(name)
 
     def get_user_name(self, user_code):
         """
@@ -307,19 +1071,61 @@ class MattBot:
         Args:
             channel_code: The channel code to look up
         """
-        try:
-            return self.slack_channels[channel_code]
-        except KeyError:
-            logger.warning('Could not find a channel with the code %s', channel_code)
-            try:
-                return self.slack_users[self.slack_ims[channel_code]]
-            except KeyError:
-                logger.error('Could not find an IM with the code %s', channel_code)
+        channel_name = self.slack_channels.get(channel_code)
+        if channel_name is not None:
+            return channel_name
+
+        im_user = self.slack_ims.get(channel_code)
+        if im_user is not None:
+            return self.get_user_name(im_user)
 
+        logger.error('Could not find a channel or IM with the code %s', channel_code)
         return 'unknown channel'
 
 if __name__ == "__main__":
 
-    bot = MattBot(name='mattbot',
-                  token=os.environ.get('MATTBOT_TOKEN'))
-    bot.listen()
+    logconfig.setup(os.environ.get('MATTBOT_LOG_LEVEL', logconfig.DEFAULT_LEVEL),
+                    sample_debug=int(os.environ.get('MATTBOT_LOG_SAMPLE', 1)))
+
+    # Throttled by default, MATTBOT_THROTTLE=off turns it off
+    throttle = parse_limits(os.environ.get('MATTBOT_THROTTLE', ''))
+    settings = SettingsStore(os.environ.get('MATTBOT_SETTINGS', DEFAULT_PATH))
+    metrics_port = os.environ.get('MATTBOT_METRICS_PORT')
+    metrics_port = int(metrics_port) if metrics_port else None
+
+    if os.environ.get('MATTBOT_TOKENS'):
+        # Every workspace on one event loop, sharing the registry and the transport
+        from workspaces import WorkspaceHost, parse_tokens
+        host = WorkspaceHost(parse_tokens(os.environ['MATTBOT_TOKENS']), name='mattbot',
+                             transport=Transport(base_url=os.environ.get('MATTBOT_API_URL', SLACK_API_URL),
+                                                 http2=bool(os.environ.get('MATTBOT_HTTP2'))),
+                             metrics_port=metrics_port,
+                             throttle=throttle, settings=settings)
+        host.connect()
+        host.run()
+        sys.exit()
+
+    workers = int(os.environ.get('MATTBOT_WORKERS', 0))
+    bot_class, options = MattBot, {'workers': workers}
+    if os.environ.get('MATTBOT_SHARDS'):
+        # Commands run in shard processes, with the workers in each of them
+        from sharding import ShardedBot
+        bot_class, options = ShardedBot, {'shards': int(os.environ['MATTBOT_SHARDS']), 'shard_workers': workers}
+
+    bot = bot_class(name='mattbot',
+                    token=os.environ.get('MATTBOT_TOKEN'),
+                    queue_size=int(os.environ.get('MATTBOT_QUEUE_SIZE', DEFAULT_QUEUE_SIZE)),
+                    queue_policy=os.environ.get('MATTBOT_QUEUE_POLICY', BLOCK),
+                    transport=Transport(base_url=os.environ.get('MATTBOT_API_URL', SLACK_API_URL),
+                                        http2=bool(os.environ.get('MATTBOT_HTTP2'))),
+                    metrics_port=metrics_port,
+                    throttle=throttle,
+                    settings=settings,
+                    **options)
+
+    # The engine runs commands itself, sharded bots hand them to their shards
+    if os.environ.get('MATTBOT_ASYNC') and bot_class is MattBot:
+        from engine import AsyncEngine
+        AsyncEngine(bot).run()
+    else:
+        bot.listen()
@@ -1,17 +1,184 @@
-import os
+"""
+Lazy loading for commands
+
+Command modules are not imported with the package. A manifest of every
+command class, the module it lives in and its aliases is read from the
+module sources without running them, and cached on disk until a module
+changes. A module is only imported the first time one of its commands is
+used.
+
+"""
+import ast
 import importlib
-import inspect
+import json
+import logging
+import os
+import time
 
-#
-# Dynamic imports for commands
-#
+logger = logging.getLogger(__name__)
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
-for path, subdirs, files in os.walk(dir_path):
-    for name in files:
-        if '__init__' not in name and name.endswith('.py'):
-            module_name = f'.{name[:-3]}'
-            command_module = importlib.import_module(module_name, 'commands')
-            for member_name, member_item in inspect.getmembers(command_module):
-                if inspect.isclass(member_item) and inspect.getmodule(member_item) is command_module:
-                    globals()[member_name] = member_item
+MANIFEST_PATH = os.path.join(dir_path, '__pycache__', 'manifest.json')
+COMMAND_SUFFIX = 'Command'
+
+_manifest = None
+_import_times = {}
+_manifest_report = {}
+
+
+def command_modules() -> dict:
+    """
+    Get the command module files and their stamps, used to tell when the
+    cached manifest is out of date.
+
+    """
+    modules = {}
+    for name in sorted(os.listdir(dir_path)):
+        if '__' in name or not name.endswith('.py'):
+            continue
+
+        stat = os.stat(os.path.join(dir_path, name))
+        modules[name[:-3]] = [stat.st_mtime_ns, stat.st_size]
+
+    return modules
+
+
+def scan_module(module_name: str) -> dict:
+    """
+    Find the command classes defined in a module without importing it.
+
+    Returns:
+        The class names mapped to their aliases
+
+    """
+    with open(os.path.join(dir_path, f'{module_name}.py'), encoding='utf-8') as source:
+        tree = ast.parse(source.read())
+
+    found = {}
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef) or node.name == COMMAND_SUFFIX or not node.name.endswith(COMMAND_SUFFIX):
+            continue
+
+        aliases = []
+        for statement in node.body:
+            if isinstance(statement, ast.Assign) and any(getattr(target, 'id', None) == 'aliases'
+                                                         for target in statement.targets):
+                aliases = list(ast.literal_eval(statement.value))
+
+        found[node.name] = aliases
+
+    return found
+
+
+def read_cache() -> dict:
+    try:
+        with open(MANIFEST_PATH, encoding='utf-8') as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache(cache: dict):
+    try:
+        os.makedirs(os.path.dirname(MANIFEST_PATH), exist_ok=True)
+        with open(MANIFEST_PATH, 'w', encoding='utf-8') as cache_file:
+            json.dump(cache, cache_file)
+    except OSError as error:
+        logger.warning('Could not cache the command manifest: %s', error)
+
+
+def load_manifest() -> dict:
+    """
+    Get the manifest of every command, scanning only the modules that
+    changed since it was cached.
+
+    Returns:
+        Command class names mapped to {'module': ..., 'aliases': [...]}
+
+    """
+    global _manifest
+
+    if _manifest is not None:
+        return _manifest
+
+    started = time.perf_counter()
+    cache = read_cache()
+    cached_modules = cache.get('modules', {})
+    modules = {}
+    scanned = []
+
+    for module_name, stamp in command_modules().items():
+        cached = cached_modules.get(module_name)
+        if cached is not None and cached['stamp'] == stamp:
+            modules[module_name] = cached
+            continue
+
+        modules[module_name] = {'stamp': stamp, 'commands': scan_module(module_name)}
+        scanned.append(module_name)
+
+    if scanned or len(modules) != len(cached_modules):
+        write_cache({'modules': modules})
+
+    _manifest = {class_name: {'module': module_name, 'aliases': aliases}
+                 for module_name, module in modules.items()
+                 for class_name, aliases in module['commands'].items()}
+
+    _manifest_report.update(seconds=time.perf_counter() - started, scanned=scanned, modules=len(modules))
+    logger.debug('Loaded a manifest of %s commands in %.4f seconds, scanned %s', len(_manifest),
+                 _manifest_report['seconds'], ', '.join(scanned) or 'nothing')
+
+    return _manifest
+
+
+def import_module(module_name: str):
+    """
+    Import a command module, timing it the first time.
+
+    """
+    full_name = f'{__name__}.{module_name}'
+    if full_name not in _import_times:
+        started = time.perf_counter()
+        module = importlib.import_module(full_name)
+        _import_times[full_name] = time.perf_counter() - started
+        logger.debug('Imported %s in %.4f seconds', full_name, _import_times[full_name])
+        return module
+
+    return importlib.import_module(full_name)
+
+
+def load(class_name: str) -> type:
+    """
+    Get a command class, importing its module if it has not been yet.
+
+    Args:
+        class_name: The name of the command class, HelloCommand for example
+
+    """
+    entry = load_manifest().get(class_name)
+    if entry is None:
+        raise AttributeError(f'There is no command class called {class_name}')
+
+    return getattr(import_module(entry['module']), class_name)
+
+
+def import_report() -> dict:
+    """
+    Get how long the manifest and every command module imported so far took
+    to load, to keep an eye on startup time.
+
+    """
+    return {
+        'manifest': dict(_manifest_report),
+        'imports': dict(_import_times),
+    }
+
+
+def __getattr__(name: str):
+    # Keeps commands.HelloCommand, commands.Command and friends working
+    if name in ('Command', 'CommandResult'):
+        return getattr(import_module('base'), name)
+
+    try:
+        return load(name)
+    except AttributeError:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
@@ -0,0 +1,27 @@
+"""
+Report how long the commands take to load, to track startup time
+
+    python -m commands
+
+"""
+import commands
+
+
+def main():
+    manifest = commands.load_manifest()
+    for class_name in sorted(manifest):
+        commands.load(class_name)
+
+    report = commands.import_report()
+    scanned = ', '.join(report['manifest']['scanned']) or 'none, it was cached'
+    print(f'Manifest of {len(manifest)} commands in {report["manifest"]["modules"]} modules: '
+          f'{report["manifest"]["seconds"] * 1000:.2f} ms, scanned {scanned}')
+
+    for module_name, seconds in sorted(report['imports'].items(), key=lambda item: -item[1]):
+        print(f'{module_name:<30} {seconds * 1000:>8.2f} ms')
+
+    print(f'{"total":<30} {sum(report["imports"].values()) * 1000:>8.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,18 @@
 Base Command classes
 
 """
+import asyncio
+import functools
+import inspect
 import logging
+import typing
 
-from bot import MattBot
 from collections import namedtuple
 
+if typing.TYPE_CHECKING:
+    from bot import MattBot
+    from settings import ScopedSettings
+
 logger = logging.getLogger(__name__)
 
 
@@ -25,33 +32,85 @@ class CommandResult(namedtuple('CommandResult', ['success', 'message'])):
         return self.success
 
 
+class RequestContext:
+    """
+    Where a command came from.
+
+    The channel and user names are only looked up the first time they are
+    used and then kept, most commands never need both.
+
+    """
+    __slots__ = ('bot', 'channel', 'user', '_channel_name', '_user_name')
+
+    def __init__(self, bot: 'MattBot', channel: str, user: str) -> None:
+        self.bot = bot
+        self.channel = channel
+        self.user = user
+        self._channel_name = None
+        self._user_name = None
+
+    @property
+    def channel_name(self) -> str:
+        if self._channel_name is None:
+            self._channel_name = self.bot.get_channel_name(self.channel)
+
+        return self._channel_name
+
+    @property
+    def user_name(self) -> str:
+        if self._user_name is None:
+            self._user_name = self.bot.get_user_name(self.user)
+
+        return self._user_name
+
+
 class Command:
     """
     Base command class
 
     """
+    aliases = ()
+    cost = 1  # Throttle tokens a run takes, see the throttle module
     client = None
-    channel = 'unknown'
-    user = 'unknown'
 
-    def __init__(self, bot: MattBot, channel: str, user: str) -> None:
+    def __init__(self, bot: 'MattBot', channel: str, user: str, context: RequestContext = None) -> None:
         """
         Initialize the command
 
         Args:
-            bot:    An instance of the MattBot
-            channel:The channel the event took place in
-            user:   The user who initiated the event
+            bot:     An instance of the MattBot
+            channel: The channel the event took place in
+            user:    The user who initiated the event
+            context: The context of the request, built from the channel and
+                     user when it is not given
 
         """
-        self.settings = {
-            'check_logs': None
-        }
         self.bot = bot
-        self.channel = channel
-        self.channel_name = self.bot.get_channel_name(channel)
-        self.user = user
-        self.user_name = self.bot.get_user_name(user)
+        self.context = context if context is not None else RequestContext(bot, channel, user)
+
+    @property
+    def channel(self) -> str:
+        return self.context.channel
+
+    @property
+    def user(self) -> str:
+        return self.context.user
+
+    @property
+    def channel_name(self) -> str:
+        return self.context.channel_name
+
+    @property
+    def user_name(self) -> str:
+        return self.context.user_name
+
+    @property
+    def settings(self) -> 'ScopedSettings':
+        """
+        The settings for the user in this channel, see the settings module
+
+        """
+        return self.bot.settings.scoped(self.bot.team_id, self.channel, self.user)
 
     def call_api(self, endpoint: str, message: str = None, **parameters) -> dict:
         """
@@ -66,19 +125,44 @@ class Command:
             Whether or not the call was successful
 
         """
-        return self.bot.slack_client.api_call(endpoint, text=message, channel=self.channel, as_user=True, **parameters)
+        parameters = dict({'text': message, 'channel': self.channel, 'as_user': True}, **parameters)
+        return self.bot.api_call(endpoint, **parameters)
+
+    async def call_api_async(self, endpoint: str, message: str = None, **parameters) -> dict:
+        """
+        Make an API call without blocking the event loop
+
+        Args:
+            endpoint:   The endpoint to communicate with
+            message:    The message to send.
+            parameters: Other parameters
+
+        """
+        call_api = functools.partial(self.call_api, endpoint, message, **parameters)
+        return await asyncio.get_event_loop().run_in_executor(None, call_api)
 
     def post_message(self, message) -> dict:
         """
-        Post a message
+        Post a message to the channel of the command
+
+        Messages are queued and posted in order within Slack's rate limit, so
+        this returns before the message is in the channel.
 
         Args:
-            message:
+            message: The message to post
 
-        Returns:
+        """
+        return self.bot.post_message(self.channel, message)
 
+    async def post_message_async(self, message) -> dict:
         """
-        return self.call_api(endpoint='chat.postMessage', message=message)
+        Post a message without blocking the event loop
+
+        Args:
+            message: The message to post
+
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, self.post_message, message)
 
     def join_channel(self, channel: str) -> dict:
         """
@@ -87,7 +171,7 @@ class Command:
             channel: The channel to join
 
         """
-        return self.bot.slack_client.api_call('channels.join', channel=channel)
+        return self.bot.api_call('channels.join', channel=channel)
 
     def run(self, parameters: str) -> bool:
         """
@@ -97,3 +181,20 @@ class Command:
 
         """
         raise NotImplementedError('You must define a run method')
+
+    async def run_async(self, parameters: str):
+        """
+        Run the command from the event loop.
+
+        Commands may define run as a coroutine, which is awaited directly.
+        Synchronous commands run in the loop's executor so they can block
+        without holding up anyone else.
+
+        Args:
+            parameters: The content of the command
+
+        """
+        if inspect.iscoroutinefunction(self.run):
+            return await self.run(parameters)
+
+        return await asyncio.get_event_loop().run_in_executor(None, self.run, parameters)
@@ -5,9 +5,14 @@ Commands specific to the bot
 import logging
 
 from commands.base import Command, CommandResult
+from profiler import Profiler, parse_request
+from settings import CHANNEL, SCOPES, USER, WORKSPACE
+from subscriptions import IGNORE, LISTEN
 
 logger = logging.getLogger(__name__)
 
+LEAVE_TIMEOUT = 10  # Seconds to wait for the goodbye message before leaving
+
 
 class DieCommand(Command):
     """
@@ -25,7 +30,8 @@ class DieCommand(Command):
 
         """
         setting, _, setting_parameters = parameters.partition(' ')
-        self.settings[setting] = setting_parameters
+        if setting:
+            self.settings[setting] = setting_parameters
         response = f'Okay {self.user_name}, I am going to die.'
         self.post_message(response)
         self.bot.die()
@@ -35,7 +41,9 @@ class DieCommand(Command):
 
 class SetCommand(Command):
     """
-    Update a command setting
+    Update a command setting, "set check_logs on" for this channel or
+    "set user check_logs on" for yourself and "set workspace check_logs on"
+    for everyone
 
     """
     def run(self, parameters: str) -> bool:
@@ -48,9 +56,65 @@ class SetCommand(Command):
             The CommandResult
 
         """
-        setting, _, setting_parameters = parameters.partition(' ')
-        self.settings[setting] = setting_parameters
-        response = f'Okay {self.user_name}, setting {setting} to {setting_parameters}'
+        scope, _, rest = parameters.partition(' ')
+        if scope not in SCOPES:
+            scope, rest = CHANNEL, parameters
+
+        setting, _, setting_parameters = rest.partition(' ')
+        if not setting:
+            response = f'Sorry {self.user_name}, set what?'
+            self.post_message(response)
+            return CommandResult(success=False, message=response)
+
+        self.settings.set(setting, setting_parameters, scope=scope)
+        audience = {USER: 'you', CHANNEL: 'this channel', WORKSPACE: 'everyone'}[scope]
+        response = f'Okay {self.user_name}, setting {setting} to {setting_parameters} for {audience}'
+        self.post_message(response)
+
+        return CommandResult(success=True, message=response)
+
+
+class ProfileCommand(Command):
+    """
+    Profile the bot for a while, "profile sample 30s" or "profile cprofile 20 commands"
+
+    """
+    cost = 5  # Slows every other command down while it runs
+
+    def run(self, parameters: str) -> bool:
+        """
+
+        Args:
+            parameters: The command payload
+
+        Returns:
+            The CommandResult
+
+        """
+        if parameters.strip() == 'stop':
+            profiler = self.bot.profiler
+            if profiler is None:
+                response = f'I am not profiling anything, {self.user_name}.'
+                self.post_message(response)
+                return CommandResult(success=False, message=response)
+
+            profiler.finish()
+            return CommandResult(success=True, message='Stopped profiling')
+
+        try:
+            mode, seconds, commands = parse_request(parameters)
+        except ValueError as error:
+            response = f'Sorry {self.user_name}, {error}.'
+            self.post_message(response)
+            return CommandResult(success=False, message=response)
+
+        if not Profiler(self.bot, self.channel, mode, seconds=seconds, commands=commands).start():
+            response = f'Sorry {self.user_name}, I am already being profiled.'
+            self.post_message(response)
+            return CommandResult(success=False, message=response)
+
+        amount = f'{commands} commands' if commands is not None else f'{seconds} seconds'
+        response = f'Okay {self.user_name}, profiling with {mode} for the next {amount}.'
         self.post_message(response)
 
         return CommandResult(success=True, message=response)
@@ -108,6 +172,10 @@ class LeaveCommand(Command):
         response = f'Okay {self.user_name}, I am leaving {self.channel_name}.'
         self.post_message(response)
 
+        # Say goodbye before we are gone
+        if self.bot.outbound is not None:
+            self.bot.outbound.wait_until_sent(self.channel, timeout=LEAVE_TIMEOUT)
+
         api_response = self.call_api('channels.leave')
         if not api_response.get('ok', False):
             error = api_response.get("error", "an error")
@@ -120,7 +188,8 @@ class LeaveCommand(Command):
 
 class ListenCommand(Command):
     """
-    Tell the bot to listen to the current channel
+    Tell the bot to listen to the current channel again, or to the channels
+    matching a rule like "listen deploy-prod"
 
     """
     def run(self, parameters: str) -> bool:
@@ -133,7 +202,12 @@ class ListenCommand(Command):
             The CommandResult
 
         """
-        response = f'Okay {self.user_name}, listening for events in {self.channel_name}.'
+        if not parameters.strip():
+            self.bot.subscribe(LISTEN, self.channel)
+            response = f'Okay {self.user_name}, listening for events in {self.channel_name}.'
+        else:
+            rule = self.bot.subscribe(LISTEN, parameters)
+            response = f'Okay {self.user_name}, listening for events in channels matching {rule}.'
         self.post_message(response)
 
         return CommandResult(success=True, message=response)
@@ -141,7 +215,35 @@ class ListenCommand(Command):
 
 class IgnoreCommand(Command):
     """
-    Tell the bot to ignore commands in this channel
+    Tell the bot to ignore commands in this channel, or in the channels
+    matching a rule like "ignore deploy-*"
+
+    """
+    def run(self, parameters: str) -> bool:
+        """
+
+        Args:
+            parameters: The command payload
+
+        Returns:
+            The CommandResult
+
+        """
+        if not parameters.strip():
+            self.bot.subscribe(IGNORE, self.channel)
+            response = f'Okay {self.user_name}, not listening for events in {self.channel_name}.'
+        else:
+            rule = self.bot.subscribe(IGNORE, parameters)
+            response = (f'Okay {self.user_name}, not listening for events in channels matching {rule}. '
+                        f'Say listen to hear them again.')
+        self.post_message(response)
+
+        return CommandResult(success=True, message=response)
+
+
+class StatsCommand(Command):
+    """
+    Summarize what the bot has been up to
 
     """
     def run(self, parameters: str) -> bool:
@@ -154,7 +256,7 @@ class IgnoreCommand(Command):
             The CommandResult
 
         """
-        response = f'Okay {self.user_name}, not listening for events in {self.channel_name}.'
+        response = '```' + self.bot.stats() + '```'
         self.post_message(response)
 
         return CommandResult(success=True, message=response)
@@ -1,42 +1,150 @@
 """
 Commands specific to Exos
 
+Deploy logs are checked as they download. The response is searched for the
+start of the migration section, only the section is split into lines and
+kept, and the download stops as soon as the section ends, so nothing
+touches the disk and a log of any size takes a bounded amount of memory.
+
+Files are not commands. The bot hands the file of a file event straight to
+the FileHandler, which is not registered, so nobody can type a file in.
+
 """
+import codecs
 import logging
-import os
-import requests
+import typing
 
 from commands.base import Command, CommandResult
-from tempfile import NamedTemporaryFile
+from transport import DownloadError
 
 logger = logging.getLogger(__name__)
 
+CHUNK_SIZE = 64 * 1024  # Bytes read from the download at a time
+MAX_LINE = 64 * 1024  # Characters in a line before it is split
+MAX_SNIPPET = 1024 * 1024  # Characters of the migration section sent as a snippet
+
+START_LOG = '#### RUNNING MIGRATIONS'
+END_LOG = '#### DONE'
+
+
+def skip_to(chunks: typing.Iterable[bytes], marker: bytes, max_line: int = MAX_LINE) -> typing.Iterator[bytes]:
+    """
+    Skip a stream of chunks to the start of the line holding a marker,
+    without splitting the lines before it.
+
+    Args:
+        chunks:   The body of a download
+        marker:   What to look for
+        max_line: The most of a line kept between chunks while looking
+
+    """
+    chunks = iter(chunks)
+    tail = b''  # The unfinished line at the end of the last chunk
+    for chunk in chunks:
+        buffer = tail + chunk
+        found = buffer.find(marker)
+        if found != -1:
+            yield buffer[buffer.rfind(b'\n', 0, found) + 1:]
+            yield from chunks
+            return
+
+        tail = buffer[buffer.rfind(b'\n') + 1:][-max(max_line, len(marker)):]
+
+
+def iter_lines(chunks: typing.Iterable[bytes], max_line: int = MAX_LINE) -> typing.Iterator[str]:
+    """
+    Split a stream of UTF-8 chunks into lines as they arrive.
+
+    Args:
+        chunks:   The body of a download
+        max_line: Lines longer than this are split, so one endless line
+                  cannot fill the memory
 
-class HandleFileCommand(Command):
     """
-    Handle "hello"
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    partial = ''
+    for chunk in chunks:
+        if not chunk:  # filter out keep-alive new chunks
+            continue
+
+        lines = (partial + decoder.decode(chunk)).split('\n')
+        partial = lines.pop()
+        for line in lines:
+            yield line + '\n'
+
+        while len(partial) > max_line:
+            yield partial[:max_line]
+            partial = partial[max_line:]
+
+    partial += decoder.decode(b'', final=True)
+    if partial:
+        yield partial
+
 
+def migration_section(lines: typing.Iterable[str], start_log: str = START_LOG,
+                      end_log: str = END_LOG) -> typing.Iterator[str]:
     """
-    def run(self, parameters: str):
+    Yield the lines from the start of the migrations to their end, and
+    stop reading there.
+
+    """
+    found_migrations = False
+    for line in lines:
+        if not found_migrations:
+            if start_log in line:
+                logger.debug('Found the start of the log')
+                found_migrations = True
+            else:
+                continue
+
+        yield line
+
+        if end_log in line:
+            logger.debug('Found the end of the log')
+            return
+
+
+def keep_snippet(lines: typing.Iterable[str], snippet: list, limit: int = MAX_SNIPPET) -> typing.Iterator[str]:
+    """
+    Pass lines on while keeping the first of them, up to a limit, for the
+    snippet.
+
+    """
+    kept = 0
+    for line in lines:
+        if kept < limit:
+            snippet.append(line[:limit - kept])
+            kept += len(snippet[-1])
+
+        yield line
+
+
+class FileHandler(Command):
+    """
+    Handle a file shared with the bot
+
+    """
+    cost = 5  # Downloads and reads the whole file
+
+    def run(self, file: dict):
         """
         Perform the action of this command
 
         Args:
-            parameters:
+            file: The file as it came in the file event
 
         Returns:
+            The CommandResult
 
         """
-        response = f'Hello, {self.user_name}!'
-        self.post_message(response)
-        return CommandResult(success=True, message=response)
+        return self.handle_file(file)
 
     def check_deploy_log(self, lines):
         """
         Check for error key words or fake migration phrases
 
         Args:
-            lines (list): The lines from the log file
+            lines (iterable): The lines from the log file, read once
 
         Returns:
             tuple:
@@ -63,69 +171,32 @@ class HandleFileCommand(Command):
 
         return has_errors, needs_fake
 
-    def download_file(self, url):
-        """
-
-        Args:
-            url: The URL to download the file from
-
-        """
-        logger.debug('Getting file contents from "%s"', url)
-
-        session = requests.Session()
-        session.headers['Authorization'] = f'Bearer {self.bot.slack_token}'
-        response = session.get(url, stream=True)
-
-        if response.status_code != 200:
-            logger.error('Could not download file from %s', url)
-            return None
-
-        with NamedTemporaryFile(delete=False) as log_file:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:  # filter out keep-alive new chunks
-                    log_file.write(chunk)
-
-            logger.debug('Saved log to %s', log_file.name)
-
-            return log_file.name
-
     def handle_deploy_log(self, channel, file):
         """
         Handle a log file
 
         """
-        start_log = '#### RUNNING MIGRATIONS'
-        end_log = '#### DONE'
-
-        url = file.get('url_private_download')
-
-        file_name = self.download_file(url)
-
-        if file_name is None:
+        url = file.get('url_private_download') or ''
+        if not self.bot.transport.is_file_url(url):
+            logger.warning('Not downloading %s, it is not a Slack file', url)
             return None
 
-        found_migrations = False
-        log_content = []
-
-        with open(file_name) as log:
-            for line in log:
-                if not found_migrations:
-                    if start_log in line:
-                        logger.debug('Found the start of the log')
-                        found_migrations = True
-                    else:
-                        continue
-
-                log_content.append(line)
-
-                if found_migrations and end_log in line:
-                    logger.debug('Found the end of the log')
-                    break
-
-        # Nuke the log file
-        os.unlink(file_name)
+        logger.debug('Reading the log from "%s"', url)
 
-        has_errors, needs_fake = self.check_deploy_log(log_content)
+        log_content = []
+        try:
+            with self.bot.transport.download(url, token=self.bot.slack_token) as response:
+                if response.status_code != 200:
+                    raise DownloadError(f'Got a {response.status_code} response')
+
+                # Lines before the migrations are never checked, so they are never split
+                lines = iter_lines(skip_to(response.iter_content(chunk_size=CHUNK_SIZE), START_LOG.encode()))
+                # Leaving the download once the migrations are done stops it there
+                has_errors, needs_fake = self.check_deploy_log(keep_snippet(migration_section(lines), log_content))
+        except DownloadError as error:
+            logger.error('Could not download file from %s: %s', url, error)
+            self.post_message('Sorry, I could not download the file {}.'.format(file['name']))
+            return None
 
         message = 'I could not find any issues in the {} file, check the snippet.'.format(file['name'])
 
@@ -143,19 +214,20 @@ class HandleFileCommand(Command):
         content = ''.join(log_content)
 
         logger.debug('Sending snippet {} to {}'.format(snippet_file_name, recipient_channels))
-        api_response = self.bot.slack_client.api_call('files.upload',
-                                                      channels=recipient_channels,
-                                                      content=content,
-                                                      initial_comment=message,
-                                                      filetype='text',
-                                                      filename=snippet_file_name)
+        api_response = self.bot.api_call('files.upload',
+                                         channels=recipient_channels,
+                                         content=content,
+                                         initial_comment=message,
+                                         filetype='text',
+                                         filename=snippet_file_name)
 
         if not api_response.get('ok', False):
-            message = 'Sorry, I was not able to send the snippet due to {api_response.get("error", "an error")}.'
-            self.post_message(message)
+            self.post_message(f'Sorry, I was not able to send the snippet due to '
+                              f'{api_response.get("error", "an error")}.')
 
         # Reply to the original channel with the message
         self.post_message(message)
+        return True
 
     def handle_file(self, file_data):
         """
@@ -165,7 +237,7 @@ class HandleFileCommand(Command):
         if self.user == self.bot.slack_user_id:
             return
 
-        file_name = file_data['name']
+        file_name = file_data.get('name') or ''
 
         if file_name.endswith('deploy.log'):
             response = f'Handling file {file_name} from channel {self.channel_name} by {self.user_name}'
@@ -176,3 +248,4 @@ class HandleFileCommand(Command):
 
         response = 'I have nothing to say about that file.'
         self.post_message(response)
+        return CommandResult(success=True, message=response)
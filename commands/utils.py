@@ -25,7 +25,7 @@ class TestCommand(Command):
 
         """
         response = f'Okay {self.user_name}, I going to try uploading a snippet.'
-        self.client.api_call('chat.postMessage', channel=self.channel, text=response, as_user=True)
+        self.bot.api_call('chat.postMessage', channel=self.channel, text=response, as_user=True)
 
         recipients = ['@mpurdon', ]
         # recipient_ids = [recipient_id for recipient_id, name in self.users.items() if name in recipients]
@@ -41,19 +41,19 @@ class TestCommand(Command):
 
         recipients = ','.join(recipients)
         logger.debug('Sending snippet % to %', snippet_file_name, recipients)
-        api_response = self.client.api_call('files.upload',
-                                            channels=recipients,
-                                            filename=snippet_file_name,
-                                            filetype='text',
-                                            content=content,
-                                            initial_comment='I could not find a problem with the log.')
+        api_response = self.bot.api_call('files.upload',
+                                         channels=recipients,
+                                         filename=snippet_file_name,
+                                         filetype='text',
+                                         content=content,
+                                         initial_comment='I could not find a problem with the log.')
 
         logger.debug('Got response: %', api_response)
 
         if not api_response.get('ok', False):
             error = api_response.get("error", "an error")
             message = f'Sorry {self.user_name}, I was not able to send the snippet due to {error}.'
-            self.client.api_call('chat.postMessage', channel=self.channel, text=message, as_user=True)
+            self.bot.api_call('chat.postMessage', channel=self.channel, text=message, as_user=True)
             return CommandResult(success=False, message=message)
 
         return CommandResult(success=False, message='Saved snippet.')
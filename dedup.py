@@ -0,0 +1,75 @@
+"""
+Duplicate event suppression for the mattbot
+
+Slack can deliver the same message twice, after a reconnect or a retry.
+Every command event is checked against the keys of the most recent ones,
+kept in a fixed size ring with a hash index, so the check takes constant
+time and the memory stays bounded however fast events arrive.
+
+"""
+import typing
+
+DEDUP_SIZE = 4096  # Recent command events remembered
+
+
+def event_key(event: dict) -> typing.Optional[typing.Hashable]:
+    """
+    Get the key that identifies a message however often it is delivered.
+
+    Returns:
+        The client message id, or the channel and timestamp when there is
+        none, None when the event carries neither
+
+    """
+    client_msg_id = event.get('client_msg_id')
+    if client_msg_id is not None:
+        return client_msg_id
+
+    ts = event.get('ts')
+    if ts is None:
+        return None
+
+    return event.get('channel'), ts
+
+
+class RingIndex:
+    """
+    The most recent keys added, the oldest is forgotten once it is full
+
+    Not thread safe, the bot checks events on the thread that reads them.
+
+    """
+    __slots__ = ('size', 'ring', 'index', 'position')
+
+    def __init__(self, size: int = DEDUP_SIZE) -> None:
+        self.size = size
+        self.ring = [None] * size
+        self.index = set()
+        self.position = 0
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def add(self, key) -> bool:
+        """
+        Add a key unless it is already there.
+
+        Returns:
+            Whether the key was new
+
+        """
+        if key in self.index:
+            return False
+
+        # Keys are only added once, so the slot holds the only copy of its key
+        oldest = self.ring[self.position]
+        if oldest is not None:
+            self.index.discard(oldest)
+
+        self.ring[self.position] = key
+        self.index.add(key)
+        self.position = (self.position + 1) % self.size
+        return True
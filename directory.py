@@ -0,0 +1,439 @@
+"""
+User, channel and IM directory for the mattbot
+
+The directory is loaded once from the Web API, following the pagination
+cursors, and then kept current by applying RTM events to it as they arrive
+so new users and channels never need a full refetch.
+
+The directory is stored in NameIndex maps, which pack every id and name
+into a single buffer instead of holding a Python string object for each, so
+very large workspaces stay small in memory and can be searched both ways.
+
+"""
+import logging
+import threading
+import typing
+
+from array import array
+from collections.abc import MutableMapping
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 200  # Slack recommends no more than 200 results per page
+
+EMPTY = -1  # A hash table slot that was never used
+REMOVED = -2  # A hash table slot whose record was removed or renamed
+INITIAL_TABLE_SIZE = 16
+
+
+def paginate(api_call: typing.Callable, method: str, key: str, **parameters) -> typing.Iterator[dict]:
+    """
+    Yield every item from a paginated Web API list method.
+
+    Args:
+        api_call:   Makes a Web API call, SlackClient.api_call for example
+        method:     The list method to call
+        key:        The key of the items in the response
+        parameters: Other parameters for the call
+
+    """
+    cursor = None
+    while True:
+        if cursor:
+            parameters['cursor'] = cursor
+
+        response = api_call(method, limit=PAGE_SIZE, **parameters)
+        if not response.get('ok', False):
+            logger.error('Could not list %s: %s', key, response.get('error', 'unknown error'))
+            return
+
+        yield from response.get(key) or []
+
+        cursor = (response.get('response_metadata') or {}).get('next_cursor')
+        if not cursor:
+            return
+
+
+class Tables:
+    """
+    The buffer and the hash tables behind a NameIndex
+
+    Ids and names are stored UTF-8 encoded, back to back, in one bytearray.
+    Record n spans starts[n] to ends[n] with the id ending at splits[n].
+    Two open addressing hash tables hold record numbers, one hashed by id
+    and one by name.
+
+    """
+    __slots__ = ('data', 'starts', 'splits', 'ends', 'id_table', 'name_table', 'size', 'id_used', 'name_used')
+
+    def __init__(self, table_size: int = INITIAL_TABLE_SIZE) -> None:
+        self.data = bytearray()
+        self.starts = array('I')
+        self.splits = array('I')
+        self.ends = array('I')
+        self.id_table = array('i', [EMPTY]) * table_size
+        self.name_table = array('i', [EMPTY]) * table_size
+        self.size = 0  # live records
+        self.id_used = 0  # id table slots that are not empty, including removed ones
+        self.name_used = 0
+
+    def find(self, table: array, value: bytes, starts: array, ends: array) -> int:
+        """
+        Find the table slot holding a value, or the empty slot it would go in.
+
+        Args:
+            table:  The id or the name table
+            value:  The encoded id or name
+            starts: Where the values of the table start in the buffer
+            ends:   Where the values of the table end in the buffer
+
+        """
+        data = self.data
+        mask = len(table) - 1
+        slot = hash(value) & mask
+        while True:
+            record = table[slot]
+            if record == EMPTY:
+                return slot
+            if record >= 0 and data[starts[record]:ends[record]] == value:
+                return slot
+            slot = (slot + 1) & mask
+
+    def find_id(self, key: bytes) -> int:
+        return self.find(self.id_table, key, self.starts, self.splits)
+
+    def find_name(self, name: bytes) -> int:
+        return self.find(self.name_table, name, self.splits, self.ends)
+
+    def key_at(self, record: int) -> str:
+        return self.data[self.starts[record]:self.splits[record]].decode()
+
+    def name_at(self, record: int) -> str:
+        return self.data[self.splits[record]:self.ends[record]].decode()
+
+    def add(self, key: bytes, name: bytes):
+        """
+        Store an encoded id and name, replacing any record with the same id.
+
+        A record is written in full before a table points at it, so a reader
+        finds either the old record or the new one.
+
+        """
+        id_slot = self.find_id(key)
+        old_record = self.id_table[id_slot]
+        if old_record >= 0:
+            old_name = self.data[self.splits[old_record]:self.ends[old_record]]
+            if old_name == name:
+                return
+
+            name_slot = self.find_name(bytes(old_name))
+            if self.name_table[name_slot] == old_record:
+                self.name_table[name_slot] = REMOVED
+            self.size -= 1
+        else:
+            self.id_used += 1
+
+        record = len(self.starts)
+        self.starts.append(len(self.data))
+        self.data += key
+        self.splits.append(len(self.data))
+        self.data += name
+        self.ends.append(len(self.data))
+
+        self.id_table[id_slot] = record
+        if name:
+            name_slot = self.find_name(name)
+            if self.name_table[name_slot] == EMPTY:
+                self.name_used += 1
+            self.name_table[name_slot] = record
+        self.size += 1
+
+    def remove(self, key: bytes) -> bool:
+        """
+        Remove the record with an encoded id.
+
+        Returns:
+            Whether there was one
+
+        """
+        id_slot = self.find_id(key)
+        record = self.id_table[id_slot]
+        if record < 0:
+            return False
+
+        self.id_table[id_slot] = REMOVED
+        name_slot = self.find_name(bytes(self.data[self.splits[record]:self.ends[record]]))
+        if self.name_table[name_slot] == record:
+            self.name_table[name_slot] = REMOVED
+        self.size -= 1
+        return True
+
+    def live(self) -> typing.Iterator[tuple]:
+        """
+        Yield the encoded id and name of every live record.
+
+        """
+        data, starts, splits, ends = self.data, self.starts, self.splits, self.ends
+        for record in self.id_table:
+            if record >= 0:
+                yield bytes(data[starts[record]:splits[record]]), bytes(data[splits[record]:ends[record]])
+
+
+class NameIndex(MutableMapping):
+    """
+    A compact two way map of Slack ids to names
+
+    Every id and name is packed into one buffer with a hash table for each
+    direction, see Tables, so both directions are O(1) lookups.
+
+    Names are expected to be unique, when two ids share a name the last one
+    written is found by name. Renaming a record appends it again, the old
+    bytes are reclaimed the next time the tables are rebuilt.
+
+    Lookups can run on any thread while the listener writes. A rebuild fills
+    new tables off to the side and swaps them in with one assignment, and
+    every lookup reads from the tables it started with. Writers take a lock.
+
+    """
+    __slots__ = ('tables', 'lock')
+
+    # Rebuild the tables once half of their slots have been used and give
+    # them at least three slots per live record when they are rebuilt
+    MAX_LOAD = 2
+    SLOTS_PER_RECORD = 3
+
+    def __init__(self, items: typing.Iterable[tuple] = ()) -> None:
+        self.lock = threading.RLock()
+        self.clear()
+        for key, name in items:
+            self[key] = name
+
+    def clear(self, table_size: int = INITIAL_TABLE_SIZE):
+        self.tables = Tables(table_size)
+
+    def record_for(self, tables: Tables, key) -> int:
+        if not isinstance(key, str):
+            return EMPTY
+
+        return tables.id_table[tables.find_id(key.encode())]
+
+    def add(self, key: bytes, name: bytes):
+        """
+        Store an encoded id and name, replacing any record with the same id.
+
+        """
+        with self.lock:
+            tables = self.tables
+            tables.add(key, name)
+            if max(tables.id_used, tables.name_used) * self.MAX_LOAD > len(tables.id_table):
+                self.rebuild()
+
+    def rebuild(self):
+        """
+        Rebuild the buffer and the tables from the live records, doubling the
+        tables until there is room for them.
+
+        """
+        with self.lock:
+            live = list(self.tables.live())
+
+            table_size = len(self.tables.id_table)
+            while len(live) * self.SLOTS_PER_RECORD > table_size:
+                table_size *= 2
+
+            tables = Tables(table_size)
+            for key, name in live:
+                tables.add(key, name)
+            self.tables = tables
+
+    def __getitem__(self, key: str) -> str:
+        tables = self.tables
+        record = self.record_for(tables, key)
+        if record < 0:
+            raise KeyError(key)
+
+        return tables.name_at(record)
+
+    def __setitem__(self, key: str, name: str):
+        if not isinstance(key, str):
+            raise KeyError(f'Ids must be strings, not {key!r}')
+
+        self.add(key.encode(), (name or '').encode())
+
+    def __delitem__(self, key: str):
+        if not isinstance(key, str):
+            raise KeyError(key)
+
+        with self.lock:
+            if not self.tables.remove(key.encode()):
+                raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        return self.record_for(self.tables, key) >= 0
+
+    def __iter__(self) -> typing.Iterator[str]:
+        for key, _ in self.items():
+            yield key
+
+    def __len__(self) -> int:
+        return self.tables.size
+
+    def items(self) -> typing.Iterator[tuple]:
+        tables = self.tables
+        for record in tables.id_table:
+            if record >= 0:
+                yield tables.key_at(record), tables.name_at(record)
+
+    def key_for(self, name: str) -> typing.Optional[str]:
+        """
+        Get the id for a name.
+
+        Args:
+            name: The name to look up
+
+        Returns:
+            The id or None if nothing has the name
+
+        """
+        if not name:
+            return None
+
+        tables = self.tables
+        record = tables.name_table[tables.find_name(name.encode())]
+        if record < 0:
+            return None
+
+        return tables.key_at(record)
+
+
+class Directory:
+    """
+    The users, channels and IMs the bot knows about
+
+    """
+    def __init__(self) -> None:
+        self.users = NameIndex()  # user id <-> user name
+        self.channels = NameIndex()  # channel id <-> channel name
+        self.ims = NameIndex()  # IM id <-> user id
+
+        self.event_handlers = {
+            'team_join': self.on_user,
+            'user_change': self.on_user,
+            'channel_created': self.on_channel,
+            'channel_joined': self.on_channel,
+            'channel_rename': self.on_channel,
+            'channel_deleted': self.on_channel_deleted,
+            'group_joined': self.on_channel,
+            'group_rename': self.on_channel,
+            'im_created': self.on_im,
+        }
+
+    @property
+    def event_types(self) -> typing.KeysView:
+        """
+        The RTM event types that change the directory.
+
+        """
+        return self.event_handlers.keys()
+
+    def load(self, api_call: typing.Callable):
+        """
+        Load the whole directory from the Web API.
+
+        Args:
+            api_call: Makes a Web API call, SlackClient.api_call for example
+
+        """
+        self.load_users(api_call)
+        self.load_channels(api_call)
+        self.load_ims(api_call)
+
+    def load_users(self, api_call: typing.Callable) -> dict:
+        """
+        Load every user in the slack application
+
+        """
+        for user in paginate(api_call, 'users.list', 'members'):
+            self.add_user(user)
+
+        return self.users
+
+    def load_channels(self, api_call: typing.Callable) -> dict:
+        """
+        Load every slack channel
+
+        """
+        for channel in paginate(api_call, 'channels.list', 'channels', exclude_members=True):
+            self.add_channel(channel)
+
+        return self.channels
+
+    def load_ims(self, api_call: typing.Callable) -> dict:
+        """
+        Load every IM with the bot
+
+        """
+        for im in paginate(api_call, 'im.list', 'ims'):
+            self.add_im(im)
+
+        return self.ims
+
+    def add(self, index: NameIndex, kind: str, record: dict, name_key: str):
+        """
+        Store a user, channel or IM, skipping a record without an id rather
+        than failing the whole load.
+
+        """
+        record_id = record.get('id')
+        if not isinstance(record_id, str) or not record_id:
+            logger.warning('Skipping a %s without an id: %s', kind, record)
+            return
+
+        index[record_id] = record.get(name_key, None)
+
+    def add_user(self, user: dict):
+        self.add(self.users, 'user', user, 'name')
+
+    def add_channel(self, channel: dict):
+        self.add(self.channels, 'channel', channel, 'name')
+
+    def add_im(self, im: dict):
+        self.add(self.ims, 'IM', im, 'user')
+
+    def apply_event(self, event: dict) -> bool:
+        """
+        Update the directory from an RTM event.
+
+        Args:
+            event: An event from the fire hose
+
+        Returns:
+            Whether the event changed the directory
+
+        """
+        handler = self.event_handlers.get(event.get('type'))
+        if handler is None:
+            return False
+
+        try:
+            handler(event)
+        except (KeyError, TypeError, AttributeError):
+            logger.warning('Could not apply %s event to the directory: %s', event.get('type'), event)
+            return False
+
+        return True
+
+    def on_user(self, event: dict):
+        self.add_user(event['user'])
+
+    def on_channel(self, event: dict):
+        self.add_channel(event['channel'])
+
+    def on_channel_deleted(self, event: dict):
+        self.channels.pop(event['channel'], None)
+
+    def on_im(self, event: dict):
+        # The IM channel does not always say who it is with, the event does
+        im = dict(event['channel'])
+        im.setdefault('user', event.get('user'))
+        self.add_im(im)
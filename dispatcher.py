@@ -0,0 +1,286 @@
+"""
+Command dispatcher for the mattbot
+
+Commands are queued between the listener and the command handlers and run
+on a pool of worker threads, so a long command never stops the bot from
+reading the fire hose.
+
+Commands from the same channel always run one at a time and in the order
+they arrived. Commands from different channels run in parallel.
+
+The queue is bounded. When it is full a new command is handled according
+to the dispatcher policy:
+
+    block:       Wait for room in the queue. The listener stops reading until
+                 a worker picks something up, pushing back on the websocket.
+    drop_oldest: Throw away the command that has been waiting the longest to
+                 make room for the new one.
+    reply_busy:  Reject the new command and tell the user the bot is busy.
+
+"""
+import collections
+import logging
+import threading
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+REPLY_BUSY = 'reply_busy'
+POLICIES = (BLOCK, DROP_OLDEST, REPLY_BUSY)
+
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 100
+
+
+class Job(collections.namedtuple('Job', ['channel', 'user', 'bot_command', 'queued_at'])):
+    """
+    A command waiting for a worker.
+
+    """
+
+
+class Dispatcher:
+    """
+    A bounded queue feeding a pool of worker threads
+
+    """
+    def __init__(self, handler: typing.Callable, workers: int = DEFAULT_WORKERS,
+                 queue_size: int = DEFAULT_QUEUE_SIZE, policy: str = BLOCK,
+                 on_busy: typing.Callable = None) -> None:
+        """
+        Initialize the dispatcher
+
+        Args:
+            handler:    Called with the channel, user and command of every job
+            workers:    The number of worker threads
+            queue_size: The most commands allowed to wait for a worker
+            policy:     What to do when the queue is full, one of POLICIES
+            on_busy:    Called with the channel, user and command of a job
+                        rejected by the reply_busy policy
+
+        """
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown dispatcher policy {policy}, must be one of {", ".join(POLICIES)}')
+
+        if queue_size < 1:
+            raise ValueError('The dispatcher queue must hold at least one command')
+
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.policy = policy
+        self.on_busy = on_busy
+
+        self.lock = threading.Lock()
+        self.has_jobs = threading.Condition(self.lock)
+        self.has_room = threading.Condition(self.lock)
+        self.pending = {}  # channel -> deque of jobs
+        self.ready = collections.deque()  # channels with pending jobs and no running job
+        self.active = set()  # channels with a job running
+        self.depth = 0
+        self.running = False
+        self.threads = []
+
+        self.counts = collections.Counter()
+        self.peak_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def start(self):
+        """
+        Start the worker threads.
+
+        """
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+
+        self.threads = [threading.Thread(target=self.work, name=f'mattbot-dispatch-{number}', daemon=True)
+                        for number in range(self.workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, wait: bool = True):
+        """
+        Stop the workers once the queue is empty.
+
+        Args:
+            wait: Wait for the workers to finish
+
+        """
+        with self.lock:
+            self.running = False
+            self.has_jobs.notify_all()
+            self.has_room.notify_all()
+
+        if wait:
+            for thread in self.threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
+    def submit(self, channel: str, user: str, bot_command: str) -> bool:
+        """
+        Queue a command.
+
+        Args:
+            channel:     The channel the command came from
+            user:        The user who sent the command
+            bot_command: The command text
+
+        Returns:
+            Whether the command was queued
+
+        """
+        busy = stopped = False
+        with self.lock:
+            self.counts['submitted'] += 1
+
+            if self.depth >= self.queue_size:
+                if self.policy == BLOCK:
+                    self.counts['blocked'] += 1
+                    while self.depth >= self.queue_size and self.running:
+                        self.has_room.wait()
+                    if not self.running:
+                        # Stopped while waiting, nothing would run the command
+                        self.counts['rejected'] += 1
+                        stopped = True
+                elif self.policy == DROP_OLDEST:
+                    self.drop_oldest()
+                else:
+                    self.counts['rejected'] += 1
+                    busy = True
+
+            if not busy and not stopped:
+                self.enqueue(Job(channel, user, bot_command, time.monotonic()))
+
+        if stopped:
+            logger.warning('Dispatcher stopped, rejecting "%s" from channel %s', bot_command, channel)
+            return False
+
+        if busy:
+            logger.warning('Dispatch queue is full, rejecting "%s" from channel %s', bot_command, channel)
+            if self.on_busy is not None:
+                self.on_busy(channel, user, bot_command)
+            return False
+
+        return True
+
+    def enqueue(self, job: Job):
+        """
+        Add a job to its channel, the caller must hold the lock.
+
+        """
+        channel_jobs = self.pending.setdefault(job.channel, collections.deque())
+        channel_jobs.append(job)
+        if len(channel_jobs) == 1 and job.channel not in self.active:
+            self.ready.append(job.channel)
+
+        self.depth += 1
+        self.peak_depth = max(self.peak_depth, self.depth)
+        self.has_jobs.notify()
+
+    def drop_oldest(self):
+        """
+        Throw away the job that has waited the longest, the caller must hold
+        the lock.
+
+        """
+        # Every channel queue is in arrival order so the oldest job is at the head of one of them
+        channel = min((pending_channel for pending_channel, jobs in self.pending.items() if jobs),
+                      key=lambda pending_channel: self.pending[pending_channel][0].queued_at)
+        job = self.pending[channel].popleft()
+        if not self.pending[channel]:
+            del self.pending[channel]
+            if channel not in self.active:
+                self.ready.remove(channel)
+
+        self.depth -= 1
+        self.counts['dropped'] += 1
+        logger.warning('Dispatch queue is full, dropped "%s" from channel %s', job.bot_command, job.channel)
+
+    def next_job(self) -> typing.Optional[Job]:
+        """
+        Wait for a job from a channel that has nothing running.
+
+        Returns:
+            The next job or None once the dispatcher has stopped and the queue is empty
+
+        """
+        with self.lock:
+            while not self.ready:
+                if not self.running:
+                    return None
+                self.has_jobs.wait()
+
+            channel = self.ready.popleft()
+            job = self.pending[channel].popleft()
+            self.active.add(channel)
+            self.depth -= 1
+            self.has_room.notify()
+
+        return job
+
+    def finish_job(self, job: Job):
+        """
+        Let the next job from the same channel run.
+
+        """
+        with self.lock:
+            self.active.discard(job.channel)
+            if self.pending.get(job.channel):
+                self.ready.append(job.channel)
+                self.has_jobs.notify()
+            else:
+                self.pending.pop(job.channel, None)
+
+    def work(self):
+        """
+        Run jobs until the dispatcher stops.
+
+        """
+        while True:
+            job = self.next_job()
+            if job is None:
+                return
+
+            wait = time.monotonic() - job.queued_at
+            with self.lock:
+                self.counts['started'] += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+            try:
+                self.handler(job.channel, job.user, job.bot_command)
+            except Exception:
+                logger.exception('Error while handling command "%s" in channel %s', job.bot_command, job.channel)
+            finally:
+                self.finish_job(job)
+
+            with self.lock:
+                self.counts['completed'] += 1
+
+    def metrics(self) -> dict:
+        """
+        Get a snapshot of the queue.
+
+        """
+        with self.lock:
+            started = self.counts['started']
+            return {
+                'queue_depth': self.depth,
+                'queue_peak_depth': self.peak_depth,
+                'queue_size': self.queue_size,
+                'active': len(self.active),
+                'submitted': self.counts['submitted'],
+                'completed': self.counts['completed'],
+                'blocked': self.counts['blocked'],
+                'dropped': self.counts['dropped'],
+                'rejected': self.counts['rejected'],
+                'wait_seconds_total': self.total_wait,
+                'wait_seconds_max': self.max_wait,
+                'wait_seconds_avg': self.total_wait / started if started else 0.0,
+            }
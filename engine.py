@@ -0,0 +1,209 @@
+"""
+asyncio engine for the mattbot
+
+The engine drives a MattBot from an event loop. The websocket is read when
+the loop reports it readable, every command runs in its own task and Web API
+calls are made off the loop so one slow call never stalls another user.
+
+"""
+import asyncio
+import functools
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+READ_WEBSOCKET_TIMEOUT = 1  # Check whether the bot is still living at least this often
+MAX_WORKERS = 8  # Threads available to blocking Web API calls and synchronous commands
+
+
+class AsyncEngine:
+    """
+    Run a bot on an asyncio event loop
+
+    """
+    def __init__(self, bot, loop: asyncio.AbstractEventLoop = None, max_workers: int = MAX_WORKERS,
+                 executor: ThreadPoolExecutor = None) -> None:
+        """
+        Initialize the engine
+
+        Args:
+            bot:         An instance of the MattBot
+            loop:        The event loop to run on, a new one by default
+            max_workers: The number of threads for blocking calls
+            executor:    The threads for blocking calls, shared with other
+                         engines on the same loop, a new pool by default
+
+        """
+        self.bot = bot
+        self.loop = loop or asyncio.new_event_loop()
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+        self.tasks = set()
+
+    def run(self):
+        """
+        Run the bot until it dies.
+
+        """
+        asyncio.set_event_loop(self.loop)
+        self.loop.set_default_executor(self.executor)
+        if self.bot.metrics_server is not None:
+            self.bot.metrics_server.start()
+        if self.bot.outbound is not None:
+            self.bot.outbound.start()
+        self.bot.settings.start()
+
+        try:
+            self.loop.run_until_complete(self.listen())
+        finally:
+            self.loop.run_until_complete(self.drain())
+            self.executor.shutdown(wait=True)
+            # Anything the last commands said still gets posted
+            if self.bot.outbound is not None:
+                self.bot.outbound.stop()
+            self.bot.settings.stop()
+            if self.bot.metrics_server is not None:
+                self.bot.metrics_server.stop()
+
+    async def listen(self):
+        """
+        Read events from the fire hose until the bot dies.
+
+        """
+        while self.bot.living:
+            with self.bot.metrics.rtm_read.time():
+                slack_rtm_output = self.bot.rtm_read()
+            if slack_rtm_output:
+                with self.bot.metrics.batch.time():
+                    self.dispatch_batch(slack_rtm_output)
+
+            if self.bot.dropped:
+                # Reconnecting sleeps between attempts, keep that off the loop
+                await self.loop.run_in_executor(None, self.bot.reconnect)
+                continue
+
+            if slack_rtm_output:
+                # Give the new tasks a chance to start before reading again
+                await asyncio.sleep(0)
+                continue
+
+            if not await self.read_events(timeout=READ_WEBSOCKET_TIMEOUT):
+                self.bot.keep_alive()
+
+    async def read_events(self, timeout: float) -> bool:
+        """
+        Wait for the websocket to become readable without blocking the loop.
+
+        Args:
+            timeout: The longest time to wait in seconds
+
+        Returns:
+            Whether the websocket is ready to be read
+
+        """
+        sock = self.bot.get_websocket()
+        if sock is None:
+            await asyncio.sleep(timeout)
+            return False
+
+        # TLS can hold decrypted bytes that the loop will never report
+        pending = getattr(sock, 'pending', None)
+        if pending is not None and pending():
+            return True
+
+        readable = self.loop.create_future()
+
+        def on_readable():
+            # The loop keeps calling back until the reader is removed
+            if not readable.done():
+                readable.set_result(True)
+
+        self.loop.add_reader(sock, on_readable)
+        try:
+            return await asyncio.wait_for(readable, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.loop.remove_reader(sock)
+
+    def dispatch_batch(self, slack_rtm_output: list):
+        """
+        Classify a batch of events and start a task for every command.
+
+        Args:
+            slack_rtm_output: The events read from the fire hose
+
+        """
+        pending_commands = []
+        for output in slack_rtm_output:
+            bot_command = self.bot.classify_event(output)
+            if (bot_command is not None and not self.bot.is_duplicate(output)
+                    and self.bot.admit(*bot_command, backlog=len(self.tasks))):
+                pending_commands.append(bot_command)
+
+        for channel, user, bot_command in pending_commands:
+            self.spawn(self.handle_command(channel, user, bot_command))
+
+        return self.bot.record_batch(seen=len(slack_rtm_output), dispatched=len(pending_commands))
+
+    def spawn(self, coroutine):
+        """
+        Start a task and keep track of it until it is done.
+
+        """
+        task = asyncio.ensure_future(coroutine, loop=self.loop)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def drain(self):
+        """
+        Wait for every command that is still running.
+
+        """
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def handle_command(self, channel, user, bot_command):
+        """
+        The asynchronous twin of MattBot.handle_command
+
+        """
+        try:
+            command_type, handler, parameters = self.bot.resolve_command(channel, user, bot_command)
+            if handler is not None:
+                started = time.perf_counter()
+                try:
+                    result = await handler.run_async(parameters)
+                except Exception:
+                    self.bot.record_command(handler, 'error', time.perf_counter() - started)
+                    raise
+                finally:
+                    # Commands on the loop are counted but cannot be put under cProfile
+                    if self.bot.profiler is not None:
+                        self.bot.profiler.command_finished()
+
+                self.bot.record_command(handler, 'ok' if result is None or result else 'failed',
+                                        time.perf_counter() - started)
+                return result
+
+            self.bot.record_command(None, 'unknown')
+            response = self.bot.unknown_command_response(command_type)
+            # Queued like every other reply, off the loop in case the bot posts directly
+            await self.loop.run_in_executor(None, self.bot.post_message, channel, response)
+        except Exception:
+            logger.exception('Error while handling command "%s" in channel %s', bot_command, channel)
+
+    async def api_call(self, method: str, **parameters) -> dict:
+        """
+        Call the Slack Web API without blocking the loop.
+
+        Args:
+            method:     The API method to call
+            parameters: The arguments of the call
+
+        """
+        api_call = functools.partial(self.bot.api_call, method, **parameters)
+        return await self.loop.run_in_executor(None, api_call)
@@ -0,0 +1,116 @@
+"""
+Ingest pre-filter for the mattbot
+
+Most of the fire hose is presence changes, typing indicators, reactions and
+chatter the bot never answers. Every raw frame is scanned for its event
+types and for the markers of a command before it is decoded, and only the
+frames that might matter are decoded at all.
+
+The scan errs on the side of keeping a frame, classify_event still makes
+the final call on every frame that gets through. A frame is kept when
+
+- any of its types is one the bot handles, like goodbye or the directory
+  events, or
+- it is a message that mentions the bot, carries a file or is in an IM,
+  and is not from a channel the bot ignores, see the subscriptions module.
+
+JSON is decoded with orjson when it is installed.
+
+"""
+import json
+import re
+import typing
+
+from subscriptions import LISTEN
+
+if typing.TYPE_CHECKING:
+    from subscriptions import Subscriptions
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+TYPE = 'type'  # A frame without any type the bot handles
+CHATTER = 'chatter'  # A message that is not a command
+IGNORED = 'ignored'  # A message from a channel the bot ignores
+
+TYPE_PATTERN = re.compile(rb'"type"\s*:\s*"([^"\\]*)"')
+CHANNEL_PATTERN = re.compile(rb'"channel"\s*:\s*"([^"\\]*)"')
+FILE_MARKER = b'"file"'
+MESSAGE = b'message'
+
+
+def loads(frame: typing.Union[bytes, str]):
+    if orjson is not None:
+        return orjson.loads(frame)
+
+    return json.loads(frame)
+
+
+class Prefilter:
+    """
+    Decides from the raw bytes whether a frame is worth decoding
+
+    """
+    def __init__(self, event_types: typing.Iterable[str], ims: typing.Container,
+                 subscriptions: 'Subscriptions' = None) -> None:
+        """
+        Initialize the filter
+
+        Args:
+            event_types:   The event types other than message the bot handles
+            ims:           The IM channel ids, checked as they change
+            subscriptions: The channels the bot ignores, checked as they
+                           change
+
+        """
+        self.event_types = frozenset(event_type.encode() for event_type in event_types)
+        self.ims = ims
+        self.subscriptions = subscriptions
+        self.mention = None  # Every message is kept until the bot knows its own id
+        self.listen_command = None
+
+    def set_user_id(self, user_id: typing.Optional[str]):
+        self.mention = f'<@{user_id}>'.encode() if user_id else None
+        # Mentioned in a channel or first thing in an IM
+        self.listen_command = re.compile(
+            rb'(?:' + re.escape(self.mention) + rb'\s*|"text"\s*:\s*")' + LISTEN.encode() + rb'\b',
+            re.IGNORECASE) if user_id else None
+
+    def check(self, frame: bytes) -> typing.Optional[str]:
+        """
+        Check whether a frame might hold an event the bot acts on.
+
+        Args:
+            frame: A raw text frame from the websocket
+
+        Returns:
+            None when the frame should be decoded, otherwise why it was not
+
+        """
+        types = TYPE_PATTERN.findall(frame)
+        if not self.event_types.isdisjoint(types):
+            return None
+
+        if MESSAGE not in types:
+            return TYPE
+
+        if self.mention is None:
+            return None
+
+        channels = None
+        if self.subscriptions:
+            channels = CHANNEL_PATTERN.findall(frame)
+            if (channels and all(map(self.subscriptions.is_ignored, channels))
+                    and not self.listen_command.search(frame)):
+                return IGNORED
+
+        if self.mention in frame or FILE_MARKER in frame:
+            return None
+
+        for channel in channels if channels is not None else CHANNEL_PATTERN.findall(frame):
+            if channel.decode() in self.ims:
+                return None
+
+        return CHATTER
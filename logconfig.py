@@ -0,0 +1,158 @@
+"""
+Logging setup for the mattbot
+
+Records are handed to a queue and written by a background thread, so the
+threads that read the fire hose and run commands never wait on stdout.
+Formatting happens on the writer thread too, a record is only formatted
+once it is known to be written and never for a level that is disabled.
+
+Every record is written as one compact JSON line with the time, level,
+logger and message, plus anything passed in extra, so the logs can be
+searched by channel or user:
+
+    logger.info('Handled %s', command, extra={'channel': channel, 'user': user})
+
+Debug records can be sampled, only every nth record from the same line of
+code is kept, so debugging a busy bot does not flood the logs.
+
+JSON is encoded with orjson when it is installed.
+
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import typing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+DEFAULT_LEVEL = 'INFO'
+
+# Attributes every record has, anything else on a record came from extra
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def dumps(document: dict) -> str:
+    if orjson is not None:
+        return orjson.dumps(document, default=str).decode()
+
+    return json.dumps(document, default=str, separators=(',', ':'))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format a record as one JSON line
+
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        document = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(
+                timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                document[key] = value
+
+        if record.exc_info:
+            document['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            document['exc'] = record.exc_text
+
+        return dumps(document)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keep every nth debug record from each line of code, and every record
+    above debug
+
+    """
+    def __init__(self, every: int) -> None:
+        super().__init__()
+        self.every = every
+        self.seen = {}  # (path, line) -> records seen
+        # Every thread that logs runs the filter
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or self.every <= 1:
+            return True
+
+        # The number of logging call sites is fixed, so this stays small
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            seen = self.seen.get(key, 0)
+            self.seen[key] = seen + 1
+        return seen % self.every == 0
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue records as they are, leaving them to be formatted by the writer
+
+    The stock handler formats every record on the thread that logs it.
+    Arguments are formatted later, log values rather than objects that keep
+    changing.
+
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class Writer(logging.handlers.QueueListener):
+    """
+    Write queued records on a background thread, stopping it twice is fine
+
+    """
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def setup(level: typing.Union[int, str] = DEFAULT_LEVEL, stream: typing.TextIO = None,
+          sample_debug: int = 1) -> Writer:
+    """
+    Send every log record through a queue to a JSON line writer.
+
+    Args:
+        level:        The lowest level logged, a name or a number
+        stream:       Where to write the lines, stderr by default
+        sample_debug: Keep one in this many debug records from each line
+                      of code
+
+    Returns:
+        The listener writing the records, it is stopped at exit
+
+    """
+    writer = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    writer.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    handler = DeferredQueueHandler(log_queue)
+    # Sampling happens before queueing, dropped records cost nothing more
+    if sample_debug > 1:
+        handler.addFilter(SampleFilter(sample_debug))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level.upper() if isinstance(level, str) else level)
+
+    listener = Writer(log_queue, writer, respect_handler_level=True)
+    listener.start()
+    # Write what is still queued before the interpreter goes
+    atexit.register(listener.stop)
+
+    return listener
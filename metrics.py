@@ -0,0 +1,446 @@
+"""
+Metrics for the mattbot
+
+Counters and latency histograms are cheap enough to update on every event.
+Histograms keep HDR style log-linear buckets, a fixed number of buckets for
+every power of two, so percentiles stay within a few percent from
+microseconds to minutes without keeping every sample.
+
+Metrics are exposed in the Prometheus text format on a local HTTP port and
+summarized in chat by the stats command.
+
+"""
+import collections
+import http.server
+import logging
+import threading
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+SUB_BUCKET_BITS = 5  # 16 buckets per power of two, within about 3%
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS // 2
+UNIT = 1e-6  # Histograms record whole microseconds
+
+# The le buckets Prometheus gets from each histogram, in seconds
+PROMETHEUS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def bucket_index(value: int) -> int:
+    """
+    Get the bucket a whole number of units goes in.
+
+    """
+    if value < SUB_BUCKETS:
+        return value
+
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKETS + (shift - 1) * HALF_SUB_BUCKETS + (value >> shift) - HALF_SUB_BUCKETS
+
+
+def bucket_upper_bound(index: int) -> int:
+    """
+    Get the largest whole number of units in a bucket.
+
+    """
+    if index < SUB_BUCKETS:
+        return index
+
+    shift, top = divmod(index - SUB_BUCKETS, HALF_SUB_BUCKETS)
+    shift += 1
+    return ((top + HALF_SUB_BUCKETS + 1) << shift) - 1
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+
+    pairs = ','.join('{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                     for key, value in labels.items())
+    return f'{{{pairs}}}'
+
+
+def render_registries(registries: typing.Sequence['MetricsRegistry']) -> str:
+    """
+    Render the metrics of several registries in the Prometheus text format,
+    every family once with the samples of all of them.
+
+    """
+    families = collections.OrderedDict()
+    for registry in registries:
+        for name, metric in registry.metrics.items():
+            families.setdefault(name, []).append((metric, registry.constant_labels))
+
+    lines = []
+    for name, members in families.items():
+        metric = members[0][0]
+        lines.append(f'# HELP {name} {metric.help_text}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        for metric, constant_labels in members:
+            lines.extend(metric.render(constant_labels))
+
+    return '\n'.join(lines) + '\n'
+
+
+class CounterValue:
+    """
+    One labelled counter
+
+    """
+    __slots__ = ('value', 'lock')
+
+    def __init__(self) -> None:
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self.lock:
+            self.value += amount
+
+
+class HistogramValue:
+    """
+    One labelled histogram
+
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max', 'lock')
+
+    def __init__(self) -> None:
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        index = bucket_index(int(seconds / UNIT))
+        with self.lock:
+            self.buckets[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def time(self) -> 'Timer':
+        """
+        Time a block of code into the histogram.
+
+        """
+        return Timer(self)
+
+    def snapshot(self) -> tuple:
+        with self.lock:
+            return sorted(self.buckets.items()), self.count, self.total, self.max
+
+    def percentile(self, percent: float) -> float:
+        """
+        Get a percentile in seconds, 0 when nothing has been recorded.
+
+        """
+        buckets, count, _, maximum = self.snapshot()
+        if not count:
+            return 0.0
+
+        wanted = count * percent / 100
+        seen = 0
+        for index, bucket_count in buckets:
+            seen += bucket_count
+            if seen >= wanted:
+                return min(bucket_upper_bound(index) * UNIT, maximum)
+
+        return maximum
+
+
+class Timer:
+    """
+    Records the time spent in a with block
+
+    """
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram: HistogramValue) -> None:
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Metric:
+    """
+    A named family of values, one for each set of label values
+
+    """
+    kind = None
+    value_class = None
+
+    def __init__(self, name: str, help_text: str, label_names: typing.Sequence[str] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self.lock = threading.Lock()
+        if not self.label_names:
+            self.default = self.labels()
+
+    def labels(self, *label_values):
+        """
+        Get the value for a set of label values, in label name order.
+
+        """
+        value = self.values.get(label_values)
+        if value is None:
+            with self.lock:
+                value = self.values.setdefault(label_values, self.value_class())
+
+        return value
+
+    def items(self) -> list:
+        with self.lock:
+            return [(dict(zip(self.label_names, label_values)), value)
+                    for label_values, value in self.values.items()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+    value_class = CounterValue
+
+    def inc(self, amount: float = 1):
+        self.default.inc(amount)
+
+    def render(self, constant_labels: dict) -> typing.Iterator[str]:
+        for labels, value in self.items():
+            yield f'{self.name}{format_labels(dict(constant_labels, **labels))} {value.value}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+    value_class = HistogramValue
+
+    def observe(self, seconds: float):
+        self.default.observe(seconds)
+
+    def time(self) -> Timer:
+        return self.default.time()
+
+    def render(self, constant_labels: dict) -> typing.Iterator[str]:
+        for labels, value in self.items():
+            labels = dict(constant_labels, **labels)
+            buckets, count, total, _ = value.snapshot()
+
+            cumulative = 0
+            remaining = iter(buckets)
+            pending = next(remaining, None)
+            for bound in PROMETHEUS_BUCKETS:
+                while pending is not None and bucket_upper_bound(pending[0]) * UNIT <= bound:
+                    cumulative += pending[1]
+                    pending = next(remaining, None)
+                yield f'{self.name}_bucket{format_labels(dict(labels, le=bound))} {cumulative}'
+
+            yield f'{self.name}_bucket{format_labels(dict(labels, le="+Inf"))} {count}'
+            yield f'{self.name}_sum{format_labels(labels)} {total}'
+            yield f'{self.name}_count{format_labels(labels)} {count}'
+
+
+class Gauge(Metric):
+    """
+    A value read from a callback when the metrics are collected, the
+    callback returns a number or a dict of label values to numbers
+
+    """
+    kind = 'gauge'
+
+    def __init__(self, name: str, help_text: str, callback: typing.Callable, label_name: str = None) -> None:
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.label_name = label_name
+
+    def render(self, constant_labels: dict) -> typing.Iterator[str]:
+        try:
+            value = self.callback()
+        except Exception:
+            logger.exception('Could not collect %s', self.name)
+            return
+
+        if not isinstance(value, dict):
+            yield f'{self.name}{format_labels(constant_labels)} {value}'
+            return
+
+        for label_value, sample in value.items():
+            labels = dict(constant_labels, **{self.label_name: label_value})
+            yield f'{self.name}{format_labels(labels)} {sample}'
+
+
+class MetricsRegistry:
+    """
+    The metrics of one bot
+
+    """
+    def __init__(self, constant_labels: dict = None) -> None:
+        """
+        Initialize the registry
+
+        Args:
+            constant_labels: Labels added to every sample, the workspace for example
+
+        """
+        self.constant_labels = dict(constant_labels or {})
+        self.metrics = collections.OrderedDict()
+        self.started_at = time.time()
+
+    def add(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str, label_names: typing.Sequence[str] = ()) -> Counter:
+        return self.add(Counter(name, help_text, label_names))
+
+    def histogram(self, name: str, help_text: str, label_names: typing.Sequence[str] = ()) -> Histogram:
+        return self.add(Histogram(name, help_text, label_names))
+
+    def gauge(self, name: str, help_text: str, callback: typing.Callable, label_name: str = None) -> Gauge:
+        return self.add(Gauge(name, help_text, callback, label_name))
+
+    def remove(self, name: str) -> typing.Optional[Metric]:
+        return self.metrics.pop(name, None)
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text format.
+
+        """
+        return render_registries([self])
+
+
+class BotMetrics(MetricsRegistry):
+    """
+    The metrics every bot keeps
+
+    """
+    def __init__(self, constant_labels: dict = None) -> None:
+        super().__init__(constant_labels)
+
+        self.events = self.counter('mattbot_events_total', 'RTM events read by outcome', ['outcome'])
+        self.rtm_read = self.histogram('mattbot_rtm_read_seconds', 'Time spent in rtm_read')
+        self.batch = self.histogram('mattbot_batch_seconds', 'Time spent parsing a batch of RTM events')
+        self.commands = self.counter('mattbot_commands_total', 'Commands handled by command and outcome',
+                                     ['command', 'outcome'])
+        self.command_latency = self.histogram('mattbot_command_seconds', 'Time spent running a command',
+                                              ['command'])
+        self.api_calls = self.counter('mattbot_api_calls_total', 'Web API calls by method and outcome',
+                                      ['method', 'outcome'])
+        self.api_latency = self.histogram('mattbot_api_seconds', 'Web API call latency', ['method'])
+        self.throttled = self.counter('mattbot_throttled_total', 'Commands rejected by the throttle by reason',
+                                      ['reason'])
+        self.filtered = self.counter('mattbot_frames_filtered_total',
+                                     'RTM frames dropped before decoding by reason', ['reason'])
+        self.duplicates = self.counter('mattbot_duplicates_total', 'Command events suppressed as duplicates')
+        self.connects = self.counter('mattbot_connects_total', 'RTM connection attempts by outcome', ['outcome'])
+        self.reconnects = self.counter('mattbot_reconnects_total', 'RTM connections restored after a drop')
+        self.downtime = self.histogram('mattbot_downtime_seconds', 'Time without an RTM connection after a drop')
+
+    def summary(self) -> str:
+        """
+        Summarize the metrics for people.
+
+        """
+        uptime = int(time.time() - self.started_at)
+        events = {labels['outcome']: value.value for labels, value in self.events.items()}
+        lines = [f'Up {uptime // 3600}h {uptime // 60 % 60}m, '
+                 f'{events.get("seen", 0)} events seen, {events.get("dispatched", 0)} dispatched, '
+                 f'{events.get("skipped", 0)} skipped, {self.duplicates.default.value} duplicates, '
+                 f'{sum(value.value for _, value in self.throttled.items())} throttled',
+                 f'rtm_read p50 {self.rtm_read.default.percentile(50) * 1000:.1f}ms, '
+                 f'batch p99 {self.batch.default.percentile(99) * 1000:.1f}ms, '
+                 f'{sum(value.value for _, value in self.filtered.items())} frames filtered before decoding']
+
+        downtime = self.downtime.default
+        if downtime.count:
+            lines.append(f'Reconnected {downtime.count} times, down {downtime.total:.1f}s in total, '
+                         f'{downtime.max:.1f}s at most')
+
+        outcomes = collections.defaultdict(collections.Counter)
+        for labels, value in self.commands.items():
+            outcomes[labels['command']][labels['outcome']] += value.value
+
+        for labels, value in sorted(self.command_latency.items(), key=lambda item: item[0]['command']):
+            command = labels['command']
+            lines.append(f'{command}: {value.count} runs, {outcomes[command]["error"]} errors, '
+                         f'p50 {value.percentile(50) * 1000:.1f}ms, p99 {value.percentile(99) * 1000:.1f}ms')
+
+        api_errors = collections.Counter()
+        for labels, value in self.api_calls.items():
+            if labels['outcome'] != 'ok':
+                api_errors[labels['method']] += value.value
+
+        for labels, value in sorted(self.api_latency.items(), key=lambda item: item[0]['method']):
+            method = labels['method']
+            lines.append(f'{method}: {value.count} calls, {api_errors[method]} errors, '
+                         f'p50 {value.percentile(50) * 1000:.1f}ms, p99 {value.percentile(99) * 1000:.1f}ms')
+
+        return '\n'.join(lines)
+
+
+class MetricsServer:
+    """
+    Serve metrics in the Prometheus text format over HTTP
+
+    """
+    def __init__(self, registries: typing.Sequence[MetricsRegistry], host: str = '127.0.0.1', port: int = 9105) -> None:
+        """
+        Initialize the server
+
+        Args:
+            registries: The registries to serve together
+            host:       The address to listen on, local only by default
+            port:       The port to listen on
+
+        """
+        self.registries = list(registries)
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+
+    def render(self) -> str:
+        return render_registries(self.registries)
+
+    def start(self):
+        """
+        Start serving from a background thread.
+
+        """
+        metrics_server = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = metrics_server.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug('metrics: ' + format, *args)
+
+        self.server = http.server.ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='mattbot-metrics', daemon=True)
+        self.thread.start()
+        logger.info('Serving metrics on http://%s:%s/metrics', self.host, self.port)
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
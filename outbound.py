@@ -0,0 +1,345 @@
+"""
+Outbound message queue for the mattbot
+
+Commands hand their messages to the queue and carry on. A sender thread
+posts them while keeping every channel under Slack's rate limit of about one
+message per second. Messages that pile up for a channel are merged into a
+single post, and a ratelimited response pauses the channel for as long as
+Slack asks. While the bot is reconnecting the whole queue is paused and
+messages are held until it is back.
+
+"""
+import collections
+import logging
+import threading
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+MESSAGES_PER_SECOND = 1.0  # Per channel
+BURST = 3  # Messages a quiet channel may send back to back
+MAX_MESSAGE_LENGTH = 4000  # Slack truncates longer messages, do not merge past this
+DEFAULT_RETRY_AFTER = 1.0  # Seconds to back off when Slack does not say
+
+
+class TokenBucket:
+    """
+    A token bucket that refills at a steady rate up to its capacity
+
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at', 'paused_until')
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        """
+        Initialize the bucket
+
+        Args:
+            rate:     Tokens added per second
+            capacity: The most tokens the bucket holds, the size of a burst
+
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def refill(self, now: float):
+        # A time read before the bucket was made must not take tokens away
+        if now > self.updated_at:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+    def wait_time(self, cost: float = 1.0, now: float = None) -> float:
+        """
+        Get how long until the bucket holds enough tokens.
+
+        Args:
+            cost: The tokens needed
+            now:  The current monotonic time
+
+        """
+        now = time.monotonic() if now is None else now
+        self.refill(now)
+        refill_wait = max(cost - self.tokens, 0) / self.rate
+
+        return max(refill_wait, self.paused_until - now, 0.0)
+
+    def take(self, cost: float = 1.0, now: float = None) -> bool:
+        """
+        Take tokens from the bucket if it holds enough.
+
+        Returns:
+            Whether the tokens were taken
+
+        """
+        if self.wait_time(cost, now) > 0:
+            return False
+
+        self.tokens -= cost
+        return True
+
+    def pause(self, seconds: float):
+        """
+        Hold off taking anything for a while, after a ratelimited response.
+
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class OutboundMessage(collections.namedtuple('OutboundMessage', ['channel', 'text', 'parameters'])):
+    """
+    A message waiting to be posted.
+
+    """
+
+
+class OutboundQueue:
+    """
+    Post messages from a background thread within the per channel rate limit
+
+    """
+    def __init__(self, api_call: typing.Callable, rate: float = MESSAGES_PER_SECOND, burst: int = BURST,
+                 coalesce: bool = True) -> None:
+        """
+        Initialize the queue
+
+        Args:
+            api_call: Makes a Web API call, SlackClient.api_call for example
+            rate:     Messages per second allowed in each channel
+            burst:    Messages a quiet channel may send back to back
+            coalesce: Merge messages waiting for the same channel into one post
+
+        """
+        self.api_call = api_call
+        self.rate = rate
+        self.burst = burst
+        self.coalesce = coalesce
+
+        self.condition = threading.Condition()
+        self.pending = collections.OrderedDict()  # channel -> deque of messages
+        self.sending = None  # the channel of the message being posted
+        self.buckets = {}
+        self.running = False
+        self.paused = False
+        self.thread = None
+        self.counts = collections.Counter()
+
+    def start(self):
+        """
+        Start the sender thread.
+
+        """
+        with self.condition:
+            if self.running:
+                return
+            self.running = True
+
+        self.thread = threading.Thread(target=self.send_forever, name='mattbot-outbound', daemon=True)
+        self.thread.start()
+
+    def stop(self, wait: bool = True):
+        """
+        Stop the sender thread once everything queued has been posted.
+
+        Args:
+            wait: Wait for the queue to drain
+
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+
+        if wait and self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def pause(self):
+        """
+        Hold every message until resumed, while the bot is disconnected.
+
+        """
+        with self.condition:
+            self.paused = True
+
+    def resume(self):
+        """
+        Post the held messages.
+
+        """
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    def post(self, channel: str, text: str, **parameters) -> dict:
+        """
+        Queue a message for a channel.
+
+        Args:
+            channel:    The channel to post to
+            text:       The message
+            parameters: Other chat.postMessage parameters
+
+        Returns:
+            A response saying the message was queued
+
+        """
+        with self.condition:
+            self.pending.setdefault(channel, collections.deque()).append(
+                OutboundMessage(channel, str(text), parameters))
+            self.counts['queued'] += 1
+            self.condition.notify()
+
+        return {'ok': True, 'queued': True, 'channel': channel}
+
+    def wait_until_sent(self, channel: str, timeout: float = None) -> bool:
+        """
+        Wait until every message queued for a channel has been posted, before
+        leaving it for example.
+
+        Args:
+            channel: The channel to wait for
+            timeout: The longest time to wait in seconds
+
+        Returns:
+            Whether the channel was drained in time
+
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: channel not in self.pending and self.sending != channel,
+                                           timeout)
+
+    def depth(self) -> int:
+        """
+        Get the number of messages waiting to be posted.
+
+        """
+        with self.condition:
+            return sum(len(messages) for messages in self.pending.values())
+
+    def bucket(self, channel: str) -> TokenBucket:
+        bucket = self.buckets.get(channel)
+        if bucket is None:
+            bucket = self.buckets[channel] = TokenBucket(self.rate, self.burst)
+
+        return bucket
+
+    def next_message(self) -> typing.Optional[OutboundMessage]:
+        """
+        Wait until a channel with messages is allowed to post and take its
+        messages, merged into one when possible.
+
+        Returns:
+            The message to post, or None once the queue has stopped and is empty
+
+        """
+        with self.condition:
+            while True:
+                if not self.pending:
+                    if not self.running:
+                        return None
+                    self.condition.wait()
+                    continue
+
+                if self.paused and self.running:
+                    # Stopping posts what is held rather than dropping it
+                    self.condition.wait()
+                    continue
+
+                now = time.monotonic()
+                waits = {channel: self.bucket(channel).wait_time(now=now) for channel in self.pending}
+                channel = min(waits, key=waits.get)
+                if waits[channel] > 0:
+                    self.condition.wait(waits[channel])
+                    continue
+
+                self.bucket(channel).take(now=now)
+                self.sending = channel
+                return self.take_messages(channel)
+
+    def take_messages(self, channel: str) -> OutboundMessage:
+        """
+        Take the next message for a channel, merging the ones after it that
+        share its parameters, the caller must hold the condition.
+
+        """
+        messages = self.pending[channel]
+        message = messages.popleft()
+
+        if self.coalesce:
+            texts = [message.text]
+            length = len(message.text)
+            while messages and messages[0].parameters == message.parameters:
+                length += len(messages[0].text) + 1
+                if length > MAX_MESSAGE_LENGTH:
+                    break
+                texts.append(messages.popleft().text)
+
+            if len(texts) > 1:
+                self.counts['coalesced'] += len(texts) - 1
+                message = message._replace(text='\n'.join(texts))
+
+        if not messages:
+            del self.pending[channel]
+        else:
+            # Let other channels go first next time
+            self.pending.move_to_end(channel)
+
+        return message
+
+    def requeue(self, message: OutboundMessage):
+        """
+        Put a message back at the front of its channel.
+
+        """
+        with self.condition:
+            self.pending.setdefault(message.channel, collections.deque()).appendleft(message)
+            self.pending.move_to_end(message.channel, last=False)
+            self.condition.notify()
+
+    def send(self, message: OutboundMessage):
+        """
+        Post a message, backing the channel off when Slack rate limits it.
+
+        """
+        try:
+            response = self.api_call('chat.postMessage', channel=message.channel, text=message.text,
+                                     **message.parameters)
+        except Exception:
+            logger.exception('Could not post to channel %s', message.channel)
+            self.counts['failed'] += 1
+            return
+
+        if response.get('ok', False):
+            self.counts['sent'] += 1
+            return
+
+        if response.get('error') == 'ratelimited':
+            retry_after = float(response.get('retry_after') or DEFAULT_RETRY_AFTER)
+            logger.warning('Rate limited posting to channel %s, retrying in %s seconds', message.channel,
+                           retry_after)
+            self.counts['ratelimited'] += 1
+            with self.condition:
+                self.bucket(message.channel).pause(retry_after)
+            self.requeue(message)
+            return
+
+        logger.error('Could not post to channel %s: %s', message.channel, response.get('error', 'an error'))
+        self.counts['failed'] += 1
+
+    def send_forever(self):
+        """
+        Post messages until the queue stops.
+
+        """
+        while True:
+            message = self.next_message()
+            if message is None:
+                return
+
+            try:
+                self.send(message)
+            finally:
+                with self.condition:
+                    self.sending = None
+                    self.condition.notify_all()
@@ -0,0 +1,303 @@
+"""
+On demand profiling for the mattbot
+
+The profile command starts a profiler on a running bot for a number of
+seconds or commands, then uploads what it found to the channel that asked.
+
+Two kinds of profiler are available:
+
+    sample   - A background thread records the stack of every other thread
+               a few hundred times a second. The snippet holds the stacks in
+               the collapsed format flame graph tools read, with the
+               functions seen most often in the comment.
+    cprofile - Commands are run under cProfile and the snippet holds the
+               functions that took the longest. cProfile watches one thread
+               at a time, so a command that starts while another is being
+               profiled runs as usual and is only counted. Commands the
+               asyncio engine runs on its loop are counted but not profiled.
+
+Nothing is installed while no profiler is running, the bot only checks
+whether it has one.
+
+"""
+import collections
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+SAMPLE = 'sample'
+CPROFILE = 'cprofile'
+MODES = (SAMPLE, CPROFILE)
+
+SAMPLE_INTERVAL = 0.005  # Seconds between samples
+MAX_SECONDS = 600  # The longest a profiler may run
+TOP_FUNCTIONS = 10  # Functions listed in the comment of a sample profile
+STATS_LINES = 40  # Functions listed in a cProfile snippet
+
+AMOUNT = re.compile(r'^(\d+)\s*(s|sec|secs|seconds?|commands?)?$')
+
+
+def parse_request(parameters: str) -> tuple:
+    """
+    Parse what the profile command was asked for, like "sample 30s" or
+    "cprofile 20 commands".
+
+    Returns:
+        A (mode, seconds, commands) tuple, one of seconds and commands is None
+
+    Raises:
+        ValueError: With a message for the user when the request makes no sense
+
+    """
+    mode, _, amount = parameters.strip().partition(' ')
+    if mode not in MODES:
+        mode, amount = SAMPLE, parameters.strip()
+
+    match = AMOUNT.match(amount.strip() or '30s')
+    if match is None:
+        raise ValueError(f'"{amount}" is not a number of seconds like 30s or of commands like 20 commands')
+
+    number, unit = int(match.group(1)), match.group(2) or 'commands'
+    if number <= 0:
+        raise ValueError('I need something to profile for')
+
+    if unit.startswith('command'):
+        # Never leave a profiler behind when the commands stop coming
+        return mode, MAX_SECONDS, number
+
+    return mode, min(number, MAX_SECONDS), None
+
+
+def frame_name(code) -> str:
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+class Profiler:
+    """
+    Profile a bot until enough time has passed or commands have run
+
+    """
+    def __init__(self, bot, channel: str, mode: str = SAMPLE, seconds: float = None, commands: int = None,
+                 interval: float = SAMPLE_INTERVAL) -> None:
+        """
+        Initialize the profiler
+
+        Args:
+            bot:      The bot to profile
+            channel:  The channel to upload the results to
+            mode:     sample or cprofile, see the module docstring
+            seconds:  Stop after this many seconds
+            commands: Stop after this many commands
+            interval: Seconds between samples
+
+        """
+        if mode not in MODES:
+            raise ValueError(f'Unknown profiler {mode}, use one of {", ".join(MODES)}')
+
+        self.bot = bot
+        self.channel = channel
+        self.mode = mode
+        self.seconds = seconds
+        self.commands = commands
+        self.interval = interval
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.finished = False
+        self.uploaded = False
+        self.running = 0  # Commands being profiled right now
+        self.commands_seen = 0
+        self.started_at = None
+        self.elapsed = 0.0
+
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.profile = cProfile.Profile()
+        self.profiling = threading.Lock()  # Held by the one command under cProfile
+        self.profiled = 0
+        self.unprofiled = 0
+        self.threads = []
+
+    def start(self) -> bool:
+        """
+        Start profiling the bot.
+
+        Returns:
+            Whether it started, a bot runs one profiler at a time
+
+        """
+        with self.lock:
+            if self.bot.profiler is not None:
+                return False
+            self.bot.profiler = self
+            self.started_at = time.monotonic()
+
+        if self.mode == SAMPLE:
+            self.threads.append(threading.Thread(target=self.sample_forever, name='mattbot-sampler', daemon=True))
+        if self.seconds is not None:
+            self.threads.append(threading.Thread(target=self.finish_later, name='mattbot-profiler', daemon=True))
+
+        for thread in self.threads:
+            thread.start()
+
+        return True
+
+    def finish_later(self):
+        if not self.stopped.wait(self.seconds):
+            self.finish()
+
+    def run(self, handler, parameters: str):
+        """
+        Run a command, under cProfile when that is the profiler.
+
+        """
+        if self.mode != CPROFILE or self.finished or not self.profiling.acquire(blocking=False):
+            if self.mode == CPROFILE:
+                with self.lock:
+                    self.unprofiled += 1
+            try:
+                return handler.run(parameters)
+            finally:
+                self.command_finished()
+
+        with self.lock:
+            self.running += 1
+            self.profiled += 1
+        try:
+            return self.profile.runcall(handler.run, parameters)
+        finally:
+            self.profiling.release()
+            with self.lock:
+                self.running -= 1
+            self.command_finished()
+            # The profile stop command is profiled too, it uploads once it is done
+            self.upload_when_idle()
+
+    def command_finished(self):
+        """
+        Count a command, stopping once enough of them have run.
+
+        """
+        with self.lock:
+            self.commands_seen += 1
+            done = self.commands is not None and self.commands_seen >= self.commands
+
+        if done:
+            self.finish()
+
+    def finish(self):
+        """
+        Stop profiling and upload the results, right away or once the
+        command under cProfile is done with.
+
+        """
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+            self.elapsed = time.monotonic() - self.started_at
+            if self.bot.profiler is self:
+                self.bot.profiler = None
+
+        self.stopped.set()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+        self.upload_when_idle()
+
+    def upload_when_idle(self):
+        """
+        Upload the results once profiling has finished and no command is
+        under cProfile, whichever thread gets there last does it.
+
+        """
+        with self.lock:
+            if not self.finished or self.running or self.uploaded:
+                return
+            self.uploaded = True
+
+        try:
+            self.upload()
+        except Exception:
+            logger.exception('Could not upload the profile to channel %s', self.channel)
+
+    def sample_forever(self):
+        """
+        Record the stack of every thread but the profiler's own until it stops.
+
+        """
+        while not self.stopped.wait(self.interval):
+            own_ids = {thread.ident for thread in self.threads}
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id in own_ids:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed_stacks(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int = TOP_FUNCTIONS) -> list:
+        """
+        Get the functions seen running most often, not counting callers.
+
+        """
+        leaves = collections.Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rpartition(';')[2]] += count
+
+        return leaves.most_common(limit)
+
+    def report(self) -> typing.Tuple[str, str, str]:
+        """
+        Build the results.
+
+        Returns:
+            The snippet file name, its content and a comment about it
+
+        """
+        what = f'{self.elapsed:.1f} seconds and {self.commands_seen} commands'
+
+        if self.mode == SAMPLE:
+            total = sum(self.stacks.values()) or 1
+            top = '\n'.join(f'{count * 100 / total:5.1f}% {name}' for name, count in self.top_functions())
+            comment = f'Sampled {self.samples} times over {what}, busiest functions:\n```{top}```'
+            return f'mattbot-{int(time.time())}.collapsed', self.collapsed_stacks(), comment
+
+        output = io.StringIO()
+        if self.profiled:
+            stats = pstats.Stats(self.profile, stream=output)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(STATS_LINES)
+        else:
+            output.write('No commands ran while profiling.\n')
+
+        comment = f'cProfile of {what}'
+        if self.unprofiled:
+            comment += f', {self.unprofiled} ran while another was profiled and are left out'
+
+        return f'mattbot-{int(time.time())}.pstats.txt', output.getvalue(), comment
+
+    def upload(self):
+        file_name, content, comment = self.report()
+        response = self.bot.api_call('files.upload', channels=self.channel, content=content, filename=file_name,
+                                     filetype='text', initial_comment=comment)
+        if not response.get('ok', False):
+            self.bot.post_message(self.channel, f'I could not upload the profile: {response.get("error", "an error")}')
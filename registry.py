@@ -0,0 +1,234 @@
+"""
+Command registry for the mattbot
+
+The registry is built once when the bot starts. It maps normalized command
+names and aliases to their handler classes and keeps a BK-tree of the names
+so a mistyped command gets a "did you mean" suggestion.
+
+A registry built from the command manifest only holds class names until a
+command is first used, then its class is loaded and kept.
+
+"""
+import inspect
+import logging
+import typing
+
+logger = logging.getLogger(__name__)
+
+COMMAND_SUFFIX = 'Command'
+
+
+def normalize(name: str) -> str:
+    """
+    Normalize a command name for lookups.
+
+    Args:
+        name: The command name as typed by the user
+
+    """
+    return name.strip().lower()
+
+
+def command_name(command_class: typing.Union[type, str]) -> str:
+    """
+    Get the name users type to run a command class, HelloCommand is hello.
+
+    Args:
+        command_class: The command class or its name
+
+    """
+    class_name = command_class if isinstance(command_class, str) else command_class.__name__
+    if class_name.endswith(COMMAND_SUFFIX):
+        class_name = class_name[:-len(COMMAND_SUFFIX)]
+
+    return normalize(class_name)
+
+
+def edit_distance(first: str, second: str) -> int:
+    """
+    Get the Levenshtein distance between two strings.
+
+    """
+    if len(first) < len(second):
+        first, second = second, first
+
+    previous = list(range(len(second) + 1))
+    for row, first_character in enumerate(first, 1):
+        current = [row]
+        for column, second_character in enumerate(second, 1):
+            current.append(min(previous[column] + 1,
+                               current[column - 1] + 1,
+                               previous[column - 1] + (first_character != second_character)))
+        previous = current
+
+    return previous[-1]
+
+
+class BKTree:
+    """
+    A Burkhard-Keller tree of words for finding every word within an edit
+    distance of a query without comparing against all of them.
+
+    """
+    def __init__(self, words: typing.Iterable[str] = ()) -> None:
+        self.root = None
+        for word in words:
+            self.add(word)
+
+    def add(self, word: str):
+        """
+        Add a word to the tree.
+
+        """
+        if self.root is None:
+            self.root = (word, {})
+            return
+
+        node_word, children = self.root
+        while True:
+            distance = edit_distance(word, node_word)
+            if distance == 0:
+                return
+
+            child = children.get(distance)
+            if child is None:
+                children[distance] = (word, {})
+                return
+
+            node_word, children = child
+
+    def search(self, word: str, max_distance: int) -> list:
+        """
+        Find every word within the given distance of a word.
+
+        Returns:
+            A list of (distance, word) tuples, closest first
+
+        """
+        if self.root is None:
+            return []
+
+        matches = []
+        candidates = [self.root]
+        while candidates:
+            node_word, children = candidates.pop()
+            distance = edit_distance(word, node_word)
+            if distance <= max_distance:
+                matches.append((distance, node_word))
+
+            # The triangle inequality rules out every other branch
+            for child_distance, child in children.items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    candidates.append(child)
+
+        return sorted(matches)
+
+
+class CommandRegistry:
+    """
+    Map command names and aliases to their handler classes
+
+    """
+    def __init__(self, command_classes: typing.Iterable[type] = (), loader: typing.Callable = None) -> None:
+        """
+        Initialize the registry
+
+        Args:
+            command_classes: The command classes to register
+            loader:          Loads a command class from its name, for commands
+                             registered lazily
+
+        """
+        self.handlers = {}  # alias -> command class, or its name until it is loaded
+        self.names = []
+        self.index = BKTree()
+        self.loader = loader
+
+        for command_class in command_classes:
+            self.register(command_class)
+
+    @classmethod
+    def from_module(cls, module, base_class: type) -> 'CommandRegistry':
+        """
+        Build a registry from every command class in a module.
+
+        Args:
+            module:     The module to look for commands in
+            base_class: The class every command extends, it is not registered itself
+
+        """
+        command_classes = [member for _, member in inspect.getmembers(module, inspect.isclass)
+                           if issubclass(member, base_class) and member is not base_class]
+
+        return cls(command_classes)
+
+    @classmethod
+    def from_manifest(cls, manifest: dict, loader: typing.Callable) -> 'CommandRegistry':
+        """
+        Build a registry that loads each command class the first time it is used.
+
+        Args:
+            manifest: Command class names mapped to their module and aliases
+            loader:   Loads a command class from its name
+
+        """
+        registry = cls(loader=loader)
+        for class_name, entry in manifest.items():
+            registry.register(class_name, aliases=entry.get('aliases', ()))
+
+        return registry
+
+    def register(self, command_class: typing.Union[type, str], aliases: typing.Iterable[str] = None):
+        """
+        Register a command class, or the name of one to load later, under its
+        name and aliases.
+
+        """
+        if aliases is None:
+            aliases = getattr(command_class, 'aliases', ())
+
+        name = command_name(command_class)
+        self.names.append(name)
+        self.names.sort()
+
+        for alias in (name,) + tuple(aliases):
+            alias = normalize(alias)
+            if alias in self.handlers and self.handlers[alias] != command_class:
+                logger.warning('Command %s is already registered to %s, replacing it with %s',
+                               alias, self.handlers[alias], command_class)
+
+            self.handlers[alias] = command_class
+            self.index.add(alias)
+
+    def get(self, name: str) -> typing.Optional[type]:
+        """
+        Get the handler class for a command name or alias.
+
+        """
+        handler = self.handlers.get(normalize(name))
+        if not isinstance(handler, str):
+            return handler
+
+        class_name = handler
+        handler = self.loader(class_name)
+        for alias, registered in self.handlers.items():
+            if registered == class_name:
+                self.handlers[alias] = handler
+
+        return handler
+
+    def suggest(self, name: str, limit: int = 3) -> list:
+        """
+        Suggest registered commands close to a mistyped one.
+
+        Args:
+            name:  The unknown command
+            limit: The most suggestions to return
+
+        """
+        name = normalize(name)
+        # Allow one typo in short names and two in longer ones
+        max_distance = 1 if len(name) < 5 else 2
+        matches = self.index.search(name, max_distance)
+
+        return [match for _, match in matches[:limit]]
@@ -0,0 +1,297 @@
+"""
+Settings for the mattbot
+
+Settings are kept for a whole workspace, for a channel or for a user. A
+command reads the most specific one there is, the user's before the
+channel's before the workspace's.
+
+Every setting is held in memory, so reading one is a dictionary lookup and
+never waits on the disk. Changes are written behind to a local SQLite file
+by a background thread, a batch at a time, and the whole file is read back
+in one query when the bot starts.
+
+Shard processes keep their settings in memory only, the coordinator saves
+every change a shard makes and sends it to all of them, see the sharding
+module.
+
+"""
+import logging
+import sqlite3
+import threading
+import typing
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PATH = 'mattbot-settings.sqlite3'
+FLUSH_INTERVAL = 1.0  # Seconds a change waits to be written with the ones after it
+
+WORKSPACE = 'workspace'
+CHANNEL = 'channel'
+USER = 'user'
+SCOPES = (USER, CHANNEL, WORKSPACE)  # The order settings are looked up in
+
+DEFAULTS = {
+    'check_logs': None,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (
+    workspace TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    user TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (workspace, channel, user, name)
+)
+"""
+
+
+def scope_key(scope: str, workspace: str, channel: str, user: str) -> tuple:
+    """
+    Get the (workspace, channel, user) a setting is kept under, the parts
+    outside the scope are empty.
+
+    Raises:
+        ValueError: When the scope is unknown
+
+    """
+    workspace = workspace or ''
+    if scope == USER:
+        return workspace, '', user or ''
+    if scope == CHANNEL:
+        return workspace, channel or '', ''
+    if scope == WORKSPACE:
+        return workspace, '', ''
+
+    raise ValueError(f'Unknown settings scope {scope}, use {", ".join(SCOPES)}')
+
+
+class SettingsStore:
+    """
+    Settings held in memory and written behind to SQLite
+
+    """
+    def __init__(self, path: str = None, flush_interval: float = FLUSH_INTERVAL) -> None:
+        """
+        Initialize the store, reading back what was saved before
+
+        Args:
+            path:           The SQLite file, settings only last as long as
+                            the process when None
+            flush_interval: Seconds between writing batches of changes
+
+        """
+        self.path = path
+        self.flush_interval = flush_interval
+
+        self.values = {}  # (workspace, channel, user, name) -> value
+        self.pending = {}  # (workspace, channel, user, name) -> value, None to delete
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        self.writes = 0
+        self.flushes = 0
+
+        self.connection = None
+        if path is not None:
+            # Only ever used by one thread at a time, the writer once it runs
+            self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(SCHEMA)
+            self.load()
+
+    def load(self):
+        """
+        Read every saved setting into memory.
+
+        """
+        rows = self.connection.execute('SELECT workspace, channel, user, name, value FROM settings').fetchall()
+        self.values = {(workspace, channel, user, name): value for workspace, channel, user, name, value in rows}
+        logger.info('Loaded %s settings from %s', len(self.values), self.path)
+
+    def get(self, name: str, workspace: str, channel: str = None, user: str = None, default=None):
+        """
+        Get the most specific setting for a user in a channel.
+
+        Args:
+            name:      The name of the setting
+            workspace: The team id of the workspace
+            channel:   The channel asking, if any
+            user:      The user asking, if any
+            default:   What to return when the setting is not set anywhere,
+                       the built in default by default
+
+        """
+        values = self.values
+        workspace = workspace or ''
+        if user:
+            value = values.get((workspace, '', user, name))
+            if value is not None:
+                return value
+        if channel:
+            value = values.get((workspace, channel, '', name))
+            if value is not None:
+                return value
+
+        value = values.get((workspace, '', '', name))
+        if value is not None:
+            return value
+
+        return DEFAULTS.get(name) if default is None else default
+
+    def set(self, name: str, value: typing.Optional[str], workspace: str, channel: str = None, user: str = None,
+            scope: str = CHANNEL):
+        """
+        Change a setting now and save it with the next batch.
+
+        Args:
+            name:      The name of the setting
+            value:     Its new value, None to unset it
+            workspace: The team id of the workspace
+            channel:   The channel the setting was changed in
+            user:      The user who changed it
+            scope:     Who the setting is for, the user, the channel or the
+                       whole workspace
+
+        Raises:
+            ValueError: When the scope is unknown
+
+        """
+        key = scope_key(scope, workspace, channel, user) + (name,)
+        value = None if value is None else str(value)
+
+        with self.condition:
+            if value is None:
+                self.values.pop(key, None)
+            else:
+                self.values[key] = value
+
+            if self.connection is not None:
+                self.pending[key] = value
+                self.condition.notify_all()
+
+    def scoped(self, workspace: str, channel: str, user: str) -> 'ScopedSettings':
+        return ScopedSettings(self, workspace, channel, user)
+
+    def start(self):
+        """
+        Start the writer thread.
+
+        """
+        with self.condition:
+            if self.running or self.connection is None:
+                return
+            self.running = True
+
+        self.thread = threading.Thread(target=self.write_forever, name='mattbot-settings', daemon=True)
+        self.thread.start()
+
+    def stop(self, wait: bool = True):
+        """
+        Stop the writer thread once every change has been written.
+
+        Args:
+            wait: Wait for the last batch to be written
+
+        """
+        with self.condition:
+            was_running = self.running
+            self.running = False
+            self.condition.notify_all()
+
+        if not was_running:
+            # Nothing is writing behind, save what is left right here
+            self.flush()
+        elif wait and self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def write_forever(self):
+        """
+        Write a batch of changes every flush interval until stopped.
+
+        """
+        while True:
+            with self.condition:
+                if self.running and not self.pending:
+                    self.condition.wait()
+                running = self.running
+
+            if running:
+                # Give the changes that follow a moment to join the batch
+                with self.condition:
+                    self.condition.wait_for(lambda: not self.running, timeout=self.flush_interval)
+
+            self.flush()
+            if not running:
+                return
+
+    def flush(self) -> int:
+        """
+        Write the pending changes in one transaction.
+
+        Returns:
+            The number of changes written
+
+        """
+        with self.condition:
+            batch, self.pending = self.pending, {}
+
+        if not batch or self.connection is None:
+            return 0
+
+        upserts = [key + (value,) for key, value in batch.items() if value is not None]
+        deletes = [key for key, value in batch.items() if value is None]
+        try:
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO settings (workspace, channel, user, name, value) VALUES (?, ?, ?, ?, ?)',
+                    upserts)
+                self.connection.executemany(
+                    'DELETE FROM settings WHERE workspace = ? AND channel = ? AND user = ? AND name = ?', deletes)
+        except sqlite3.Error:
+            logger.exception('Could not save %s settings to %s', len(batch), self.path)
+            with self.condition:
+                # Try again with the next batch, unless they changed again since
+                for key, value in batch.items():
+                    self.pending.setdefault(key, value)
+            return 0
+
+        self.writes += len(batch)
+        self.flushes += 1
+        return len(batch)
+
+    def metrics(self) -> dict:
+        return {'cached': len(self.values), 'pending': len(self.pending), 'written': self.writes,
+                'batches': self.flushes}
+
+
+class ScopedSettings:
+    """
+    The settings as seen by one user in one channel
+
+    Reading a setting gets the most specific one, setting one sets it for
+    the channel unless another scope is given.
+
+    """
+    __slots__ = ('store', 'workspace', 'channel', 'user')
+
+    def __init__(self, store: SettingsStore, workspace: str, channel: str, user: str) -> None:
+        self.store = store
+        self.workspace = workspace
+        self.channel = channel
+        self.user = user
+
+    def get(self, name: str, default=None):
+        return self.store.get(name, self.workspace, self.channel, self.user, default)
+
+    def set(self, name: str, value: typing.Optional[str], scope: str = CHANNEL):
+        self.store.set(name, value, self.workspace, self.channel, self.user, scope)
+
+    def __getitem__(self, name: str):
+        return self.get(name)
+
+    def __setitem__(self, name: str, value: str):
+        self.set(name, value)
+
+    def __delitem__(self, name: str):
+        self.set(name, None)
@@ -33,7 +33,7 @@ setup(
         'Natural Language :: English',
         'Operating System :: Linux',
         'Operating System :: POSIX',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.7',
         'Intended Audience :: Developers',
         'Intended Audience :: Information Technology',
         'Intended Audience :: Science/Research',
@@ -46,7 +46,7 @@ setup(
     keywords="slack bot",
 
     packages=['mattbot'],
-    python_requires='>=3.6.2',
+    python_requires='>=3.7',
     install_requires=[],
     extras_require={
         ':sys.platform == "linux"': ['pyinotify'],
@@ -0,0 +1,607 @@
+"""
+Sharding for the mattbot
+
+A sharded bot splits the channels of a workspace between worker processes.
+The coordinator process owns the RTM websocket, the directory and the
+outbound queue. It classifies every event as usual, but instead of running
+commands it hands each one to the shard that owns its channel.
+
+Channels are assigned to shards on a consistent hash ring, so when a shard
+dies only its own channels move, to the shards next to it on the ring, and
+they move back once a replacement has started.
+
+Shards post their replies through the coordinator's outbound queue, so every
+channel keeps one rate limit and one order however many shards there are
+and whichever shard owns it at the moment. Directory events are sent to
+every shard to keep their copies of the directory current.
+
+Shards count their commands and Web API calls in the coordinator's metrics
+too, so the metrics server and the stats command, which the coordinator
+answers, cover every shard.
+
+Settings are saved by the coordinator alone. A shard starts from the
+coordinator's settings and sends every change it makes back, the change is
+seen in that shard right away and the coordinator saves it and sends it on
+to every shard, so all of them agree on the user and workspace settings as
+well as on the settings of the channels they own.
+
+"""
+import bisect
+import collections
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.connection
+import queue
+import signal
+import sys
+import threading
+import typing
+
+import logconfig
+from bot import MattBot
+from settings import CHANNEL, SettingsStore
+from subscriptions import normalize
+from transport import Transport
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARDS = 4
+REPLICAS = 64  # Points on the ring for every shard, more spreads channels more evenly
+SHARD_QUEUE_SIZE = 1000  # Commands waiting for a shard before the coordinator waits
+SUBMIT_TIMEOUT = 1  # Seconds between checks that a busy shard is still alive
+STOP_TIMEOUT = 10  # Seconds a shard gets to finish its commands when stopping
+STATS_TIMEOUT = 5  # Seconds a shard waits for the coordinator's stats
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    A consistent hash ring of nodes
+
+    """
+    def __init__(self, nodes: typing.Iterable = (), replicas: int = REPLICAS) -> None:
+        self.replicas = replicas
+        self.points = []  # Sorted hashes
+        self.owners = {}  # hash -> node
+
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(set(self.owners.values()))
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = ring_hash(f'{node}:{replica}')
+            if point not in self.owners:
+                bisect.insort(self.points, point)
+            self.owners[point] = node
+
+    def remove(self, node):
+        for replica in range(self.replicas):
+            point = ring_hash(f'{node}:{replica}')
+            if self.owners.get(point) == node:
+                del self.owners[point]
+                self.points.remove(point)
+
+    def node_for(self, key: str):
+        """
+        Get the node that owns a key, None when the ring is empty.
+
+        """
+        if not self.points:
+            return None
+
+        index = bisect.bisect(self.points, ring_hash(key)) % len(self.points)
+        return self.owners[self.points[index]]
+
+
+class RemoteOutbound:
+    """
+    Stands in for the outbound queue in a shard, handing every message to
+    the coordinator
+
+    """
+    def __init__(self, shard: int, requests, replies) -> None:
+        self.shard = shard
+        self.requests = requests
+        self.replies = replies
+        self.lock = threading.Lock()
+        self.waits = 0
+        self.counts = collections.Counter()
+
+    def start(self):
+        pass
+
+    def stop(self, wait: bool = True):
+        pass
+
+    def post(self, channel: str, text: str, **parameters) -> dict:
+        self.requests.put(('post', channel, str(text), parameters))
+        self.counts['queued'] += 1
+
+        return {'ok': True, 'queued': True, 'channel': channel}
+
+    def wait_until_sent(self, channel: str, timeout: float = None) -> bool:
+        """
+        Ask the coordinator to wait until a channel has been drained.
+
+        """
+        return self.ask('wait', channel, timeout, timeout=timeout, default=False)
+
+    def ask(self, kind: str, *args, timeout: float = None, default=None):
+        """
+        Send the coordinator a request and wait for its answer.
+
+        Args:
+            kind:    The kind of request
+            args:    The arguments of the request
+            timeout: How long the coordinator may take, None to wait forever
+            default: The answer when it takes longer
+
+        """
+        with self.lock:
+            self.waits += 1
+            wait_id = self.waits
+            self.requests.put((kind, self.shard, wait_id) + args)
+
+            try:
+                while True:
+                    reply_id, answer = self.replies.get(timeout=None if timeout is None else timeout + SUBMIT_TIMEOUT)
+                    if reply_id == wait_id:
+                        return answer
+            except queue.Empty:
+                return default
+
+    def depth(self) -> int:
+        return 0
+
+
+class RemoteSettings(SettingsStore):
+    """
+    Stands in for the settings store in a shard, sending every change to the
+    coordinator to be saved and shared with the other shards
+
+    """
+    def __init__(self, requests) -> None:
+        super().__init__()
+        self.requests = requests
+
+    def set(self, name: str, value: typing.Optional[str], workspace: str, channel: str = None, user: str = None,
+            scope: str = CHANNEL):
+        # Seen by this shard right away, the coordinator sends it on to the others
+        self.apply(name, value, workspace, channel, user, scope)
+        self.requests.put(('setting', name, value, workspace, channel, user, scope))
+
+    def apply(self, name: str, value: typing.Optional[str], workspace: str, channel: str = None, user: str = None,
+              scope: str = CHANNEL):
+        """
+        Change a setting in this shard only.
+
+        """
+        super().set(name, value, workspace, channel, user, scope)
+
+
+class ShardBot(MattBot):
+    """
+    A bot that runs the commands of the channels it owns
+
+    """
+    def __init__(self, token: str, shard: int, inbound, requests, replies, **kwargs):
+        """
+        Initialize the shard
+
+        Args:
+            token:    The Slack API token
+            shard:    The number of this shard
+            inbound:  The queue the coordinator sends commands and events on
+            requests: The queue to send messages and requests to the coordinator on
+            replies:  The queue the coordinator answers requests on
+            kwargs:   Passed on to MattBot
+
+        """
+        super().__init__(token, queue_messages=False, connect=False, settings=RemoteSettings(requests), **kwargs)
+        self.shard = shard
+        self.inbound = inbound
+        self.requests = requests
+        self.outbound = RemoteOutbound(shard, requests, replies)
+
+    def die(self):
+        # The whole bot dies, not just this shard
+        self.requests.put(('die',))
+
+    def subscribe(self, action: str, pattern: str) -> str:
+        # The coordinator drops the events of ignored channels before they reach any shard
+        self.requests.put(('subscribe', action, pattern))
+        return normalize(pattern)
+
+    def count_command(self, name: typing.Optional[str], outcome: str, seconds: float = None):
+        # Counted where the metrics are served
+        self.requests.put(('count_command', name, outcome, seconds))
+
+    def count_api_call(self, method: str, outcome: str, seconds: float):
+        self.requests.put(('count_api_call', method, outcome, seconds))
+
+    def stats(self) -> str:
+        return self.outbound.ask('stats', timeout=STATS_TIMEOUT,
+                                 default='The coordinator did not send its stats in time')
+
+    def serve(self):
+        """
+        Run what the coordinator sends until it says to stop.
+
+        """
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+        self.settings.start()
+
+        try:
+            while True:
+                message = self.inbound.get()
+                if message is None:
+                    return
+
+                kind = message[0]
+                if kind == 'command':
+                    _, channel, user, bot_command = message
+                    if self.dispatcher is not None:
+                        self.dispatcher.submit(channel, user, bot_command)
+                        continue
+
+                    try:
+                        self.handle_command(channel, user, bot_command)
+                    except Exception:
+                        logger.exception('Error while handling command "%s" in channel %s', bot_command, channel)
+                elif kind == 'event':
+                    self.directory.apply_event(message[1])
+                elif kind == 'directory':
+                    _, self.slack_user_id, self.team_id, users, channels, ims = message
+                    self.directory.users.update(users)
+                    self.directory.channels.update(channels)
+                    self.directory.ims.update(ims)
+                elif kind == 'settings':
+                    self.settings.values = message[1]
+                elif kind == 'setting':
+                    self.settings.apply(*message[1:])
+        finally:
+            if self.dispatcher is not None:
+                self.dispatcher.stop()
+            self.settings.stop()
+
+
+def run_shard(shard: int, token: str, name: str, api_url: str, workers: int, inbound, requests, replies,
+              log_level: int = logging.INFO):
+    """
+    The entry point of a shard process.
+
+    """
+    # The coordinator decides when shards stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logconfig.setup(log_level)
+
+    bot = ShardBot(token, shard, inbound, requests, replies, name=name, workers=workers,
+                   transport=Transport(base_url=api_url))
+    bot.serve()
+
+
+class Shard:
+    """
+    The coordinator's handle on one shard process
+
+    """
+    def __init__(self, number: int, context, queue_size: int) -> None:
+        self.number = number
+        self.inbound = context.Queue(maxsize=queue_size)
+        self.replies = context.Queue()
+        self.process = None
+
+
+class ShardRouter:
+    """
+    Takes the place of the dispatcher in the coordinator, sending every
+    command to the shard that owns its channel
+
+    """
+    def __init__(self, bot: 'ShardedBot', shards: int = DEFAULT_SHARDS, workers: int = None,
+                 queue_size: int = SHARD_QUEUE_SIZE, respawn: bool = True) -> None:
+        """
+        Initialize the router
+
+        Args:
+            bot:        The coordinating bot
+            shards:     The number of shard processes
+            workers:    Worker threads in each shard, see the dispatcher module
+            queue_size: The most commands waiting for each shard
+            respawn:    Replace shards that die
+
+        """
+        self.bot = bot
+        self.workers = workers
+        self.queue_size = queue_size
+        self.respawn = respawn
+
+        # Shards do not inherit the coordinator's threads and sockets
+        self.context = multiprocessing.get_context('spawn')
+        self.shards = {number: Shard(number, self.context, queue_size) for number in range(shards)}
+        self.requests = self.context.Queue()
+        self.ring = HashRing()
+        self.owners = {}  # channel -> shard number, cleared when the ring changes
+
+        self.lock = threading.Lock()
+        self.settings_lock = threading.Lock()
+        self.running = False
+        self.threads = []
+        self.counts = collections.Counter()
+
+    def start(self):
+        """
+        Start every shard and the threads that serve them.
+
+        """
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+
+        for shard in self.shards.values():
+            self.spawn(shard)
+
+        self.threads = [threading.Thread(target=self.relay, name='mattbot-shard-relay', daemon=True),
+                        threading.Thread(target=self.monitor, name='mattbot-shard-monitor', daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, wait: bool = True):
+        """
+        Stop every shard once it has run its commands.
+
+        """
+        with self.lock:
+            self.running = False
+            shards = list(self.shards.values())
+
+        for shard in shards:
+            shard.inbound.put(None)
+
+        for shard in shards:
+            shard.process.join(STOP_TIMEOUT if wait else 0)
+            if shard.process.is_alive():
+                logger.warning('Shard %s did not stop in time, terminating it', shard.number)
+                shard.process.terminate()
+
+        # Relay what the shards said last before letting the relay go
+        self.requests.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+    def spawn(self, shard: Shard):
+        """
+        Start a shard process, hand it the directory and put it on the ring.
+
+        """
+        bot = self.bot
+        shard.process = self.context.Process(
+            target=run_shard, name=f'mattbot-shard-{shard.number}', daemon=True,
+            args=(shard.number, bot.slack_token, bot.name, bot.transport.base_url, self.workers,
+                  shard.inbound, self.requests, shard.replies, logging.getLogger().getEffectiveLevel()))
+        shard.process.start()
+
+        directory = bot.directory
+        shard.inbound.put(('directory', bot.slack_user_id, bot.team_id, list(directory.users.items()),
+                           list(directory.channels.items()), list(directory.ims.items())))
+        with self.settings_lock:
+            # No change can slip in between the copy and the changes sent after it
+            shard.inbound.put(('settings', dict(bot.settings.values)))
+
+        with self.lock:
+            self.ring.add(shard.number)
+            self.owners.clear()
+        logger.info('Started shard %s as process %s', shard.number, shard.process.pid)
+
+    def shard_for(self, channel: str) -> typing.Optional[Shard]:
+        with self.lock:
+            number = self.owners.get(channel)
+            if number is None:
+                number = self.ring.node_for(channel)
+                if number is None:
+                    return None
+                self.owners[channel] = number
+
+            return self.shards[number]
+
+    def submit(self, channel: str, user: str, bot_command: str) -> bool:
+        """
+        Send a command to the shard that owns its channel, waiting while
+        that shard is full.
+
+        Returns:
+            Whether a shard took the command
+
+        """
+        self.counts['submitted'] += 1
+        while self.running:
+            shard = self.shard_for(channel)
+            if shard is None:
+                break
+
+            try:
+                shard.inbound.put(('command', channel, user, bot_command), timeout=SUBMIT_TIMEOUT)
+                self.counts[f'shard_{shard.number}'] += 1
+                return True
+            except queue.Full:
+                # Full because it died, try whoever owns the channel now
+                if not shard.process.is_alive():
+                    self.remove(shard)
+
+        logger.error('No shard could take command "%s" in channel %s', bot_command, channel)
+        self.counts['lost'] += 1
+        return False
+
+    def broadcast(self, event: dict):
+        """
+        Send a directory event to every shard.
+
+        """
+        self.send_all(('event', event))
+
+    def send_all(self, message: tuple):
+        with self.lock:
+            shards = list(self.shards.values())
+
+        for shard in shards:
+            shard.inbound.put(message)
+
+    def change_setting(self, *setting):
+        """
+        Save a setting a shard changed and send it to every shard, the one
+        that changed it too so they all end up with the last change.
+
+        """
+        with self.settings_lock:
+            self.bot.settings.set(*setting)
+            self.send_all(('setting',) + setting)
+
+    def remove(self, shard: Shard):
+        """
+        Take a dead shard off the ring so its channels move to the others.
+
+        """
+        with self.lock:
+            # It may already have been removed and replaced
+            if self.shards.get(shard.number) is not shard or shard.number not in self.ring.owners.values():
+                return
+            self.ring.remove(shard.number)
+            self.owners.clear()
+
+        self.counts['deaths'] += 1
+        logger.error('Shard %s died with exit code %s, moving its channels to %s other shards',
+                     shard.number, shard.process.exitcode, len(self.ring))
+
+    def monitor(self):
+        """
+        Watch the shard processes and replace the ones that die.
+
+        """
+        while self.running:
+            with self.lock:
+                sentinels = {shard.process.sentinel: shard for shard in self.shards.values()
+                             if shard.number in self.ring.owners.values()}
+
+            for sentinel in multiprocessing.connection.wait(list(sentinels), timeout=SUBMIT_TIMEOUT):
+                if not self.running:
+                    return
+
+                shard = sentinels[sentinel]
+                self.remove(shard)
+                if self.respawn:
+                    # Commands waiting for the dead shard went with it
+                    replacement = Shard(shard.number, self.context, self.queue_size)
+                    with self.lock:
+                        self.shards[shard.number] = replacement
+                    self.spawn(replacement)
+                    self.counts['respawns'] += 1
+
+    def relay(self):
+        """
+        Serve the messages and requests the shards send back.
+
+        """
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+
+            kind = request[0]
+            if kind == 'post':
+                _, channel, text, parameters = request
+                self.bot.post_message(channel, text, **parameters)
+            elif kind == 'count_command':
+                self.bot.count_command(*request[1:])
+            elif kind == 'count_api_call':
+                self.bot.count_api_call(*request[1:])
+            elif kind == 'wait':
+                threading.Thread(target=self.answer_wait, args=request[1:], daemon=True).start()
+            elif kind == 'stats':
+                self.answer(request[1], request[2], self.bot.stats())
+            elif kind == 'die':
+                self.bot.die()
+            elif kind == 'subscribe':
+                self.bot.subscribe(*request[1:])
+            elif kind == 'setting':
+                self.change_setting(*request[1:])
+
+    def answer_wait(self, shard_number: int, wait_id: int, channel: str, timeout: float):
+        sent = self.bot.outbound.wait_until_sent(channel, timeout) if self.bot.outbound is not None else True
+        self.answer(shard_number, wait_id, sent)
+
+    def answer(self, shard_number: int, wait_id: int, answer):
+        with self.lock:
+            shard = self.shards[shard_number]
+        shard.replies.put((wait_id, answer))
+
+    @property
+    def depth(self) -> int:
+        """
+        Get the number of commands waiting for a shard, 0 where the platform
+        cannot count what is in a queue.
+
+        """
+        with self.lock:
+            shards = list(self.shards.values())
+
+        try:
+            return sum(shard.inbound.qsize() for shard in shards)
+        except NotImplementedError:
+            return 0
+
+    def metrics(self) -> dict:
+        metrics = dict(self.counts)
+        with self.lock:
+            metrics['shards'] = len(self.shards)
+            metrics['shards_alive'] = len(self.ring)
+
+        return metrics
+
+
+class ShardedBot(MattBot):
+    """
+    A bot that reads the fire hose and runs commands in shard processes
+
+    """
+    def __init__(self, token: str, shards: int = DEFAULT_SHARDS, shard_workers: int = None,
+                 shard_queue_size: int = SHARD_QUEUE_SIZE, connect: bool = True, **kwargs):
+        """
+        Initialize the coordinator
+
+        Args:
+            token:            The Slack API token
+            shards:           The number of shard processes
+            shard_workers:    Worker threads in each shard
+            shard_queue_size: The most commands waiting for each shard
+            connect:          Connect to Slack right away
+            kwargs:           Passed on to MattBot
+
+        """
+        super().__init__(token, connect=False, **kwargs)
+        self.dispatcher = ShardRouter(self, shards=shards, workers=shard_workers, queue_size=shard_queue_size)
+        self.metrics.gauge('mattbot_shards', 'Shard counts', self.dispatcher.metrics, label_name='stat')
+
+        if connect and not self.connect():
+            sys.exit()
+
+    def queue_stats(self) -> typing.List[str]:
+        shards = self.dispatcher.metrics()
+        return [f'{shards["shards_alive"]} of {shards["shards"]} shards up, {self.dispatcher.depth} commands waiting, '
+                f'{shards.get("submitted", 0)} sent to shards, {shards.get("lost", 0)} lost, '
+                f'{shards.get("respawns", 0)} shards replaced']
+
+    def classify_event(self, output: dict) -> typing.Optional[tuple]:
+        if output.get('type') in self.directory.event_types:
+            self.dispatcher.broadcast(output)
+
+        return super().classify_event(output)
@@ -0,0 +1,194 @@
+"""
+Channel subscriptions for the mattbot
+
+The bot listens to every channel it is in until told to ignore one. A rule
+is a channel, by id or by name, or a name with wildcards that covers many
+channels:
+
+    ignore                 this channel
+    ignore #random         one channel by name
+    ignore deploy-*        every channel whose name starts with deploy-
+    listen deploy-prod     an exception to the rule above
+
+A channel is ignored when it matches an ignore rule and no listen rule.
+Events from ignored channels are dropped by the ingest pre-filter before
+they are decoded, see the ingest module. Telling the bot to listen always
+gets through, so an ignored channel can be listened to again.
+
+The rules are compiled into a single regular expression whenever they
+change, and the answer for each channel is kept until the rules or the
+channel names change, so checking a frame is a dictionary lookup.
+
+Rules are changed by commands on worker threads while the listener checks
+frames. A change takes a lock and swaps in new matchers with an empty set
+of answers, in one assignment, and every check reads and records answers
+in the one it started with, so an answer worked out from the old rules is
+never kept for the new ones.
+
+"""
+import fnmatch
+import re
+import threading
+import typing
+
+LISTEN = 'listen'
+IGNORE = 'ignore'
+
+# The workspace settings the rules are saved in, see the settings module
+IGNORED_SETTING = 'ignored_channels'
+LISTENED_SETTING = 'listened_channels'
+
+# How Slack links a channel in a message, <#C1234|general>
+CHANNEL_LINK = re.compile(r'^<#([^|>]+)(?:\|[^>]*)?>$')
+
+
+def normalize(pattern: str) -> str:
+    """
+    Get the rule for a channel as typed in a message, a link to a channel
+    becomes its id and a name loses its #.
+
+    """
+    pattern = pattern.strip()
+    link = CHANNEL_LINK.match(pattern)
+    if link is not None:
+        return link.group(1).lower()
+
+    return pattern.lstrip('#').lower()
+
+
+def compile_rules(patterns: typing.Iterable[str]) -> typing.Optional[typing.Pattern]:
+    """
+    Compile wildcard rules into one case insensitive regular expression.
+
+    Returns:
+        The expression, None when there are no rules
+
+    """
+    patterns = sorted(patterns)
+    if not patterns:
+        return None
+
+    return re.compile('|'.join(fnmatch.translate(pattern) for pattern in patterns), re.IGNORECASE)
+
+
+class Matchers:
+    """
+    The compiled rules and the answers worked out from them
+
+    """
+    __slots__ = ('ignore_matcher', 'listen_matcher', 'decisions')
+
+    def __init__(self, ignore_matcher: typing.Pattern = None, listen_matcher: typing.Pattern = None) -> None:
+        self.ignore_matcher = ignore_matcher
+        self.listen_matcher = listen_matcher
+        self.decisions = {}  # channel id -> whether it is ignored
+
+    def decide(self, names: typing.Sequence[str]) -> bool:
+        if not any(self.ignore_matcher.match(name) for name in names):
+            return False
+
+        return self.listen_matcher is None or not any(self.listen_matcher.match(name) for name in names)
+
+
+class Subscriptions:
+    """
+    The channels the bot ignores
+
+    """
+    def __init__(self, channels: typing.Mapping[str, str] = None) -> None:
+        """
+        Initialize the subscriptions
+
+        Args:
+            channels: Channel ids mapped to their names, checked as they
+                      change
+
+        """
+        self.channels = channels if channels is not None else {}
+        self.ignored = set()
+        self.listened = set()
+        self.matchers = Matchers()
+        # Held by whoever changes the rules, also while saving them
+        self.lock = threading.RLock()
+
+    def __bool__(self):
+        return self.matchers.ignore_matcher is not None
+
+    def load(self, ignored: typing.Iterable[str], listened: typing.Iterable[str]):
+        with self.lock:
+            self.ignored = set(ignored)
+            self.listened = set(listened)
+            self.compile()
+
+    def ignore(self, pattern: str) -> str:
+        """
+        Ignore the channels matching a rule, unless a listen rule covers them.
+
+        Returns:
+            The rule as kept
+
+        """
+        pattern = normalize(pattern)
+        with self.lock:
+            self.listened.discard(pattern)
+            self.ignored.add(pattern)
+            self.compile()
+        return pattern
+
+    def listen(self, pattern: str) -> str:
+        """
+        Listen to the channels matching a rule again.
+
+        Returns:
+            The rule as kept
+
+        """
+        pattern = normalize(pattern)
+        with self.lock:
+            if pattern in self.ignored:
+                self.ignored.discard(pattern)
+            elif self.matchers.ignore_matcher is not None:
+                # Make an exception to a wider rule
+                self.listened.add(pattern)
+            self.compile()
+        return pattern
+
+    def rules(self) -> typing.Tuple[list, list]:
+        """
+        Get the ignore and the listen rules, sorted.
+
+        """
+        with self.lock:
+            return sorted(self.ignored), sorted(self.listened)
+
+    def compile(self):
+        with self.lock:
+            self.matchers = Matchers(compile_rules(self.ignored), compile_rules(self.listened))
+
+    def forget(self):
+        """
+        Forget the decisions made so far, after channels were renamed.
+
+        """
+        with self.lock:
+            matchers = self.matchers
+            self.matchers = Matchers(matchers.ignore_matcher, matchers.listen_matcher)
+
+    def is_ignored(self, channel: typing.Union[str, bytes]) -> bool:
+        """
+        Check whether events from a channel are ignored.
+
+        Args:
+            channel: The channel id, raw from a frame or decoded
+
+        """
+        matchers = self.matchers
+        if matchers.ignore_matcher is None:
+            return False
+
+        ignored = matchers.decisions.get(channel)
+        if ignored is None:
+            channel_id = channel.decode() if isinstance(channel, bytes) else channel
+            ignored = matchers.decisions[channel] = matchers.decide((channel_id, self.channels.get(channel_id) or ''))
+
+        return ignored
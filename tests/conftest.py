@@ -0,0 +1,9 @@
+"""
+The tests import the bot's modules from the repository root, the way the
+bot and the benchmarks run.
+
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,66 @@
+from bot import MattBot
+from dedup import RingIndex, event_key
+
+
+def test_event_keys():
+    assert event_key({'client_msg_id': 'abc', 'channel': 'C1', 'ts': '1.0'}) == 'abc'
+    assert event_key({'channel': 'C1', 'ts': '1.0'}) == ('C1', '1.0')
+    assert event_key({'channel': 'C1'}) is None
+
+
+def test_a_repeated_key_is_a_duplicate():
+    recent = RingIndex(size=3)
+
+    assert recent.add('a')
+    assert not recent.add('a')
+    assert 'a' in recent
+    assert len(recent) == 1
+
+
+def test_the_oldest_key_is_forgotten_once_full():
+    recent = RingIndex(size=3)
+    for key in ('a', 'b', 'c', 'd'):
+        assert recent.add(key)
+
+    assert len(recent) == 3
+    assert 'a' not in recent
+    assert all(key in recent for key in ('b', 'c', 'd'))
+    # A forgotten key counts as new again
+    assert recent.add('a')
+    assert 'b' not in recent
+
+
+def test_a_duplicate_does_not_take_a_slot():
+    recent = RingIndex(size=2)
+    recent.add('a')
+    recent.add('b')
+
+    assert not recent.add('b')
+    assert not recent.add('b')
+    assert 'a' in recent
+
+
+def test_the_window_stays_bounded():
+    recent = RingIndex(size=100)
+    for number in range(10000):
+        recent.add(('C1', str(number)))
+
+    assert len(recent) == 100
+    assert ('C1', '9900') in recent
+    assert ('C1', '9899') not in recent
+
+
+def test_the_bot_suppresses_a_redelivered_command():
+    bot = MattBot('token', connect=False, queue_messages=False, dedup_size=2)
+    first = {'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'hello', 'ts': '1.0'}
+    second = dict(first, ts='2.0')
+    third = dict(first, ts='3.0')
+
+    assert not bot.is_duplicate(first)
+    assert bot.is_duplicate(first)
+    assert not bot.is_duplicate(second)
+    assert not bot.is_duplicate(third)
+    # Only the last two commands are remembered
+    assert not bot.is_duplicate(first)
+    # Nothing identifies an event without a timestamp, so it always runs
+    assert not bot.is_duplicate({'type': 'message', 'channel': 'C1', 'text': 'hello'})
@@ -0,0 +1,137 @@
+import threading
+
+import pytest
+
+from directory import INITIAL_TABLE_SIZE, Directory, NameIndex
+
+
+def test_lookups_both_ways():
+    index = NameIndex([('U1', 'matt'), ('U2', 'anna')])
+
+    assert index['U1'] == 'matt'
+    assert index.key_for('anna') == 'U2'
+    assert 'U1' in index
+    assert 'U3' not in index
+    assert index.key_for('nobody') is None
+    assert len(index) == 2
+
+
+def test_rename_drops_the_old_name():
+    index = NameIndex([('U1', 'matt')])
+    index['U1'] = 'matthew'
+
+    assert index['U1'] == 'matthew'
+    assert index.key_for('matthew') == 'U1'
+    assert index.key_for('matt') is None
+    assert len(index) == 1
+
+
+def test_remove():
+    index = NameIndex([('U1', 'matt'), ('U2', 'anna')])
+    del index['U1']
+
+    assert 'U1' not in index
+    assert index.key_for('matt') is None
+    assert dict(index.items()) == {'U2': 'anna'}
+    with pytest.raises(KeyError):
+        del index['U1']
+
+
+def test_keys_that_are_not_strings_are_missing():
+    index = NameIndex([('U1', 'matt')])
+
+    assert 1 not in index
+    with pytest.raises(KeyError):
+        index[None]
+
+
+def test_empty_names_are_kept_but_not_indexed():
+    index = NameIndex([('D1', '')])
+
+    assert index['D1'] == ''
+    assert index.key_for('') is None
+
+
+def test_unicode_names():
+    index = NameIndex([('U1', 'zoë'), ('U2', '日本')])
+
+    assert index['U1'] == 'zoë'
+    assert index.key_for('日本') == 'U2'
+
+
+def test_grows_and_reclaims_renamed_records():
+    index = NameIndex()
+    for number in range(1000):
+        index[f'U{number}'] = f'user{number}'
+    for number in range(1000):
+        index[f'U{number}'] = f'renamed{number}'
+
+    assert len(index) == 1000
+    assert len(index.tables.id_table) > INITIAL_TABLE_SIZE
+    assert all(index[f'U{number}'] == f'renamed{number}' for number in range(1000))
+    assert all(index.key_for(f'user{number}') is None for number in range(1000))
+    # Rebuilding dropped most of the renamed records
+    assert len(index.tables.starts) < 2000
+
+
+def test_lookups_while_the_tables_are_rebuilt():
+    index = NameIndex((f'U{number}', f'user{number}') for number in range(100))
+    misses = []
+    writing = True
+
+    def read():
+        while writing:
+            for number in range(100):
+                if index.get(f'U{number}') != f'user{number}':
+                    misses.append(number)
+
+    readers = [threading.Thread(target=read) for _ in range(2)]
+    for reader in readers:
+        reader.start()
+    for number in range(100, 20000):
+        index[f'U{number}'] = f'user{number}'
+    writing = False
+    for reader in readers:
+        reader.join()
+
+    assert not misses
+
+
+def test_directory_applies_events():
+    directory = Directory()
+
+    assert directory.apply_event({'type': 'team_join', 'user': {'id': 'U1', 'name': 'matt'}})
+    assert directory.apply_event({'type': 'channel_created', 'channel': {'id': 'C1', 'name': 'general'}})
+    assert directory.apply_event({'type': 'channel_rename', 'channel': {'id': 'C1', 'name': 'random'}})
+    assert directory.apply_event({'type': 'im_created', 'user': 'U1', 'channel': {'id': 'D1'}})
+    assert not directory.apply_event({'type': 'presence_change', 'user': 'U1'})
+
+    assert directory.users['U1'] == 'matt'
+    assert directory.channels.key_for('random') == 'C1'
+    assert directory.ims['D1'] == 'U1'
+
+    assert directory.apply_event({'type': 'channel_deleted', 'channel': 'C1'})
+    assert 'C1' not in directory.channels
+
+
+def test_records_without_an_id_are_skipped():
+    directory = Directory()
+    users = [{'name': 'ghost'}, {'id': None, 'name': 'nobody'}, {'id': 'U1', 'name': 'matt'}]
+
+    directory.load_users(lambda method, **parameters: {'ok': True, 'members': users})
+    assert dict(directory.users.items()) == {'U1': 'matt'}
+
+    assert directory.apply_event({'type': 'team_join', 'user': {'name': 'ghost'}})
+    assert directory.apply_event({'type': 'channel_created', 'channel': {'name': 'nameless'}})
+    assert directory.apply_event({'type': 'im_created', 'channel': {}})
+    assert len(directory.users) == 1
+    assert len(directory.channels) == 0
+    assert len(directory.ims) == 0
+
+
+def test_ids_must_be_strings():
+    index = NameIndex()
+
+    with pytest.raises(KeyError):
+        index[None] = 'ghost'
+    assert len(index) == 0
@@ -0,0 +1,174 @@
+import collections
+import threading
+import time
+
+import pytest
+
+from dispatcher import BLOCK, DROP_OLDEST, REPLY_BUSY, Dispatcher
+
+
+class Recorder:
+    """
+    A handler that records the commands it ran, per channel
+
+    """
+    def __init__(self, delay: float = 0.0) -> None:
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.ran = collections.defaultdict(list)
+        self.running = collections.Counter()
+        self.overlaps = 0
+
+    def __call__(self, channel, user, bot_command):
+        with self.lock:
+            self.running[channel] += 1
+            if self.running[channel] > 1:
+                self.overlaps += 1
+        time.sleep(self.delay)
+        with self.lock:
+            self.ran[channel].append(bot_command)
+            self.running[channel] -= 1
+
+
+def test_commands_from_a_channel_run_in_order_one_at_a_time():
+    recorder = Recorder(delay=0.001)
+    dispatcher = Dispatcher(recorder, workers=4, queue_size=1000)
+    dispatcher.start()
+    for number in range(50):
+        for channel in ('C1', 'C2', 'C3'):
+            dispatcher.submit(channel, 'U1', f'{channel} {number}')
+    dispatcher.stop()
+
+    for channel in ('C1', 'C2', 'C3'):
+        assert recorder.ran[channel] == [f'{channel} {number}' for number in range(50)]
+    assert recorder.overlaps == 0
+
+
+def test_channels_run_in_parallel():
+    barrier = threading.Barrier(2, timeout=5)
+    dispatcher = Dispatcher(lambda channel, user, bot_command: barrier.wait(), workers=2)
+    dispatcher.start()
+    dispatcher.submit('C1', 'U1', 'hello')
+    dispatcher.submit('C2', 'U1', 'hello')
+    dispatcher.stop()
+
+    # Both were waiting on the barrier at the same time, or it would have broken
+    assert not barrier.broken
+    assert dispatcher.metrics()['completed'] == 2
+
+
+def test_stop_runs_what_is_queued():
+    recorder = Recorder()
+    dispatcher = Dispatcher(recorder, workers=1)
+    for number in range(10):
+        dispatcher.submit('C1', 'U1', str(number))
+    dispatcher.start()
+    dispatcher.stop()
+
+    assert recorder.ran['C1'] == [str(number) for number in range(10)]
+
+
+def test_errors_do_not_stop_the_channel():
+    ran = []
+
+    def handler(channel, user, bot_command):
+        ran.append(bot_command)
+        if bot_command == 'boom':
+            raise RuntimeError(bot_command)
+
+    dispatcher = Dispatcher(handler, workers=1)
+    dispatcher.start()
+    for bot_command in ('boom', 'hello'):
+        dispatcher.submit('C1', 'U1', bot_command)
+    dispatcher.stop()
+
+    assert ran == ['boom', 'hello']
+
+
+def test_drop_oldest_makes_room():
+    recorder = Recorder()
+    dispatcher = Dispatcher(recorder, workers=1, queue_size=2, policy=DROP_OLDEST)
+    dispatcher.submit('C1', 'U1', 'first')
+    dispatcher.submit('C2', 'U1', 'second')
+    assert dispatcher.submit('C1', 'U1', 'third')
+    dispatcher.start()
+    dispatcher.stop()
+
+    assert recorder.ran == {'C2': ['second'], 'C1': ['third']}
+    assert dispatcher.metrics()['dropped'] == 1
+
+
+def test_reply_busy_turns_commands_away():
+    busy = []
+    dispatcher = Dispatcher(Recorder(), workers=1, queue_size=1, policy=REPLY_BUSY,
+                            on_busy=lambda *job: busy.append(job))
+
+    assert dispatcher.submit('C1', 'U1', 'first')
+    assert not dispatcher.submit('C1', 'U2', 'second')
+    assert busy == [('C1', 'U2', 'second')]
+    assert dispatcher.metrics()['rejected'] == 1
+
+
+def test_block_waits_for_room():
+    gate = threading.Event()
+    ran = []
+
+    def handler(channel, user, bot_command):
+        gate.wait(5)
+        ran.append(bot_command)
+
+    dispatcher = Dispatcher(handler, workers=1, queue_size=1, policy=BLOCK)
+    dispatcher.start()
+    dispatcher.submit('C1', 'U1', 'first')
+    while dispatcher.metrics()['active'] == 0:
+        time.sleep(0.001)
+    dispatcher.submit('C1', 'U1', 'second')
+
+    submitted = threading.Event()
+    submitter = threading.Thread(target=lambda: (dispatcher.submit('C1', 'U1', 'third'), submitted.set()))
+    submitter.start()
+    assert not submitted.wait(0.1)
+
+    gate.set()
+    assert submitted.wait(5)
+    submitter.join()
+    dispatcher.stop()
+
+    assert ran == ['first', 'second', 'third']
+    assert dispatcher.metrics()['blocked'] == 1
+
+
+def test_stopping_rejects_blocked_commands():
+    gate = threading.Event()
+    ran = []
+
+    def handler(channel, user, bot_command):
+        gate.wait(5)
+        ran.append(bot_command)
+
+    dispatcher = Dispatcher(handler, workers=1, queue_size=1, policy=BLOCK)
+    dispatcher.start()
+    dispatcher.submit('C1', 'U1', 'first')
+    while dispatcher.metrics()['active'] == 0:
+        time.sleep(0.001)
+    dispatcher.submit('C1', 'U1', 'second')
+
+    results = []
+    submitter = threading.Thread(target=lambda: results.append(dispatcher.submit('C1', 'U1', 'third')))
+    submitter.start()
+    time.sleep(0.05)
+
+    dispatcher.stop(wait=False)
+    submitter.join(5)
+    gate.set()
+    dispatcher.stop()
+
+    assert results == [False]
+    assert ran == ['first', 'second']
+    assert dispatcher.metrics()['rejected'] == 1
+    assert dispatcher.metrics()['queue_depth'] == 0
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        Dispatcher(Recorder(), policy='shrug')
@@ -0,0 +1,202 @@
+import contextlib
+
+import pytest
+import requests
+
+from bot import MattBot
+from commands.exos import FileHandler, iter_lines, keep_snippet, migration_section, skip_to
+from transport import DOWNLOAD_FAILED, Download, DownloadError, Transport
+
+LOG = ('INFO collecting static files ... done\n' * 100 +
+       '#### RUNNING MIGRATIONS\n'
+       '  Applying bearprofile.0042_fitbit... OK\n'
+       '#### DONE\n' +
+       'INFO restarting workers\n' * 100).encode()
+
+
+def chunked(data: bytes, size: int) -> list:
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+def test_skip_to_finds_a_marker_split_between_chunks():
+    chunks = chunked(b'noise\nmore noise\nthe #### RUNNING MIGRATIONS line\nafter\n', 7)
+
+    assert b''.join(skip_to(chunks, b'#### RUNNING MIGRATIONS')) == b'the #### RUNNING MIGRATIONS line\nafter\n'
+
+
+def test_skip_to_without_the_marker():
+    assert list(skip_to(chunked(b'noise\n' * 100, 10), b'#### RUNNING MIGRATIONS')) == []
+
+
+def test_iter_lines_joins_lines_and_characters_split_between_chunks():
+    data = 'first line\nsecond zoë\nno newline at the end'.encode()
+
+    for size in (1, 2, 3, 7, len(data)):
+        assert list(iter_lines(chunked(data, size))) == ['first line\n', 'second zoë\n', 'no newline at the end']
+
+
+def test_iter_lines_splits_endless_lines():
+    lines = list(iter_lines(chunked(b'x' * 25 + b'\nshort\n', 4), max_line=10))
+
+    assert all(len(line) <= 11 for line in lines)
+    assert ''.join(lines) == 'x' * 25 + '\nshort\n'
+
+
+def test_migration_section_stops_reading_at_the_end():
+    lines = iter(['noise\n', '#### RUNNING MIGRATIONS\n', 'Applying\n', '#### DONE\n', 'after\n'])
+
+    assert list(migration_section(lines)) == ['#### RUNNING MIGRATIONS\n', 'Applying\n', '#### DONE\n']
+    assert list(lines) == ['after\n']
+
+
+def test_keep_snippet_keeps_up_to_the_limit():
+    snippet = []
+
+    assert list(keep_snippet(['12345\n', '67890\n', 'abc\n'], snippet, limit=8)) == ['12345\n', '67890\n', 'abc\n']
+    assert ''.join(snippet) == '12345\n67'
+
+
+class FakeTransport(Transport):
+    """
+    Serves one log for every download and records the Web API calls
+
+    """
+    def __init__(self, log: bytes, chunk_size: int = 64, status_code: int = 200, lost: bool = False) -> None:
+        super().__init__()
+        self.log = log
+        self.chunk_size = chunk_size
+        self.status_code = status_code
+        self.lost = lost
+        self.calls = []
+        self.sent = 0
+
+    @contextlib.contextmanager
+    def download(self, url: str, token: str):
+        assert self.is_file_url(url)
+
+        def chunks(chunk_size):
+            for chunk in chunked(self.log, self.chunk_size):
+                self.sent += len(chunk)
+                yield chunk
+            if self.lost:
+                raise requests.ConnectionError('Connection reset by peer')
+
+        yield Download(self.status_code, self.read_chunks(url, chunks))
+
+    def api_call(self, method: str, token: str, **parameters) -> dict:
+        self.calls.append((method, parameters))
+        return {'ok': True}
+
+
+def handle(log: bytes, url: str = 'https://files.slack.com/files-pri/T1-F1/deploy.log', name: str = 'deploy.log',
+           status_code: int = 200, lost: bool = False):
+    transport = FakeTransport(log, status_code=status_code, lost=lost)
+    bot = MattBot('token', connect=False, queue_messages=False, transport=transport)
+    result = FileHandler(bot, channel='C1', user='U1').run({'url_private_download': url, 'name': name})
+    return result, transport
+
+
+def test_a_clean_log():
+    result, transport = handle(LOG)
+
+    assert result.success
+    (upload_method, upload), (post_method, post) = transport.calls
+    assert upload_method == 'files.upload'
+    assert upload['content'] == '#### RUNNING MIGRATIONS\n  Applying bearprofile.0042_fitbit... OK\n#### DONE\n'
+    assert post_method == 'chat.postMessage'
+    assert 'could not find any issues' in post['text']
+
+
+def test_a_log_with_errors():
+    _, transport = handle(LOG.replace(b'OK\n', b'OK\nTraceback (most recent call last):\n'))
+
+    assert 'I found an issue' in transport.calls[-1][1]['text']
+
+
+def test_a_log_that_needs_the_fake():
+    _, transport = handle(LOG.replace(b'OK\n', b"Table 'bearprofile_fitbitactivitynotification' already exists\n"))
+
+    assert 'we need to run the fake' in transport.calls[-1][1]['text']
+
+
+def test_the_download_stops_after_the_migrations():
+    _, transport = handle(LOG + b'INFO after the migrations\n' * 10000)
+
+    assert transport.sent < len(LOG)
+
+
+def test_files_that_are_not_deploy_logs():
+    result, transport = handle(LOG, name='notes.txt')
+
+    assert result.success
+    assert transport.sent == 0
+    assert transport.calls[-1][1]['text'] == 'I have nothing to say about that file.'
+
+
+def test_files_that_could_not_be_downloaded():
+    for status_code in (DOWNLOAD_FAILED, 404):
+        result, transport = handle(LOG, status_code=status_code)
+
+        assert not result.success
+        assert transport.calls[-1][1]['text'] == 'Sorry, I could not download the file deploy.log.'
+
+
+def test_a_download_that_is_cut_off():
+    result, transport = handle(LOG[:LOG.index(b'OK')], lost=True)
+
+    assert not result.success
+    assert transport.calls[-1][1]['text'] == 'Sorry, I could not download the file deploy.log.'
+    assert transport.metrics()['errors'] == 1
+
+
+def test_files_off_slack_are_never_downloaded():
+    for url in ('https://attacker.example/deploy.log', 'https://files.slack.com@attacker.example/deploy.log',
+                'http://files.slack.com/deploy.log', ''):
+        result, transport = handle(LOG, url=url)
+
+        assert not result.success
+        assert transport.sent == 0
+        assert transport.calls == []
+
+
+def test_files_cannot_be_typed_as_commands():
+    bot = MattBot('token', connect=False, queue_messages=False, transport=FakeTransport(LOG))
+
+    for name in ('handlefile', 'filehandler', 'file'):
+        assert bot.registry.get(name) is None
+        assert name not in bot.get_available_commands()
+
+
+def test_the_transport_only_sends_the_token_to_slack():
+    transport = Transport(base_url='http://127.0.0.1:8080/api/')
+
+    assert transport.is_file_url('https://files.slack.com/files-pri/T1-F1/deploy.log')
+    assert transport.is_file_url('http://127.0.0.1:8080/files/deploy.log')
+    assert not transport.is_file_url('http://127.0.0.1:9090/files/deploy.log')
+    assert not transport.is_file_url('https://files.slack.com.attacker.example/deploy.log')
+    with pytest.raises(ValueError):
+        with transport.download('https://attacker.example/deploy.log', token='token'):
+            pass
+    assert transport.metrics()['refused'] == 1
+
+
+def test_the_transport_reports_a_download_it_could_not_make():
+    # Nothing listens on the discard port
+    transport = Transport(base_url='http://127.0.0.1:9/api/')
+
+    with transport.download('http://127.0.0.1:9/files/deploy.log', token='token') as response:
+        assert response.status_code == DOWNLOAD_FAILED
+        assert list(response.iter_content()) == []
+    assert transport.metrics()['errors'] == 1
+
+
+def test_the_transport_reports_a_lost_download():
+    transport = Transport()
+
+    def chunks(chunk_size):
+        yield b'#### RUNNING'
+        raise requests.exceptions.ChunkedEncodingError('Connection broken')
+
+    with pytest.raises(DownloadError):
+        list(transport.read_chunks('https://files.slack.com/deploy.log', chunks)(1024))
+    assert transport.metrics()['errors'] == 1
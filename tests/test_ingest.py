@@ -0,0 +1,75 @@
+import json
+
+from ingest import CHATTER, IGNORED, TYPE, Prefilter, loads
+from subscriptions import Subscriptions
+
+BOT_ID = 'UBOT'
+
+
+def frame(**event) -> bytes:
+    return json.dumps(event).encode()
+
+
+def make_prefilter(subscriptions: Subscriptions = None) -> Prefilter:
+    prefilter = Prefilter(['goodbye', 'team_join'], {'D1': 'U1'}, subscriptions)
+    prefilter.set_user_id(BOT_ID)
+    return prefilter
+
+
+def test_handled_types_are_kept():
+    prefilter = make_prefilter()
+
+    assert prefilter.check(frame(type='goodbye')) is None
+    assert prefilter.check(frame(type='team_join', user={'id': 'U2', 'name': 'anna'})) is None
+
+
+def test_other_types_are_dropped():
+    prefilter = make_prefilter()
+
+    assert prefilter.check(frame(type='user_typing', channel='C1', user='U1')) == TYPE
+    assert prefilter.check(frame(type='presence_change', user='U1', presence='away')) == TYPE
+    assert prefilter.check(b'{"ok": true}') == TYPE
+
+
+def test_messages_for_the_bot_are_kept():
+    prefilter = make_prefilter()
+
+    assert prefilter.check(frame(type='message', channel='C1', user='U1', text=f'<@{BOT_ID}> hello')) is None
+    assert prefilter.check(frame(type='message', channel='D1', user='U1', text='hello')) is None
+    assert prefilter.check(frame(type='message', channel='C1', user='U1', file={'name': 'deploy.log'})) is None
+
+
+def test_chatter_is_dropped():
+    prefilter = make_prefilter()
+
+    assert prefilter.check(frame(type='message', channel='C1', user='U1', text='lunch?')) == CHATTER
+    assert prefilter.check(frame(type='message', channel='C1', user='U1', text='<@U2> lunch?')) == CHATTER
+
+
+def test_spacing_around_the_type_does_not_matter():
+    assert make_prefilter().check(b'{"type" : "message", "channel": "C1", "text": "lunch?"}') == CHATTER
+
+
+def test_every_message_is_kept_until_the_bot_knows_its_id():
+    prefilter = Prefilter(['goodbye'], {})
+
+    assert prefilter.check(frame(type='message', channel='C1', user='U1', text='lunch?')) is None
+
+
+def test_ignored_channels_are_dropped_but_can_be_listened_to():
+    subscriptions = Subscriptions({'C1': 'random', 'C2': 'general'})
+    subscriptions.ignore('random')
+    subscriptions.ignore('D1')
+    prefilter = make_prefilter(subscriptions)
+
+    assert prefilter.check(frame(type='message', channel='C1', user='U1', text=f'<@{BOT_ID}> hello')) == IGNORED
+    assert prefilter.check(frame(type='message', channel='C1', user='U1', file={'name': 'deploy.log'})) == IGNORED
+    assert prefilter.check(frame(type='message', channel='C1', user='U1', text=f'<@{BOT_ID}> Listen')) is None
+    assert prefilter.check(frame(type='message', channel='D1', user='U1', text='listen')) is None
+    assert prefilter.check(frame(type='message', channel='D1', user='U1', text='hello')) == IGNORED
+    assert prefilter.check(frame(type='message', channel='C2', user='U1', text=f'<@{BOT_ID}> hello')) is None
+
+
+def test_loads():
+    assert loads(b'{"type": "message", "text": "h\\u00e9"}') == {'type': 'message', 'text': 'hé'}
+    assert loads('{"type": "hello"}') == {'type': 'hello'}
@@ -0,0 +1,38 @@
+import logging
+import threading
+
+from logconfig import SampleFilter
+
+
+def record(level: int = logging.DEBUG, line: int = 1) -> logging.LogRecord:
+    return logging.LogRecord('mattbot', level, 'bot.py', line, 'message', None, None)
+
+
+def test_every_nth_debug_record_from_a_line_is_kept():
+    sample = SampleFilter(3)
+
+    assert [sample.filter(record()) for _ in range(6)] == [True, False, False, True, False, False]
+    assert sample.filter(record(line=2))
+
+
+def test_records_above_debug_are_always_kept():
+    sample = SampleFilter(100)
+
+    assert all(sample.filter(record(logging.INFO)) for _ in range(10))
+
+
+def test_sampling_from_many_threads_keeps_exactly_every_nth():
+    sample = SampleFilter(10)
+    kept = []
+
+    def log():
+        kept.append(sum(sample.filter(record()) for _ in range(10000)))
+
+    threads = [threading.Thread(target=log) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sample.seen[('bot.py', 1)] == 80000
+    assert sum(kept) == 8000
@@ -0,0 +1,158 @@
+import threading
+import time
+
+from outbound import MAX_MESSAGE_LENGTH, OutboundQueue, TokenBucket
+
+
+class FakeSlack:
+    """
+    Answers chat.postMessage, rate limiting the first calls it is told to
+
+    """
+    def __init__(self, ratelimited: int = 0, retry_after: str = '0.05') -> None:
+        self.ratelimited = ratelimited
+        self.retry_after = retry_after
+        self.posts = []  # (time, channel, text)
+        self.lock = threading.Lock()
+
+    def __call__(self, method, channel, text, **parameters):
+        with self.lock:
+            if self.ratelimited:
+                self.ratelimited -= 1
+                return {'ok': False, 'error': 'ratelimited', 'retry_after': self.retry_after}
+
+            self.posts.append((time.monotonic(), channel, text))
+            return {'ok': True}
+
+    def texts(self, channel: str = None) -> list:
+        return [text for _, posted_channel, text in self.posts if channel in (None, posted_channel)]
+
+
+def test_messages_waiting_for_a_channel_are_merged():
+    slack = FakeSlack()
+    outbound = OutboundQueue(slack, rate=100)
+    for number in range(3):
+        outbound.post('C1', f'line {number}')
+    outbound.post('C2', 'other channel')
+    outbound.start()
+    outbound.stop()
+
+    assert slack.texts('C1') == ['line 0\nline 1\nline 2']
+    assert slack.texts('C2') == ['other channel']
+    assert outbound.counts['coalesced'] == 2
+    assert outbound.counts['sent'] == 2
+
+
+def test_messages_with_other_parameters_are_not_merged():
+    slack = FakeSlack()
+    outbound = OutboundQueue(slack, rate=100)
+    outbound.post('C1', 'plain')
+    outbound.post('C1', 'threaded', thread_ts='1.0')
+    outbound.post('C1', 'plain again')
+    outbound.start()
+    outbound.stop()
+
+    assert slack.texts() == ['plain', 'threaded', 'plain again']
+
+
+def test_merging_stops_at_the_message_length_limit():
+    slack = FakeSlack()
+    outbound = OutboundQueue(slack, rate=100)
+    half = 'x' * ((MAX_MESSAGE_LENGTH - 1) // 2)
+    for _ in range(3):
+        outbound.post('C1', half)
+    outbound.start()
+    outbound.stop()
+
+    assert [len(text) for text in slack.texts()] == [len(half) * 2 + 1, len(half)]
+
+
+def test_coalescing_can_be_turned_off():
+    slack = FakeSlack()
+    outbound = OutboundQueue(slack, rate=100, coalesce=False)
+    for number in range(3):
+        outbound.post('C1', str(number))
+    outbound.start()
+    outbound.stop()
+
+    assert slack.texts() == ['0', '1', '2']
+
+
+def test_ratelimited_messages_are_retried_in_order_after_the_wait():
+    slack = FakeSlack(ratelimited=1, retry_after='0.2')
+    outbound = OutboundQueue(slack, rate=100, coalesce=False)
+    outbound.start()
+    started = time.monotonic()
+    outbound.post('C1', 'first')
+    outbound.post('C1', 'second')
+    assert outbound.wait_until_sent('C1', timeout=5)
+    outbound.stop()
+
+    assert slack.texts() == ['first', 'second']
+    assert slack.posts[0][0] - started >= 0.2
+    assert outbound.counts['ratelimited'] == 1
+    assert outbound.counts['sent'] == 2
+
+
+def test_a_ratelimited_channel_does_not_hold_up_the_others():
+    slack = FakeSlack(ratelimited=1, retry_after='0.5')
+    outbound = OutboundQueue(slack, rate=100)
+    outbound.start()
+    outbound.post('C1', 'slow')
+    time.sleep(0.05)
+    outbound.post('C2', 'fast')
+    assert outbound.wait_until_sent('C2', timeout=0.3)
+    outbound.stop()
+
+    assert slack.texts() == ['fast', 'slow']
+
+
+def test_channels_keep_to_the_rate_after_a_burst():
+    slack = FakeSlack()
+    outbound = OutboundQueue(slack, rate=20, burst=2, coalesce=False)
+    outbound.start()
+    for number in range(4):
+        outbound.post('C1', str(number))
+    outbound.stop()
+
+    times = [posted_at for posted_at, _, _ in slack.posts]
+    assert slack.texts() == ['0', '1', '2', '3']
+    # Two back to back, then one every 50ms
+    assert times[2] - times[0] >= 0.04
+    assert times[3] - times[2] >= 0.04
+
+
+def test_paused_messages_are_held_until_resumed():
+    slack = FakeSlack()
+    outbound = OutboundQueue(slack, rate=100)
+    outbound.start()
+    outbound.pause()
+    outbound.post('C1', 'held')
+    assert not outbound.wait_until_sent('C1', timeout=0.1)
+    assert slack.texts() == []
+
+    outbound.resume()
+    assert outbound.wait_until_sent('C1', timeout=5)
+    outbound.stop()
+    assert slack.texts() == ['held']
+
+
+def test_failed_posts_are_counted_and_dropped():
+    outbound = OutboundQueue(lambda method, **parameters: {'ok': False, 'error': 'channel_not_found'})
+    outbound.post('C1', 'lost')
+    outbound.start()
+    outbound.stop()
+
+    assert outbound.counts['failed'] == 1
+    assert outbound.depth() == 0
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, capacity=2)
+    now = bucket.updated_at
+
+    assert bucket.take(now=now)
+    assert bucket.take(now=now)
+    assert not bucket.take(now=now)
+    assert abs(bucket.wait_time(now=now) - 0.1) < 1e-9
+    assert bucket.take(now=now + 0.1)
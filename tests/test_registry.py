@@ -0,0 +1,102 @@
+import random
+import string
+
+from registry import BKTree, CommandRegistry, command_name, edit_distance
+
+
+class HelloCommand:
+    aliases = ('hi',)
+
+
+class DeployCommand:
+    aliases = ()
+
+
+class StatsCommand:
+    aliases = ('status',)
+
+
+def registry() -> CommandRegistry:
+    return CommandRegistry([HelloCommand, DeployCommand, StatsCommand])
+
+
+def test_command_names():
+    assert command_name(HelloCommand) == 'hello'
+    assert command_name('StatsCommand') == 'stats'
+
+
+def test_edit_distance():
+    assert edit_distance('deploy', 'deploy') == 0
+    assert edit_distance('deploy', 'depoly') == 2
+    assert edit_distance('', 'hi') == 2
+    assert edit_distance('kitten', 'sitting') == 3
+
+
+def test_exact_names_and_aliases():
+    commands = registry()
+
+    assert commands.get('hello') is HelloCommand
+    assert commands.get(' HI ') is HelloCommand
+    assert commands.get('status') is StatsCommand
+    assert commands.get('nothing') is None
+    assert commands.names == ['deploy', 'hello', 'stats']
+
+
+def test_an_exact_match_is_suggested_first():
+    assert registry().suggest('stats') == ['stats', 'status']
+
+
+def test_near_misses_are_suggested():
+    commands = registry()
+
+    assert commands.suggest('helo') == ['hello']
+    assert commands.suggest('DEPLY') == ['deploy']
+    # Longer names allow two typos
+    assert commands.suggest('depoly') == ['deploy']
+
+
+def test_misses_beyond_the_distance_are_not_suggested():
+    commands = registry()
+
+    # Short names allow one typo
+    assert commands.suggest('hlo') == []
+    assert commands.suggest('dpeoly') == []
+    assert commands.suggest('weather') == []
+
+
+def test_suggestions_are_limited():
+    commands = CommandRegistry(['Cat1Command', 'Cat2Command', 'Cat3Command', 'Cat4Command'])
+
+    assert commands.suggest('cat5') == ['cat1', 'cat2', 'cat3']
+    assert commands.suggest('cat5', limit=1) == ['cat1']
+
+
+def test_lazy_commands_are_loaded_once():
+    loaded = []
+
+    def loader(class_name):
+        loaded.append(class_name)
+        return HelloCommand
+
+    commands = CommandRegistry.from_manifest({'HelloCommand': {'aliases': ['hi']}}, loader)
+
+    assert commands.get('hi') is HelloCommand
+    assert commands.get('hello') is HelloCommand
+    assert loaded == ['HelloCommand']
+
+
+def test_the_bk_tree_finds_what_a_full_scan_finds():
+    rng = random.Random(7)
+    words = {''.join(rng.choice('abcd') for _ in range(rng.randint(1, 6))) for _ in range(300)}
+    tree = BKTree(words)
+
+    for _ in range(50):
+        query = ''.join(rng.choice(string.ascii_lowercase[:5]) for _ in range(rng.randint(1, 6)))
+        for max_distance in (0, 1, 2):
+            expected = sorted((edit_distance(query, word), word) for word in words
+                              if edit_distance(query, word) <= max_distance)
+            assert tree.search(query, max_distance) == expected
+
+
+def test_an_empty_bk_tree():
+    assert BKTree().search('hello', 2) == []
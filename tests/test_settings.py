@@ -0,0 +1,135 @@
+import queue
+import sqlite3
+
+import pytest
+
+from settings import CHANNEL, USER, WORKSPACE, SettingsStore
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'settings.sqlite3')
+
+
+def test_the_most_specific_setting_wins():
+    store = SettingsStore()
+    store.set('check_logs', 'workspace', 'T1', scope=WORKSPACE)
+    store.set('check_logs', 'channel', 'T1', 'C1', scope=CHANNEL)
+    store.set('check_logs', 'user', 'T1', 'C1', 'U1', scope=USER)
+
+    assert store.get('check_logs', 'T1', 'C1', 'U1') == 'user'
+    assert store.get('check_logs', 'T1', 'C1', 'U2') == 'channel'
+    assert store.get('check_logs', 'T1', 'C2', 'U2') == 'workspace'
+    assert store.get('check_logs', 'T2', 'C1', 'U1') is None
+    assert store.get('color', 'T1', default='blue') == 'blue'
+
+
+def test_unsetting_falls_back_to_the_wider_scope():
+    store = SettingsStore()
+    store.set('check_logs', 'workspace', 'T1', scope=WORKSPACE)
+    store.set('check_logs', 'channel', 'T1', 'C1')
+    store.set('check_logs', None, 'T1', 'C1')
+
+    assert store.get('check_logs', 'T1', 'C1') == 'workspace'
+
+
+def test_unknown_scope():
+    with pytest.raises(ValueError):
+        SettingsStore().set('check_logs', 'on', 'T1', scope='galaxy')
+
+
+def test_scoped_settings():
+    settings = SettingsStore().scoped('T1', 'C1', 'U1')
+    settings['check_logs'] = 'on'
+    settings.set('color', 'red', scope=USER)
+
+    assert settings['check_logs'] == 'on'
+    assert settings.store.get('check_logs', 'T1', 'C1', 'U2') == 'on'
+    assert settings.store.get('color', 'T1', 'C2', 'U1') == 'red'
+
+    del settings['check_logs']
+    assert settings['check_logs'] is None
+
+
+def test_changes_are_saved_in_one_batch_and_read_back(path):
+    store = SettingsStore(path)
+    store.set('check_logs', 'on', 'T1', 'C1')
+    store.set('check_logs', 'off', 'T1', 'C1')
+    store.set('color', 'red', 'T1', scope=WORKSPACE)
+
+    assert store.flush() == 2
+    assert store.flush() == 0
+    assert store.metrics() == {'cached': 2, 'pending': 0, 'written': 2, 'batches': 1}
+
+    assert SettingsStore(path).values == store.values
+    assert SettingsStore(path).get('check_logs', 'T1', 'C1') == 'off'
+
+
+def test_unset_settings_are_deleted(path):
+    store = SettingsStore(path)
+    store.set('check_logs', 'on', 'T1', 'C1')
+    store.flush()
+    store.set('check_logs', None, 'T1', 'C1')
+    store.flush()
+
+    assert SettingsStore(path).values == {}
+
+
+def test_the_writer_saves_everything_when_stopped(path):
+    store = SettingsStore(path, flush_interval=60)
+    store.start()
+    for number in range(100):
+        store.set(f'setting{number}', str(number), 'T1', scope=WORKSPACE)
+    store.stop()
+
+    assert len(SettingsStore(path).values) == 100
+    assert store.metrics()['pending'] == 0
+
+
+def test_stop_without_start_still_saves(path):
+    store = SettingsStore(path)
+    store.set('check_logs', 'on', 'T1', 'C1')
+    store.stop()
+
+    assert SettingsStore(path).get('check_logs', 'T1', 'C1') == 'on'
+
+
+def test_a_failed_batch_is_kept_for_the_next_one(path):
+    store = SettingsStore(path)
+    store.set('check_logs', 'on', 'T1', 'C1')
+
+    # Hold a write lock so the batch cannot be written
+    blocker = sqlite3.connect(path, timeout=0)
+    blocker.execute('BEGIN IMMEDIATE')
+    store.connection.execute('PRAGMA busy_timeout = 0')
+    assert store.flush() == 0
+    assert store.metrics()['pending'] == 1
+
+    blocker.rollback()
+    assert store.flush() == 1
+    assert SettingsStore(path).get('check_logs', 'T1', 'C1') == 'on'
+
+
+def test_memory_only_settings_never_wait_to_be_saved():
+    store = SettingsStore()
+    store.set('check_logs', 'on', 'T1', 'C1')
+    store.start()
+    store.stop()
+
+    assert store.metrics()['pending'] == 0
+    assert store.flush() == 0
+
+
+def test_shards_send_their_changes_to_the_coordinator():
+    from sharding import RemoteSettings
+
+    requests = queue.Queue()
+    store = RemoteSettings(requests)
+    store.set('check_logs', 'on', 'T1', 'C1', 'U1', scope=USER)
+
+    assert store.get('check_logs', 'T1', None, 'U1') == 'on'
+    assert requests.get_nowait() == ('setting', 'check_logs', 'on', 'T1', 'C1', 'U1', USER)
+
+    store.apply('check_logs', 'off', 'T1', 'C1', 'U1', scope=USER)
+    assert store.get('check_logs', 'T1', None, 'U1') == 'off'
+    assert requests.empty()
@@ -0,0 +1,134 @@
+import threading
+
+from subscriptions import Subscriptions, compile_rules, normalize
+
+
+def make_subscriptions() -> Subscriptions:
+    return Subscriptions({'C1': 'deploy-prod', 'C2': 'deploy-staging', 'C3': 'random'})
+
+
+def test_normalize():
+    assert normalize(' #Random ') == 'random'
+    assert normalize('<#C1234|general>') == 'c1234'
+    assert normalize('<#C1234>') == 'c1234'
+
+
+def test_compile_rules():
+    assert compile_rules([]) is None
+    assert compile_rules(['deploy-*']).match('DEPLOY-prod')
+
+
+def test_nothing_is_ignored_by_default():
+    subscriptions = make_subscriptions()
+
+    assert not subscriptions
+    assert not subscriptions.is_ignored('C1')
+
+
+def test_ignore_by_name_id_and_wildcard():
+    subscriptions = make_subscriptions()
+    subscriptions.ignore('#random')
+    assert subscriptions.is_ignored('C3')
+    assert subscriptions.is_ignored(b'C3')
+    assert not subscriptions.is_ignored('C1')
+
+    subscriptions.ignore('deploy-*')
+    assert subscriptions.is_ignored('C1') and subscriptions.is_ignored('C2')
+
+    subscriptions.ignore('<#C9|new>')
+    assert subscriptions.is_ignored('C9')
+
+
+def test_listen_makes_an_exception_to_a_wider_rule():
+    subscriptions = make_subscriptions()
+    subscriptions.ignore('deploy-*')
+    subscriptions.listen('deploy-prod')
+
+    assert not subscriptions.is_ignored('C1')
+    assert subscriptions.is_ignored('C2')
+    assert subscriptions.rules() == (['deploy-*'], ['deploy-prod'])
+
+
+def test_listen_removes_a_rule():
+    subscriptions = make_subscriptions()
+    subscriptions.ignore('random')
+    subscriptions.listen('#random')
+
+    assert not subscriptions.is_ignored('C3')
+    assert subscriptions.rules() == ([], [])
+
+
+def test_ignore_replaces_a_listen_rule():
+    subscriptions = make_subscriptions()
+    subscriptions.ignore('deploy-*')
+    subscriptions.listen('deploy-prod')
+    subscriptions.ignore('deploy-prod')
+
+    assert subscriptions.is_ignored('C1')
+    assert subscriptions.rules() == (['deploy-*', 'deploy-prod'], [])
+
+
+def test_renamed_channels_are_decided_again_once_forgotten():
+    channels = {'C1': 'deploy-prod'}
+    subscriptions = Subscriptions(channels)
+    subscriptions.ignore('deploy-*')
+    assert subscriptions.is_ignored('C1')
+
+    channels['C1'] = 'shipped'
+    assert subscriptions.is_ignored('C1')
+    subscriptions.forget()
+    assert not subscriptions.is_ignored('C1')
+
+
+def test_load():
+    subscriptions = make_subscriptions()
+    subscriptions.load(['deploy-*'], ['deploy-staging'])
+
+    assert subscriptions.is_ignored('C1')
+    assert not subscriptions.is_ignored('C2')
+
+
+def test_answers_from_old_rules_are_not_kept():
+    channels = {f'C{number}': f'deploy-{number}' for number in range(100)}
+    subscriptions = Subscriptions(channels)
+    errors = []
+    changing = True
+
+    def change():
+        try:
+            for _ in range(200):
+                subscriptions.ignore('deploy-*')
+                subscriptions.listen('deploy-*')
+                subscriptions.rules()
+        except Exception as error:
+            errors.append(error)
+
+    writers = [threading.Thread(target=change) for _ in range(2)]
+    for writer in writers:
+        writer.start()
+    while changing:
+        for channel in channels:
+            subscriptions.is_ignored(channel)
+        changing = any(writer.is_alive() for writer in writers)
+    for writer in writers:
+        writer.join()
+
+    assert not errors
+    assert subscriptions.rules() == ([], [])
+    assert not any(subscriptions.is_ignored(channel) for channel in channels)
+
+
+def test_the_bot_drops_commands_from_ignored_channels():
+    from bot import MattBot
+
+    bot = MattBot('token', connect=False)
+    bot.slack_user_id = 'UBOT'
+    bot.slack_channels['C1'] = 'random'
+    bot.subscriptions.ignore('random')
+
+    def message(**event):
+        return bot.classify_event(dict(type='message', channel='C1', user='U1', **event))
+
+    assert message(text=f'{bot.at_name} hello') is None
+    assert message(file={'name': 'deploy.log'}) is None
+    assert message(text=f'{bot.at_name} listen') == ('C1', 'U1', 'listen')
@@ -0,0 +1,91 @@
+import pytest
+
+from throttle import BUSY, CHANNEL, DEFAULT_LIMITS, USER, Throttle, ThrottleLimits, parse_limits
+
+LIMITS = ThrottleLimits(user_rate=1, user_burst=3, channel_rate=1, channel_burst=5, backlog=10, window=30)
+
+
+def test_a_user_gets_a_burst_then_waits():
+    throttle = Throttle(LIMITS)
+
+    assert [throttle.check('C1', 'U1')[0] for _ in range(3)] == [None, None, None]
+    reason, wait = throttle.check('C1', 'U1')
+    assert reason == USER
+    assert 0 < wait <= 1
+
+
+def test_a_channel_is_shared_by_its_users():
+    throttle = Throttle(LIMITS)
+    for user in ('U1', 'U2', 'U3', 'U4', 'U5'):
+        assert throttle.check('C1', user)[0] is None
+
+    assert throttle.check('C1', 'U6')[0] == CHANNEL
+    assert throttle.check('C2', 'U6')[0] is None
+
+
+def test_a_rejected_command_costs_nothing():
+    throttle = Throttle(LIMITS)
+    for user in ('U1', 'U2', 'U3', 'U4', 'U5'):
+        throttle.check('C1', user)
+
+    # Turned away by the channel, so U6 still has a full burst elsewhere
+    assert throttle.check('C1', 'U6')[0] == CHANNEL
+    assert [throttle.check('C2', 'U6')[0] for _ in range(3)] == [None, None, None]
+
+
+def test_costly_commands_use_the_allowance_faster():
+    throttle = Throttle(LIMITS)
+
+    assert throttle.check('C1', 'U1', cost=2)[0] is None
+    assert throttle.check('C1', 'U1', cost=2)[0] == USER
+    assert throttle.check('C1', 'U1', cost=1)[0] is None
+
+
+def test_a_cost_over_the_burst_can_still_run():
+    assert Throttle(LIMITS).check('C1', 'U1', cost=50)[0] is None
+
+
+def test_free_commands_are_never_throttled():
+    throttle = Throttle(LIMITS)
+
+    assert all(throttle.check('C1', 'U1', cost=0, backlog=100)[0] is None for _ in range(10))
+
+
+def test_a_backlog_sheds_commands():
+    throttle = Throttle(LIMITS)
+
+    assert throttle.check('C1', 'U1', backlog=10) == (BUSY, 0.0)
+    assert throttle.check('C1', 'U1', backlog=9)[0] is None
+
+
+def test_people_are_told_once_per_window():
+    throttle = Throttle(LIMITS)
+
+    assert throttle.should_notify(USER, 'U1')
+    assert not throttle.should_notify(USER, 'U1')
+    assert throttle.should_notify(CHANNEL, 'U1')
+
+    throttle.notified[(USER, 'U1')] -= LIMITS.window
+    assert throttle.should_notify(USER, 'U1')
+
+
+def test_prune_forgets_full_buckets():
+    throttle = Throttle(LIMITS)
+    throttle.check('C1', 'U1')
+    throttle.prune(throttle.users['U1'].updated_at + 60)
+
+    assert throttle.metrics() == {'users': 0, 'channels': 0}
+
+
+def test_parse_limits():
+    assert parse_limits('') == DEFAULT_LIMITS
+    assert parse_limits('off') is None
+
+    limits = parse_limits('user=2/4, channel=3,backlog=5')
+    assert (limits.user_rate, limits.user_burst) == (2, 4)
+    assert (limits.channel_rate, limits.channel_burst) == (3, DEFAULT_LIMITS.channel_burst)
+    assert limits.backlog == 5
+    assert limits.window == DEFAULT_LIMITS.window
+
+    with pytest.raises(ValueError):
+        parse_limits('everyone=1')
@@ -0,0 +1,178 @@
+"""
+Command throttling for the mattbot
+
+Every command is checked before it is dispatched. Each user and each
+channel has a token bucket, and a command takes as many tokens as its cost,
+so a file download uses up a user's allowance faster than saying hello.
+When the backlog of commands waiting to run grows past a limit, new
+commands are shed until it drains.
+
+A rejected user or channel is told once per window rather than on every
+command, so a flood of commands cannot become a flood of replies.
+
+Limits are given as a comma separated list, rates in commands per second
+and bursts in commands:
+
+    MATTBOT_THROTTLE=user=0.5/5,channel=2/10,backlog=80,window=30
+
+"""
+import collections
+import time
+import typing
+
+from outbound import TokenBucket
+
+USER = 'user'
+CHANNEL = 'channel'
+BUSY = 'busy'
+
+PRUNE_INTERVAL = 60  # Seconds between forgetting buckets that have refilled
+
+
+class ThrottleLimits(collections.namedtuple('ThrottleLimits', ['user_rate', 'user_burst', 'channel_rate',
+                                                               'channel_burst', 'backlog', 'window'])):
+    """
+    How fast users and channels may run commands, the backlog of commands
+    that sheds new ones and the seconds between telling someone they are
+    throttled.
+
+    """
+
+
+DEFAULT_LIMITS = ThrottleLimits(user_rate=0.5, user_burst=5, channel_rate=2.0, channel_burst=10, backlog=80,
+                                window=30)
+
+
+def parse_limits(spec: str) -> typing.Optional[ThrottleLimits]:
+    """
+    Parse throttle limits like user=0.5/5,channel=2/10,backlog=80,window=30,
+    anything left out keeps its default.
+
+    Returns:
+        The limits, None when the spec is off
+
+    Raises:
+        ValueError: When the spec makes no sense
+
+    """
+    spec = spec.strip()
+    if spec == 'off':
+        return None
+
+    limits = DEFAULT_LIMITS._asdict()
+    for part in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, value = part.partition('=')
+        if name in (USER, CHANNEL):
+            rate, _, burst = value.partition('/')
+            limits[f'{name}_rate'] = float(rate)
+            if burst:
+                limits[f'{name}_burst'] = float(burst)
+        elif name in ('backlog', 'window'):
+            limits[name] = float(value)
+        else:
+            raise ValueError(f'Unknown throttle limit {name}, use user, channel, backlog or window')
+
+    return ThrottleLimits(**limits)
+
+
+class Throttle:
+    """
+    Token buckets for every user and channel
+
+    Not thread safe, the bot checks commands on the thread that reads them.
+
+    """
+    def __init__(self, limits: ThrottleLimits = DEFAULT_LIMITS) -> None:
+        self.limits = limits
+        self.users = {}  # user -> bucket
+        self.channels = {}  # channel -> bucket
+        self.notified = {}  # (reason, user or channel) -> when they were last told
+        self.pruned_at = time.monotonic()
+
+    def bucket(self, buckets: dict, key: str, rate: float, burst: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst)
+
+        return bucket
+
+    def check(self, channel: str, user: str, cost: float = 1,
+              backlog: int = 0) -> typing.Tuple[typing.Optional[str], float]:
+        """
+        Check whether a command may run, taking its cost when it may.
+
+        Args:
+            channel: The channel the command came from
+            user:    The user who sent it
+            cost:    The tokens the command takes, commands that cost
+                     nothing are never throttled
+            backlog: The number of commands waiting to run
+
+        Returns:
+            A (reason, seconds) tuple, the reason is None when the command may
+            run, otherwise user, channel or busy with the seconds until it
+            might run
+
+        """
+        if cost <= 0:
+            return None, 0.0
+
+        now = time.monotonic()
+        if now - self.pruned_at >= PRUNE_INTERVAL:
+            self.prune(now)
+
+        if backlog >= self.limits.backlog:
+            return BUSY, 0.0
+
+        limits = self.limits
+        # A command costing more than a burst could never run
+        cost = min(cost, limits.user_burst, limits.channel_burst)
+        user_bucket = self.bucket(self.users, user, limits.user_rate, limits.user_burst)
+        channel_bucket = self.bucket(self.channels, channel, limits.channel_rate, limits.channel_burst)
+
+        # Neither bucket is charged unless both have room
+        user_wait = user_bucket.wait_time(cost, now)
+        if user_wait > 0:
+            return USER, user_wait
+
+        channel_wait = channel_bucket.wait_time(cost, now)
+        if channel_wait > 0:
+            return CHANNEL, channel_wait
+
+        user_bucket.take(cost, now)
+        channel_bucket.take(cost, now)
+        return None, 0.0
+
+    def should_notify(self, reason: str, key: str) -> bool:
+        """
+        Check whether to tell someone they are throttled, once per window.
+
+        Args:
+            reason: Why they were throttled
+            key:    The user or channel throttled
+
+        """
+        now = time.monotonic()
+        notified_at = self.notified.get((reason, key))
+        if notified_at is not None and now - notified_at < self.limits.window:
+            return False
+
+        self.notified[(reason, key)] = now
+        return True
+
+    def prune(self, now: float):
+        """
+        Forget the buckets that have refilled and the notices that have
+        expired, a new bucket is full anyway.
+
+        """
+        for buckets in (self.users, self.channels):
+            for key in [key for key, bucket in buckets.items() if bucket.wait_time(bucket.capacity, now) == 0]:
+                del buckets[key]
+
+        self.notified = {key: notified_at for key, notified_at in self.notified.items()
+                         if now - notified_at < self.limits.window}
+        self.pruned_at = now
+
+    def metrics(self) -> dict:
+        return {'users': len(self.users), 'channels': len(self.channels)}
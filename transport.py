@@ -0,0 +1,289 @@
+"""
+HTTP transport for the mattbot
+
+Every Web API call and file download goes through one pooled, keep-alive
+session so connections and TLS sessions are reused between calls instead of
+being set up again each time. HTTP/2 is used when httpx is installed and it
+is asked for.
+
+Downloads carry the workspace token, so files are only ever downloaded from
+Slack's file host, or from the Web API host when it is a local stand in.
+
+"""
+import collections
+import contextlib
+import json
+import logging
+import threading
+import typing
+import urllib.parse
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+SLACK_API_URL = 'https://slack.com/api/'
+
+POOL_CONNECTIONS = 4  # Hosts to keep a pool for, slack.com and files.slack.com mostly
+POOL_MAXSIZE = 16  # Connections kept alive for each host
+CONNECT_RETRIES = 2  # Retries of connections that could not be made, requests are never repeated
+
+# (connect, read) timeouts in seconds for each class of endpoint
+TIMEOUTS = {
+    'api': (3.05, 15),
+    'upload': (3.05, 60),
+    'download': (3.05, 60),
+}
+
+UPLOAD_METHODS = ('files.upload',)
+
+FILE_HOSTS = ('files.slack.com',)  # Where Slack serves private files from
+
+DOWNLOAD_FAILED = 0  # The status code of a download that never got a response
+
+
+def endpoint_class(method: str) -> str:
+    """
+    Get the timeout class of a Web API method.
+
+    """
+    return 'upload' if method in UPLOAD_METHODS else 'api'
+
+
+def encode_parameters(parameters: dict) -> dict:
+    """
+    Encode Web API parameters the way Slack expects them as form data,
+    leaving out the ones that are not set.
+
+    """
+    return {key: value if isinstance(value, str) else json.dumps(value)
+            for key, value in parameters.items() if value is not None}
+
+
+class DownloadError(IOError):
+    """
+    A file could not be downloaded
+
+    """
+
+
+class Download:
+    """
+    A streaming file download
+
+    """
+    def __init__(self, status_code: int, chunks: typing.Callable) -> None:
+        self.status_code = status_code
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size: int = 64 * 1024) -> typing.Iterator[bytes]:
+        """
+        Iterate over the body of the file as it arrives.
+
+        """
+        return self.chunks(chunk_size)
+
+
+class Transport:
+    """
+    A pooled HTTP session shared by every Web API call and file download
+
+    """
+    def __init__(self, base_url: str = SLACK_API_URL, pool_connections: int = POOL_CONNECTIONS,
+                 pool_maxsize: int = POOL_MAXSIZE, timeouts: dict = None, http2: bool = False) -> None:
+        """
+        Initialize the transport
+
+        Args:
+            base_url:         The Web API URL, a local stand in for testing for example
+            pool_connections: The number of hosts to keep a pool of connections for
+            pool_maxsize:     The connections to keep alive for each host
+            timeouts:         (connect, read) timeouts by endpoint class, see TIMEOUTS
+            http2:            Use HTTP/2 when httpx is installed
+
+        """
+        self.base_url = base_url.rstrip('/') + '/'
+        self.timeouts = dict(TIMEOUTS, **(timeouts or {}))
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.client = None
+        self.session = None
+        self.errors = (requests.RequestException,)  # Raised when a request could not be made
+
+        if http2:
+            try:
+                import httpx
+                limits = httpx.Limits(max_connections=pool_connections * pool_maxsize,
+                                      max_keepalive_connections=pool_maxsize)
+                self.client = httpx.Client(http2=True, limits=limits)
+                self.errors = (httpx.HTTPError,)
+            except ImportError:
+                logger.warning('HTTP/2 needs httpx[http2] to be installed, falling back to HTTP/1.1')
+
+        if self.client is None:
+            self.session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                                  max_retries=CONNECT_RETRIES)
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
+
+    def count(self, key: str):
+        with self.lock:
+            self.counts[key] += 1
+
+    def api_call(self, method: str, token: str, **parameters) -> dict:
+        """
+        Call the Slack Web API
+
+        Args:
+            method:     The API method to call
+            token:      The token of the workspace to call it for
+            parameters: The arguments of the call
+
+        Returns:
+            The decoded response, a ratelimited response carries retry_after
+            and a call that could not be made has ok set to False
+
+        """
+        files = None
+        if method in UPLOAD_METHODS and 'file' in parameters:
+            files = {'file': parameters.pop('file')}
+
+        data = encode_parameters(parameters)
+        data['token'] = token
+        url = self.base_url + method
+        timeout = self.timeouts[endpoint_class(method)]
+
+        self.count('api_calls')
+        try:
+            if self.client is not None:
+                response = self.client.post(url, data=data, files=files, timeout=timeout)
+            else:
+                response = self.session.post(url, data=data, files=files, timeout=timeout)
+        except Exception as error:
+            logger.error('Could not call %s: %s', method, error)
+            self.count('errors')
+            return {'ok': False, 'error': str(error)}
+
+        if response.status_code == 429:
+            self.count('ratelimited')
+            return {'ok': False, 'error': 'ratelimited', 'retry_after': response.headers.get('Retry-After')}
+
+        try:
+            return response.json()
+        except ValueError:
+            logger.error('Got a %s response that is not JSON from %s', response.status_code, method)
+            self.count('errors')
+            return {'ok': False, 'error': f'http_{response.status_code}'}
+
+    @contextlib.contextmanager
+    def download(self, url: str, token: str) -> typing.Iterator[Download]:
+        """
+        Stream a private file.
+
+        Args:
+            url:   The private download URL of the file
+            token: The token of the workspace the file belongs to
+
+        Returns:
+            The download, with a status code of DOWNLOAD_FAILED when the file
+            could not be requested
+
+        Raises:
+            ValueError:    When the file is not on a Slack file host
+            DownloadError: When the connection is lost reading the file
+
+        """
+        if not self.is_file_url(url):
+            self.count('refused')
+            raise ValueError(f'Refusing to send the token to {url}, it is not a Slack file')
+
+        headers = {'Authorization': f'Bearer {token}'}
+        timeout = self.timeouts['download']
+
+        self.count('downloads')
+        with contextlib.ExitStack() as stack:
+            try:
+                if self.client is not None:
+                    response = stack.enter_context(self.client.stream('GET', url, headers=headers, timeout=timeout))
+                    chunks = response.iter_bytes
+                else:
+                    response = self.session.get(url, headers=headers, timeout=timeout, stream=True)
+                    # Hands the connection back to the pool
+                    stack.callback(response.close)
+                    chunks = response.iter_content
+            except self.errors as error:
+                logger.error('Could not download %s: %s', url, error)
+                self.count('errors')
+                response = None
+
+            if response is None:
+                yield Download(DOWNLOAD_FAILED, lambda chunk_size: iter(()))
+            else:
+                yield Download(response.status_code, self.read_chunks(url, chunks))
+
+    def read_chunks(self, url: str, chunks: typing.Callable) -> typing.Callable:
+        """
+        Wrap the chunks of a download so a lost connection raises a
+        DownloadError rather than an error of the HTTP library.
+
+        """
+        def read(chunk_size: int) -> typing.Iterator[bytes]:
+            try:
+                yield from chunks(chunk_size=chunk_size)
+            except self.errors as error:
+                logger.error('Lost the download of %s: %s', url, error)
+                self.count('errors')
+                raise DownloadError(f'Could not download {url}') from error
+
+        return read
+
+    def is_file_url(self, url: str) -> bool:
+        """
+        Check whether a URL is on a host the token may be sent to, Slack's
+        file host or the Web API host.
+
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme == 'https' and parts.hostname in FILE_HOSTS:
+            return True
+
+        api = urllib.parse.urlsplit(self.base_url)
+        return bool(parts.netloc) and (parts.scheme, parts.netloc) == (api.scheme, api.netloc)
+
+    def metrics(self) -> dict:
+        """
+        Get the call counts and how often a pooled connection was reused.
+
+        Connections are counted for HTTP/1.1 only, httpx does not expose them.
+
+        """
+        with self.lock:
+            metrics = dict(self.counts)
+
+        if self.session is not None:
+            requests_made = connections_made = 0
+            for adapter in set(self.session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool is not None:
+                        requests_made += pool.num_requests
+                        connections_made += pool.num_connections
+
+            metrics['pool_hits'] = requests_made - connections_made
+            metrics['pool_misses'] = connections_made
+
+        return metrics
+
+    def close(self):
+        """
+        Close every pooled connection.
+
+        """
+        if self.client is not None:
+            self.client.close()
+        if self.session is not None:
+            self.session.close()
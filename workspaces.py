@@ -0,0 +1,198 @@
+"""
+Multi workspace hosting for the mattbot
+
+One runtime hosts a bot for every workspace token it is given. Each
+workspace keeps its own directory, outbound queue and rate limits, and its
+metrics carry a workspace label. The command registry, the HTTP connection
+pool, the settings store, the threads for blocking calls and the asyncio
+event loop are shared, so another workspace costs little more than its
+directory. Settings are kept apart by the team id of each workspace.
+
+Tokens are given as a comma separated list, each optionally labelled:
+
+    MATTBOT_TOKENS=acme=xoxb-1234,xoxb-5678
+
+A workspace without a label is labelled with its team id once connected.
+
+"""
+import asyncio
+import logging
+import typing
+
+from concurrent.futures import ThreadPoolExecutor
+
+import commands
+from bot import MattBot
+from engine import MAX_WORKERS, AsyncEngine
+from metrics import BotMetrics, MetricsRegistry, MetricsServer
+from registry import CommandRegistry
+from settings import SettingsStore
+from transport import Transport
+
+logger = logging.getLogger(__name__)
+
+WORKERS_PER_WORKSPACE = 2  # Threads added to the shared pool for every workspace
+
+
+def parse_tokens(tokens: str) -> list:
+    """
+    Parse a comma separated list of tokens like acme=xoxb-1234,xoxb-5678.
+
+    Returns:
+        A list of (label, token) tuples, the label is None when not given
+
+    """
+    workspaces = []
+    for entry in tokens.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+
+        label, _, token = entry.rpartition('=')
+        workspaces.append((label or None, token))
+
+    return workspaces
+
+
+class WorkspaceHost:
+    """
+    Runs a bot for every workspace on one event loop
+
+    """
+    def __init__(self, workspaces: typing.Sequence[tuple], name: str = None, registry: CommandRegistry = None,
+                 transport: Transport = None, loop: asyncio.AbstractEventLoop = None, max_workers: int = None,
+                 metrics_port: int = None, settings: SettingsStore = None, **kwargs) -> None:
+        """
+        Initialize the host
+
+        Args:
+            workspaces:   (label, token) tuples, see parse_tokens
+            name:         The user name of the bot in every workspace
+            registry:     The commands every bot knows, every command in the
+                          commands package by default
+            transport:    The HTTP connection pool every bot calls through,
+                          a new one by default
+            loop:         The event loop to run on, a new one by default
+            max_workers:  The threads for blocking calls, a few for every
+                          workspace by default
+            metrics_port: Serve the metrics of every workspace in the
+                          Prometheus text format on this local port
+            settings:     Where every workspace keeps its settings, only in
+                          memory by default
+            kwargs:       Passed on to every MattBot
+
+        """
+        if registry is None:
+            registry = CommandRegistry.from_manifest(commands.load_manifest(), commands.load)
+        if transport is None:
+            transport = Transport()
+        if max_workers is None:
+            max_workers = max(MAX_WORKERS, WORKERS_PER_WORKSPACE * len(workspaces))
+        if settings is None:
+            settings = SettingsStore()
+
+        self.name = name
+        self.registry = registry
+        self.transport = transport
+        self.settings = settings
+        self.loop = loop or asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.options = kwargs
+
+        # What the workspaces share is counted once, outside of any workspace
+        self.metrics = MetricsRegistry()
+        self.metrics.gauge('mattbot_transport', 'HTTP transport counts and pool reuse',
+                           self.transport.metrics, label_name='stat')
+        self.metrics.gauge('mattbot_settings', 'Settings cached, waiting to be saved and saved',
+                           self.settings.metrics, label_name='stat')
+        self.metrics.gauge('mattbot_workspaces', 'Workspaces hosted and still living', self.counts,
+                           label_name='stat')
+
+        self.bots = []
+        self.engines = []
+        for label, token in workspaces:
+            self.add(token, label)
+
+        self.metrics_server = None
+        if metrics_port is not None:
+            self.metrics_server = MetricsServer([self.metrics] + [bot.metrics for bot in self.bots],
+                                                port=metrics_port)
+
+    def add(self, token: str, label: str = None) -> MattBot:
+        """
+        Add a workspace, before the host runs.
+
+        """
+        metrics = BotMetrics({'workspace': label} if label else None)
+        bot = MattBot(token, name=self.name, registry=self.registry, transport=self.transport, connect=False,
+                      settings=self.settings, metrics=metrics, **self.options)
+        metrics.remove('mattbot_transport')
+        metrics.remove('mattbot_settings')
+
+        self.bots.append(bot)
+        self.engines.append(AsyncEngine(bot, loop=self.loop, executor=self.executor))
+        return bot
+
+    def connect(self):
+        """
+        Connect every workspace, a few at a time.
+
+        """
+        def connect(bot):
+            if not bot.connect():
+                # One refused token does not keep the other workspaces down
+                logger.error('Could not connect workspace %s', bot.metrics.constant_labels.get('workspace'))
+                bot.living = False
+            bot.metrics.constant_labels.setdefault('workspace', bot.team_id or 'unknown')
+
+        list(self.executor.map(connect, self.bots))
+
+    def counts(self) -> dict:
+        return {'hosted': len(self.bots), 'living': sum(bot.living for bot in self.bots)}
+
+    def run(self):
+        """
+        Run every workspace until they have all died.
+
+        """
+        self.loop.set_default_executor(self.executor)
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        for bot in self.bots:
+            if bot.outbound is not None:
+                bot.outbound.start()
+        self.settings.start()
+
+        listening = asyncio.ensure_future(self.listen_all(), loop=self.loop)
+        try:
+            self.loop.run_until_complete(listening)
+        finally:
+            for bot in self.bots:
+                bot.living = False
+            # Every listener notices within a read timeout
+            self.loop.run_until_complete(asyncio.wait([listening]))
+            self.loop.run_until_complete(self.drain_all())
+            self.executor.shutdown(wait=True)
+            # Anything the last commands said still gets posted
+            for bot in self.bots:
+                if bot.outbound is not None:
+                    bot.outbound.stop()
+            self.settings.stop()
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+
+    async def listen_all(self):
+        await asyncio.gather(*(self.listen(engine) for engine in self.engines))
+
+    async def drain_all(self):
+        await asyncio.gather(*(engine.drain() for engine in self.engines))
+
+    async def listen(self, engine: AsyncEngine):
+        """
+        Listen to one workspace, one failing does not stop the others.
+
+        """
+        try:
+            await engine.listen()
+        except Exception:
+            logger.exception('Stopped listening to workspace %s', engine.bot.metrics.constant_labels.get('workspace'))